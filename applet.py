@@ -1,17 +1,33 @@
 import streamlit as st
 import pandas as pd
 from io import StringIO
-from visualization import potential_data_visualisation
-from data_extraction_openai import get_data
 from data_correction import get_datetime_columns, convert_string_columns
-from explanation import get_explanation
 import duckdb
 import os
-from openai import OpenAI
-from data_visualisation_openai import get_data_visualisation
-from data_forecast import potential_timeseries_forecasting, identify_timeseries_datetime_column, iterative_forecasting, is_forecast_request
+import uuid
+from data_forecast import (
+    potential_timeseries_forecasting, identify_timeseries_datetime_column, run_forecasting, forecast_backends,
+    load_forecast_history,
+)
+from pipeline import answer_question
+from data_extraction_openai import sql_cache
+from cache import get_cache, make_key, cached_call, fingerprint_file
+from telemetry import metrics, start_metrics_server
+from llm_client import get_client, llm_session
+from schema_summary import describe_table, format_summary, summarize_table
+from column_index import build_column_index, WIDE_TABLE_COLUMNS
+from ingestion import (
+    STREAMING_THRESHOLD_BYTES, UPLOAD_TYPES, TYPED_FORMATS, connect_dataset, ingest_csv, read_preview,
+    table_exists, file_format, load_typed_file, Registrations, touch_dataset, sweep_datasets
+)
+from dataset_store import get_store
+from rollups import build_rollups, load_rollups
+from sampling import build_sample, load_sample, describe_approximation
 
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Shared by every session: pooled connections, rate limits, backoff and circuit breaker
+client = get_client()
+# Prometheus metrics on DOCUMENTCHAT_METRICS_PORT, when set
+start_metrics_server()
 
 # DuckDB Connection
 def get_duckdb_connection():
@@ -19,8 +35,66 @@ def get_duckdb_connection():
         st.session_state.duckdb_con = duckdb.connect()
     return st.session_state.duckdb_con
 
-def create_metadata(df):
-    return df.head().to_string()
+def get_registrations(con):
+    # Registrations belong to a connection; a new connection starts with none
+    registrations = st.session_state.get("registrations")
+    if registrations is None or registrations.con is not con:
+        registrations = st.session_state.registrations = Registrations(con)
+    return registrations
+
+def load_upload(con, uploaded_file, upload_format, fingerprint, streaming, verdicts, materialize=False):
+    """
+    Loads an upload into con as 'dataframe' (or, for in-memory CSVs, returns it for
+    registration) and returns the DataFrame to display.
+    """
+    if upload_format in TYPED_FORMATS:
+        # Typed formats need neither string conversion nor LLM datetime inference
+        return load_typed_file(uploaded_file, upload_format, fingerprint, con, materialize=materialize)
+
+    head = pd.read_csv(uploaded_file, nrows=5)
+    uploaded_file.seek(0)
+    datetime_cols = cached_call(
+        verdicts, make_key(fingerprint, "get_datetime_columns"),
+        get_datetime_columns, head, client, fallback={}
+    )
+    print(datetime_cols, 'main')
+    if streaming or materialize:
+        # Only a bounded preview is kept in memory; queries run on the on-disk table
+        if table_exists(con, 'dataframe'):
+            return read_preview(con)
+        return ingest_csv(uploaded_file, con, datetime_columns=datetime_cols)
+    df = pd.read_csv(uploaded_file)
+    return convert_string_columns(df, datetime_cols)
+
+def request_exact_run(question):
+    # Picked up by the next rerun, which answers the question without approximation
+    st.session_state.exact_query = question
+
+def stream_with_chart(explanation, figure, chart_slot):
+    """
+    Passes the explanation's text through to st.write_stream, drawing the chart into its
+    placeholder as soon as it is ready, between two chunks.
+    """
+    for text in explanation:
+        if figure is not None and figure.done():
+            if figure.result() is not None:
+                chart_slot.plotly_chart(figure.result())
+            figure = None
+        yield text
+    if figure is not None and figure.result() is not None:
+        chart_slot.plotly_chart(figure.result())
+
+def show_latency_breakdown(trace_id):
+    spans = metrics.trace(trace_id)
+    if not spans:
+        return
+    breakdown = pd.DataFrame(spans)[["stage", "seconds", "first_token_seconds", "prompt_tokens", "completion_tokens", "retry", "cache_hit"]]
+    st.sidebar.write("Last answer")
+    st.sidebar.dataframe(breakdown, hide_index=True)
+    st.sidebar.caption(
+        f"{int((~breakdown['cache_hit']).sum())} LLM calls, {breakdown['seconds'].sum():.2f}s of LLM time, "
+        f"{int(breakdown['prompt_tokens'].sum() + breakdown['completion_tokens'].sum())} tokens"
+    )
 
 # Streamlit app
 def main():
@@ -33,63 +107,193 @@ def main():
         st.session_state.metadata = None
     if "forecast_df" not in st.session_state:
         st.session_state.forecast_df = None
+    if "forecast_metadata" not in st.session_state:
+        st.session_state.forecast_metadata = None
+
+    forecast_backend = st.sidebar.selectbox(
+        "Forecasting backend", list(forecast_backends), format_func=forecast_backends.get
+    )
+    if st.session_state.get("forecast_backend") != forecast_backend:
+        # Recompute the forecast when the backend changes
+        st.session_state.forecast_backend = forecast_backend
+        st.session_state.forecast_df = None
+
+    approximate = st.sidebar.checkbox(
+        "Approximate answers from a sample", value=False,
+        help="Counts, sums and averages of very large uploads are estimated from a sample, with error bounds."
+    )
+
+    stream = st.sidebar.checkbox("Stream explanations", value=True)
+
+    sql_cache_stats = sql_cache.stats()
+    st.sidebar.caption(
+        f"SQL cache: {sql_cache_stats['hits']} hits, {sql_cache_stats['semantic_hits']} similar-question hits, "
+        f"{sql_cache_stats['misses']} misses, {sql_cache_stats['entries']} entries"
+    )
 
-    uploaded_file = st.file_uploader("Upload a CSV file", type="csv")
+    uploaded_file = st.file_uploader("Upload a data file", type=UPLOAD_TYPES)
+    forecasting_flag = False
 
     if uploaded_file is not None:
+        streaming = st.sidebar.checkbox(
+            "Stream upload into DuckDB on disk", value=uploaded_file.size > STREAMING_THRESHOLD_BYTES
+        )
+        rollups_enabled = st.sidebar.checkbox("Pre-aggregate rollups for dashboard questions", value=True)
+        if st.session_state.get("upload_id") != uploaded_file.file_id or st.session_state.get("streaming") != streaming:
+            # A new file was uploaded; fingerprint it and reset the derived state
+            st.session_state.upload_id = uploaded_file.file_id
+            st.session_state.streaming = streaming
+            st.session_state.fingerprint = fingerprint_file(uploaded_file)
+            st.session_state.df = None
+            st.session_state.metadata = None
+            st.session_state.column_index = None
+            st.session_state.rollups = None
+            st.session_state.pop("sample", None)
+            st.session_state.forecast_df = None
+            st.session_state.pop("duckdb_con", None)
+            dataset = st.session_state.pop("dataset", None)
+            if dataset is not None:
+                dataset.close()
+            # Delete the files of datasets every session has moved on from (the store deletes
+            # its own), touching the new file first in case it is one of them
+            touch_dataset(st.session_state.fingerprint)
+            store = get_store()
+            sweep_datasets(keep=store.contains if store is not None else None)
+
+        # Dataset-level LLM verdicts are keyed by the file contents and persisted to disk
+        verdicts = get_cache("dataset_verdicts")
+        fingerprint = st.session_state.fingerprint
+        upload_format = file_format(uploaded_file.name)
+        # Every rerun counts as a use, so files of open sessions are never swept
+        touch_dataset(fingerprint)
+
         if st.session_state.df is None:  # Load and clean the dataframe only once
-            df = pd.read_csv(uploaded_file)
-            datetime_cols = get_datetime_columns(df.head(), client)
-            print(datetime_cols, 'main')
-            df = convert_string_columns(df, datetime_cols)
-            st.session_state.df = df
-            st.session_state.metadata = create_metadata(df)
-
-        # Re-register dataframe to DuckDB
+            store = get_store()
+            if store is not None and store.can_open(fingerprint):
+                # One copy per file for all sessions, loaded by whichever session opens it first
+                dataset = store.open(
+                    fingerprint,
+                    lambda cursor: load_upload(cursor, uploaded_file, upload_format, fingerprint, streaming, verdicts, materialize=True)
+                )
+                st.session_state.dataset = dataset
+                st.session_state.duckdb_con = dataset.cursor
+                st.session_state.df = read_preview(dataset.cursor)
+            else:
+                if streaming:
+                    st.session_state.duckdb_con = connect_dataset(fingerprint)
+                st.session_state.df = load_upload(
+                    get_duckdb_connection(), uploaded_file, upload_format, fingerprint, streaming, verdicts
+                )
+
+        # Shared, streamed and typed datasets are queried in place
+        in_duckdb = "dataset" in st.session_state or streaming or upload_format in TYPED_FORMATS
+        st.session_state.in_duckdb = in_duckdb
+
+        # Registered once per dataset rather than on every rerun
         con = get_duckdb_connection()
-        con.register('dataframe', st.session_state.df)
+        registrations = get_registrations(con)
+        if not in_duckdb:
+            registrations.register('dataframe', st.session_state.df, fingerprint)
+        if st.session_state.metadata is None:
+            # One SUMMARIZE pass per dataset; every prompt reuses the description
+            row_count, columns = cached_call(
+                get_cache("schema_summaries"), make_key(fingerprint, "dataframe"),
+                summarize_table, con, 'dataframe'
+            )
+            st.session_state.metadata = format_summary('dataframe', row_count, columns)
+            # Only wide tables are narrowed to the relevant columns, so only they are embedded
+            if len(columns) > WIDE_TABLE_COLUMNS:
+                st.session_state.column_index = build_column_index(fingerprint, 'dataframe', row_count, columns)
+            st.session_state.table_profile = (row_count, columns)
+        if st.session_state.get("rollups") is None or st.session_state.get("rollups_enabled") != rollups_enabled:
+            # Built once per dataset, next to it; shared datasets are written through the store
+            st.session_state.rollups_enabled = rollups_enabled
+            if rollups_enabled:
+                row_count, columns = st.session_state.table_profile
+                build = lambda cursor: build_rollups(cursor, row_count, columns)
+                if "dataset" in st.session_state:
+                    get_store().write(fingerprint, build)
+                else:
+                    build(con)
+            st.session_state.rollups = load_rollups(con) if rollups_enabled else []
+        if approximate and "sample" not in st.session_state:
+            # Drawn once per dataset, the first time approximate answers are asked for
+            row_count, columns = st.session_state.table_profile
+            build = lambda cursor: build_sample(cursor, row_count, columns)
+            if "dataset" in st.session_state:
+                get_store().write(fingerprint, build)
+            else:
+                build(con)
+            st.session_state.sample = load_sample(con)
 
-        
         st.write("Uploaded Data")
         st.write(st.session_state.df)
 
-        forecasting_flag = potential_timeseries_forecasting(st.session_state.metadata, client)
+        forecasting_flag = cached_call(
+            verdicts, make_key(fingerprint, "potential_timeseries_forecasting"),
+            potential_timeseries_forecasting, st.session_state.metadata, client, fallback=False
+        )
         if forecasting_flag:
             if st.session_state.forecast_df is None:  # Load and clean the dataframe only once
-                timestamp_column = identify_timeseries_datetime_column(st.session_state.metadata, client)
-                forecast_df = iterative_forecasting(st.session_state.df, timestamp_column, client)
+                timestamp_column = cached_call(
+                    verdicts, make_key(fingerprint, "identify_timeseries_datetime_column"),
+                    identify_timeseries_datetime_column, st.session_state.metadata, client, fallback=None
+                )
+                if in_duckdb:
+                    history = load_forecast_history(con, timestamp_column, st.session_state.table_profile[1])
+                else:
+                    history = st.session_state.df
+                forecast_df = run_forecasting(history, timestamp_column, client, forecast_backend)
                 st.session_state.forecast_df = forecast_df
+                st.session_state.forecast_version = uuid.uuid4().hex
+                registrations.register('forecast_dataframe', forecast_df, st.session_state.forecast_version)
+                st.session_state.forecast_metadata = describe_table(con, 'forecast_dataframe')
             st.write(st.session_state.forecast_df)
-            con.register('forecast_dataframe', st.session_state.forecast_df)
+        registrations.register('forecast_dataframe', st.session_state.forecast_df, st.session_state.get("forecast_version"))
         
     # User query input
     user_query = st.text_input("Ask questions about your data")
 
-    if st.button("Get Answer!"):
-        if st.session_state.df is not None and user_query:
-            # Re-register the dataframe again to ensure persistence
+    exact_query = st.session_state.pop("exact_query", None)
+    if st.button("Get Answer!") or exact_query:
+        question = exact_query or user_query
+        if st.session_state.df is not None and question:
+            # The tables were registered with the upload above
             con = get_duckdb_connection()
-            con.register('dataframe', st.session_state.df)
-            con.register('forecast_dataframe', st.session_state.forecast_df)
-            forecast_request = is_forecast_request(user_query, client)
-            if forecasting_flag and forecast_request:
-                forecasting = True
+            answer = answer_question(
+                question, st.session_state, forecasting_flag, client, con,
+                approximate=approximate and not exact_query, stream=stream
+            )
+            if "dataset" in st.session_state:
+                get_store().record_query(st.session_state.fingerprint)
             else:
-                forecasting = False
-            # Generate response
-            visualisation = potential_data_visualisation(user_query, st.session_state, forecasting, client)
-            data = get_data(visualisation, user_query, st.session_state, forecasting, client, con)
+                get_registrations(con).record_query('dataframe')
+            st.session_state.last_trace_id = answer.trace_id
             st.write("Response:")
-            st.write(data)
-            st.write(get_explanation(user_query, st.session_state, client, data).explanation)
-            
-            print(visualisation)
-            if visualisation is not None:
-                visualisation_figure = get_data_visualisation(data, visualisation, client, st)
-                st.plotly_chart(visualisation_figure)
+            st.write(answer.data)
+            if answer.data.attrs.get("truncated"):
+                shown = "a sample" if answer.data.attrs.get("sampled") else "the first"
+                st.caption(f"Showing {shown} {len(answer.data)} of {answer.data.attrs['row_count']} rows.")
+            if answer.data.attrs.get("approximate"):
+                st.caption(describe_approximation(answer.data.attrs["approximate"]))
+                st.button("Run exactly", on_click=request_exact_run, args=(question,))
+            if stream:
+                # The table is shown and the chart drawn while the explanation is generated
+                chart_slot = st.empty()
+                st.write_stream(stream_with_chart(answer.explanation, answer.figure, chart_slot))
+            else:
+                st.write(answer.explanation.explanation)
+
+                if answer.figure is not None:
+                    st.plotly_chart(answer.figure)
 
         else:
             st.write("Please upload a file and ask a question.")
 
+    if st.sidebar.checkbox("Show latency breakdown") and st.session_state.get("last_trace_id"):
+        show_latency_breakdown(st.session_state.last_trace_id)
+
 if __name__ == "__main__":
-    main()
+    # Caps the concurrent LLM calls of one browser session
+    with llm_session(st.session_state.setdefault("llm_session_id", uuid.uuid4().hex)):
+        main()
@@ -0,0 +1,260 @@
+"""
+Replays a JSONL benchmark of questions through the NL->SQL pipeline and records
+per-stage latency, token usage, retries and result correctness.
+
+Each question is answered by pipeline.answer_question, exactly as the app does, and the
+per-stage numbers are read from the telemetry spans of its trace: the LLM time, tokens,
+cache hits and calls marked by retrying() (answer-correction retries) per stage, plus the
+transport retries LLMClient made. Stages run concurrently, so their times do not add up
+to the end-to-end latency, which is recorded separately.
+
+Each line of the benchmark file is a JSON object:
+    {"id": "...", "dataset": "path/to/file.csv", "question": "...",
+     "expected_sql": "SELECT ..."}            # or "expected": [[row values], ...]
+    optional: "ordered": true to compare rows in order
+
+Usage:
+    python benchmark.py benchmarks/example.jsonl --base-url http://localhost:8000/v1 --output run.json
+    python benchmark.py benchmarks/example.jsonl --baseline previous.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+import duckdb
+import pandas as pd
+import data_extraction_openai
+from cache import DiskCache
+from mock_openai import ReplayClient, RecordingClient
+from llm_client import LLMClient, create_openai_client
+from data_correction import convert_string_columns
+from pipeline import answer_question
+from schema_summary import describe_table
+from telemetry import InstrumentedClient, metrics
+
+STAGE_FIELDS = ("calls", "seconds", "prompt_tokens", "completion_tokens", "retries", "transport_retries", "cache_hits", "errors")
+
+
+def load_dataset(path, con):
+    """
+    Registers a dataset as 'dataframe' like the app does and returns the session state.
+    """
+    if path.lower().endswith(".csv"):
+        df = convert_string_columns(pd.read_csv(path))
+        con.register("dataframe", df)
+    else:
+        con.execute(f"CREATE OR REPLACE VIEW dataframe AS SELECT * FROM '{path}'")
+        df = con.execute("SELECT * FROM dataframe LIMIT 1000").fetchdf()
+    return SimpleNamespace(df=df, forecast_df=None, metadata=describe_table(con, "dataframe"), forecast_metadata=None)
+
+
+def normalize_rows(frame, ordered=False):
+    """
+    Converts a result to comparable rows, ignoring column names and float noise.
+    """
+    rows = [
+        tuple(round(value, 6) if isinstance(value, float) else str(value) for value in row)
+        for row in frame.itertuples(index=False, name=None)
+    ]
+    return rows if ordered else sorted(rows, key=repr)
+
+
+def retry_counts():
+    """
+    Returns the process-wide retry counter of every stage.
+    """
+    return {name: stage_metrics.retries for name, stage_metrics in metrics.stages.items()}
+
+
+def stage_breakdown(spans, retries_before, retries_after):
+    """
+    Sums the spans of one trace per stage.
+
+    Parameters:
+    - spans: The spans of the trace, see telemetry.Metrics.trace.
+    - retries_before / retries_after: retry_counts() around the trace; the counters also
+      count LLMClient's transport retries, which record no span of their own.
+
+    Returns:
+    - A dictionary of stage name to its STAGE_FIELDS.
+    """
+    stages = {}
+    for span in spans:
+        totals = stages.setdefault(span["stage"], dict.fromkeys(STAGE_FIELDS, 0))
+        if span["cache_hit"]:
+            totals["cache_hits"] += 1
+            continue
+        totals["calls"] += 1
+        totals["seconds"] += span["seconds"]
+        totals["prompt_tokens"] += span["prompt_tokens"]
+        totals["completion_tokens"] += span["completion_tokens"]
+        totals["retries"] += int(span["retry"])
+        totals["errors"] += int(span["error"])
+    for name, count in retries_after.items():
+        transport_retries = count - retries_before.get(name, 0) - stages.get(name, {}).get("retries", 0)
+        if transport_retries > 0:
+            stages.setdefault(name, dict.fromkeys(STAGE_FIELDS, 0))["transport_retries"] = transport_retries
+    return stages
+
+
+def run_case(case, client, datasets):
+    """
+    Answers one benchmark case with the pipeline and returns its record. Cases run one
+    at a time, so the retry counters only move for the case's own calls.
+    """
+    path = case["dataset"]
+    if path not in datasets:
+        con = duckdb.connect()
+        datasets[path] = (con, load_dataset(path, con))
+    con, session_state = datasets[path]
+
+    record = {"id": case.get("id", case["question"]), "question": case["question"], "latency": None, "error": None}
+    data = None
+    trace_id = None
+    retries_before = retry_counts()
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        answer = answer_question(case["question"], session_state, False, client, con)
+        trace_id = answer.trace_id
+        data = answer.data
+        record["latency"] = time.perf_counter() - start
+    except Exception as e:
+        record["error"] = str(e)
+
+    if trace_id is not None:
+        spans = metrics.trace(trace_id)
+    else:
+        # A failed answer returns no trace id; its spans are the ones recorded since it started
+        spans = metrics.since(started_at)
+    record["stages"] = stage_breakdown(spans, retries_before, retry_counts())
+    record["sql_cache_hit"] = record["stages"].get("sql", {}).get("cache_hits", 0) > 0
+
+    if data is None:
+        record["correct"] = False
+    elif "expected_sql" in case:
+        expected = con.execute(case["expected_sql"]).fetchdf()
+        record["correct"] = normalize_rows(data, case.get("ordered")) == normalize_rows(expected, case.get("ordered"))
+    elif "expected" in case:
+        expected = pd.DataFrame(case["expected"])
+        record["correct"] = normalize_rows(data, case.get("ordered")) == normalize_rows(expected, case.get("ordered"))
+    else:
+        record["correct"] = None
+    return record
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+
+def summarize(records):
+    """
+    Aggregates the end-to-end latency, per-stage LLM time percentiles, tokens, retries and
+    accuracy over a run.
+    """
+    latencies = [record["latency"] for record in records if record["latency"] is not None]
+    summary = {
+        "cases": len(records),
+        "errors": sum(1 for record in records if record["error"]),
+        "sql_cache_hits": sum(1 for record in records if record.get("sql_cache_hit")),
+        "latency": {
+            "p50": statistics.median(latencies) if latencies else None,
+            "p95": percentile(latencies, 0.95),
+            "mean": statistics.fmean(latencies) if latencies else None,
+        },
+        "stages": {},
+    }
+    scored = [record["correct"] for record in records if record["correct"] is not None]
+    summary["accuracy"] = sum(scored) / len(scored) if scored else None
+    for stage in sorted({stage for record in records for stage in record["stages"]}):
+        totals = [record["stages"][stage] for record in records if stage in record["stages"]]
+        seconds = [total["seconds"] for total in totals if total["calls"]]
+        summary["stages"][stage] = {
+            "p50": statistics.median(seconds) if seconds else None,
+            "p95": percentile(seconds, 0.95),
+            "mean": statistics.fmean(seconds) if seconds else None,
+        }
+        for field in STAGE_FIELDS:
+            if field != "seconds":
+                summary["stages"][stage][field] = sum(total[field] for total in totals)
+    return summary
+
+
+def compare(report, baseline):
+    """
+    Compares a run with a baseline report and returns the ids of cases that regressed.
+    """
+    print("stage                    p50 (s)            tokens (prompt+completion)   retries")
+    previous_stages = baseline["summary"].get("stages", {})
+    for stage in sorted(set(report["summary"]["stages"]) | set(previous_stages)):
+        current, previous = report["summary"]["stages"].get(stage, {}), previous_stages.get(stage, {})
+        tokens = current.get("prompt_tokens", 0) + current.get("completion_tokens", 0)
+        previous_tokens = previous.get("prompt_tokens", 0) + previous.get("completion_tokens", 0)
+        retries = current.get("retries", 0) + current.get("transport_retries", 0)
+        previous_retries = previous.get("retries", 0) + previous.get("transport_retries", 0)
+        print(
+            f"{stage:<24} {previous.get('p50')!s:>8} -> {current.get('p50')!s:<8} "
+            f"{previous_tokens:>8} -> {tokens:<8} {previous_retries:>8} -> {retries}"
+        )
+    previous_latency = baseline["summary"].get("latency", {})
+    print(f"{'end to end':<24} {previous_latency.get('p50')!s:>8} -> {report['summary']['latency']['p50']!s}")
+    print(f"accuracy       {baseline['summary'].get('accuracy')} -> {report['summary']['accuracy']}")
+
+    previous_results = {record["id"]: record["correct"] for record in baseline["records"]}
+    regressions = [
+        record["id"] for record in report["records"]
+        if previous_results.get(record["id"]) and not record["correct"]
+    ]
+    for case_id in regressions:
+        print(f"REGRESSION: {case_id}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the NL->SQL pipeline.")
+    parser.add_argument("benchmark", help="JSONL file of benchmark cases")
+    parser.add_argument("--base-url", default=os.getenv("OPENAI_BASE_URL"), help="OpenAI-compatible endpoint, e.g. a mock server")
+    parser.add_argument("--output", help="Where to write the JSON report")
+    parser.add_argument("--baseline", help="A previous report to compare against")
+    parser.add_argument("--cold", action="store_true", help="Start with an empty SQL cache")
+    parser.add_argument("--replay", help="Answer in-process from a recording file instead of an endpoint")
+    parser.add_argument("--record", help="Append every completion to a recording file")
+    args = parser.parse_args()
+
+    if args.replay:
+        client = ReplayClient(args.replay)
+    else:
+        client = create_openai_client(api_key=os.getenv("OPENAI_API_KEY", "benchmark"), base_url=args.base_url)
+    if args.record:
+        client = RecordingClient(client, args.record)
+    # The same rate limits, backoff, circuit breaker and instrumentation as the app, so
+    # injected errors are retried and every call is recorded in the answer's trace
+    client = InstrumentedClient(LLMClient(client))
+    datasets = {}
+    with open(args.benchmark) as file:
+        cases = [json.loads(line) for line in file if line.strip()]
+
+    if args.cold:
+        # Measure SQL generation rather than answers served from the on-disk SQL cache
+        data_extraction_openai.sql_cache = DiskCache("sql_queries", directory=tempfile.mkdtemp())
+
+    records = [run_case(case, client, datasets) for case in cases]
+    report = {"benchmark": args.benchmark, "records": records, "summary": summarize(records)}
+    print(json.dumps(report["summary"], indent=2))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2, default=str)
+    if args.baseline:
+        with open(args.baseline) as file:
+            if compare(report, json.load(file)):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
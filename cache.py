@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from telemetry import record_cache_hit
+
+CACHE_DIR = os.getenv("DOCUMENTCHAT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "documentchat"))
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def fingerprint_file(file, chunk_size=1 << 20):
+    """
+    Computes a content hash of an uploaded file without changing its read position.
+
+    Parameters:
+    - file: A binary file-like object, e.g. a Streamlit UploadedFile.
+    - chunk_size: The number of bytes hashed per read.
+
+    Returns:
+    - str: The hex SHA-256 digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    position = file.tell()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+        digest.update(chunk)
+    file.seek(position)
+    return digest.hexdigest()
+
+
+def make_key(*parts):
+    """
+    Builds a stable cache key from JSON-serializable parts.
+
+    Parameters:
+    - parts: The values identifying the cached computation.
+
+    Returns:
+    - str: The hex SHA-256 digest of the serialized parts.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    A JSON value store persisted in a SQLite file under CACHE_DIR, safe to share
+    between threads, Streamlit sessions and processes on the same disk.
+
+    Entries expire ttl seconds after they were written and the least recently used
+    entries are evicted beyond max_entries. Entries may carry a partition and an
+    embedding so near-duplicate keys can be served with nearest().
+    """
+
+    def __init__(self, name, directory=CACHE_DIR, max_entries=None, ttl=None):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{name}.sqlite")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._con.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        # Columns added after the first release of the cache file
+        columns = {row[1] for row in self._con.execute("PRAGMA table_info(entries)")}
+        for column, definition in (("accessed", "REAL"), ("partition_key", "TEXT"), ("embedding", "BLOB")):
+            if column not in columns:
+                self._con.execute(f"ALTER TABLE entries ADD COLUMN {column} {definition}")
+        self._con.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._con.execute("CREATE INDEX IF NOT EXISTS entries_partition ON entries (partition_key)")
+        self._con.commit()
+
+    def _expired_before(self):
+        return time.time() - self.ttl if self.ttl else None
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._con.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            expired_before = self._expired_before()
+            if row and expired_before is not None and row[1] < expired_before:
+                self._con.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._con.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return default
+            self._con.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._con.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def nearest(self, partition, embedding, threshold, default=None):
+        """
+        Returns the value of the entry in partition whose embedding has the highest
+        cosine similarity to embedding, if that similarity is at least threshold.
+        """
+        with self._lock:
+            query = "SELECT key, value, embedding FROM entries WHERE partition_key = ? AND embedding IS NOT NULL"
+            params = [partition]
+            expired_before = self._expired_before()
+            if expired_before is not None:
+                query += " AND created >= ?"
+                params.append(expired_before)
+            rows = self._con.execute(query, params).fetchall()
+            if not rows:
+                return default
+            matrix = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+            query_vector = np.asarray(embedding, dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vector)
+            similarities = matrix @ query_vector / np.where(norms == 0, 1, norms)
+            best = int(np.argmax(similarities))
+            if similarities[best] < threshold:
+                return default
+            self._con.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), rows[best][0]))
+            self._con.commit()
+            self.semantic_hits += 1
+        return json.loads(rows[best][1])
+
+    def set(self, key, value, partition=None, embedding=None):
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32).tobytes()
+        now = time.time()
+        with self._lock:
+            self._con.execute(
+                "INSERT OR REPLACE INTO entries (key, value, created, accessed, partition_key, embedding) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, json.dumps(value), now, now, partition, embedding),
+            )
+            self._evict()
+            self._con.commit()
+
+    def _evict(self):
+        expired_before = self._expired_before()
+        if expired_before is not None:
+            self._con.execute("DELETE FROM entries WHERE created < ?", (expired_before,))
+        if self.max_entries:
+            self._con.execute(
+                "DELETE FROM entries WHERE key IN ("
+                "SELECT key FROM entries ORDER BY COALESCE(accessed, created) DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self):
+        with self._lock:
+            entries = self._con.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"hits": self.hits, "semantic_hits": self.semantic_hits, "misses": self.misses, "entries": entries}
+
+
+def get_cache(name, **options):
+    """
+    Returns the process-wide DiskCache with the given name, opening it with options on first use.
+    """
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = DiskCache(name, **options)
+        return _caches[name]
+
+
+_missing = object()
+
+
+def cached_call(cache, key, function, *args, fallback=_missing, **kwargs):
+    """
+    Returns the cached result for key, calling function and storing its result on a miss.
+
+    Parameters:
+    - cache: The DiskCache holding the results.
+    - key: The cache key, see make_key.
+    - function: The function computing a JSON-serializable result.
+    - fallback: Returned, without being stored, when function raises; without it the
+      exception propagates. Failures are retried on the next call instead of being cached.
+
+    Returns:
+    - The cached or freshly computed result.
+    """
+    result = cache.get(key, _missing)
+    if result is _missing:
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            if fallback is _missing:
+                raise
+            print(f"{function.__name__} failed, not caching the result: {e}")
+            return fallback
+        cache.set(key, result)
+    else:
+        record_cache_hit(function.__name__)
+    return result
@@ -0,0 +1,127 @@
+import pandas as pd
+
+# Categorical columns with at most this many distinct values are used for colour
+LOW_CARDINALITY = 20
+
+
+def classify_columns(data):
+    """
+    Groups the columns of a query result by role.
+
+    Parameters:
+    - data: The dataframe to visualize.
+
+    Returns:
+    - A tuple of lists: datetime columns, numeric columns and categorical columns,
+      each ordered as in the dataframe.
+    """
+    datetime_columns, numeric_columns, categorical_columns = [], [], []
+    for column in data.columns:
+        series = data[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            datetime_columns.append(column)
+        elif pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            numeric_columns.append(column)
+        else:
+            categorical_columns.append(column)
+    return datetime_columns, numeric_columns, categorical_columns
+
+
+def color_column(data, categorical_columns, exclude=()):
+    """
+    Returns the first low-cardinality categorical column not in exclude, or None.
+    """
+    for column in categorical_columns:
+        if column not in exclude and 1 < data[column].nunique() <= LOW_CARDINALITY:
+            return column
+    return None
+
+
+def with_color(arguments, color):
+    if color is not None:
+        arguments["color"] = color
+    return arguments
+
+
+def measures_argument(measures):
+    # Plotly express accepts a list of columns for wide-form line and bar charts
+    return measures[0] if len(measures) == 1 else measures
+
+
+def build_chart_arguments(data, method):
+    """
+    Maps the dtypes and cardinalities of a query result to keyword arguments for the
+    common plotly.express chart methods, without an LLM call.
+
+    Parameters:
+    - data: The dataframe to visualize.
+    - method: The plotly.express function name, e.g. 'bar'.
+
+    Returns:
+    - dict: Keyword arguments for the chart function, or None when the method is not
+      covered or the columns do not fit it.
+    """
+    if data is None or data.empty:
+        return None
+    datetime_columns, numeric_columns, categorical_columns = classify_columns(data)
+    dimension = (datetime_columns + categorical_columns or [None])[0]
+
+    if method in ("bar", "funnel"):
+        if dimension is None or not numeric_columns:
+            return None
+        if method == "funnel":
+            return {"x": numeric_columns[0], "y": dimension}
+        arguments = {"x": dimension, "y": measures_argument(numeric_columns)}
+        if len(numeric_columns) == 1:
+            with_color(arguments, color_column(data, categorical_columns, exclude=(dimension,)))
+        return arguments
+
+    if method in ("line", "area"):
+        if datetime_columns:
+            x = datetime_columns[0]
+        elif len(numeric_columns) >= 2:
+            x = numeric_columns[0]
+        else:
+            x = dimension
+        measures = [column for column in numeric_columns if column != x]
+        if x is None or not measures:
+            return None
+        arguments = {"x": x, "y": measures_argument(measures)}
+        if len(measures) == 1:
+            with_color(arguments, color_column(data, categorical_columns, exclude=(x,)))
+        return arguments
+
+    if method == "scatter":
+        if len(numeric_columns) >= 2:
+            x, y = numeric_columns[0], numeric_columns[1]
+        elif numeric_columns and dimension is not None:
+            x, y = dimension, numeric_columns[0]
+        else:
+            return None
+        return with_color({"x": x, "y": y}, color_column(data, categorical_columns, exclude=(x, y)))
+
+    if method == "histogram":
+        if dimension is not None and numeric_columns and data[dimension].is_unique:
+            # Already aggregated: one row per category, summed by the histogram
+            return {"x": dimension, "y": numeric_columns[0]}
+        if numeric_columns:
+            return with_color({"x": numeric_columns[0]}, color_column(data, categorical_columns))
+        if dimension is not None:
+            return {"x": dimension}
+        return None
+
+    if method in ("pie", "funnel_area"):
+        if dimension is None or not numeric_columns:
+            return None
+        return {"names": dimension, "values": numeric_columns[0]}
+
+    if method in ("box", "violin", "strip"):
+        if not numeric_columns:
+            return None
+        arguments = {"y": numeric_columns[0]}
+        category = color_column(data, categorical_columns)
+        if category is not None:
+            arguments["x"] = category
+        return arguments
+
+    return None
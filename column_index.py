@@ -0,0 +1,101 @@
+import os
+import re
+import numpy as np
+from cache import CACHE_DIR
+from embeddings import EMBEDDING_MODEL, embed
+from schema_summary import format_summary
+
+INDEX_DIR = os.path.join(CACHE_DIR, "column_index")
+
+# Tables with more columns than this get only the relevant ones in the SQL prompt
+WIDE_TABLE_COLUMNS = int(os.getenv("DOCUMENTCHAT_WIDE_TABLE_COLUMNS", "50"))
+TOP_K_COLUMNS = int(os.getenv("DOCUMENTCHAT_TOP_K_COLUMNS", "25"))
+
+
+def column_text(column):
+    """
+    The text embedded for a column: its name split into words, its type and sample values.
+    """
+    words = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", column["name"]).replace("_", " ").replace("-", " ")
+    text = f"{words} ({column['type']})"
+    if column["samples"]:
+        text += ": " + ", ".join(column["samples"])
+    return text
+
+
+class ColumnIndex:
+    """
+    Column profiles of one table with an L2-normalized embedding per column, so that a
+    question's most relevant columns are found with a single matrix-vector product.
+    """
+
+    def __init__(self, table_name, row_count, columns, matrix):
+        self.table_name = table_name
+        self.row_count = row_count
+        self.columns = columns
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self._name_patterns = [
+            re.compile(rf"(?<![a-z0-9_]){re.escape(column['name'].lower())}(?![a-z0-9_])") for column in columns
+        ]
+
+    def __len__(self):
+        return len(self.columns)
+
+    def search(self, question_vector, k=TOP_K_COLUMNS):
+        """
+        Returns the positions of the k columns most similar to the question, best first.
+        """
+        scores = self.matrix @ np.asarray(question_vector, dtype=np.float32)
+        if k >= len(scores):
+            return list(np.argsort(-scores))
+        top = np.argpartition(-scores, k)[:k]
+        return list(top[np.argsort(-scores[top])])
+
+    def relevant_columns(self, question, question_vector, k=TOP_K_COLUMNS):
+        """
+        Returns the profiles of the columns named in the question plus the most similar
+        ones, up to k in total and in table order.
+        """
+        lowered = question.lower()
+        selected = [index for index, pattern in enumerate(self._name_patterns) if pattern.search(lowered)][:k]
+        for index in self.search(question_vector, k):
+            if len(selected) >= k:
+                break
+            if index not in selected:
+                selected.append(index)
+        return [self.columns[index] for index in sorted(selected)]
+
+    def describe(self, question, question_vector, k=TOP_K_COLUMNS):
+        """
+        Describes only the columns relevant to a question, in the format of describe_table.
+        """
+        columns = self.relevant_columns(question, question_vector, k)
+        text = format_summary(self.table_name, self.row_count, columns)
+        return text + f"\n(Showing the {len(columns)} of {len(self.columns)} columns most relevant to the question.)"
+
+
+def build_column_index(fingerprint, table_name, row_count, columns):
+    """
+    Builds the column index of a table, reusing the embedding matrix saved for the same
+    dataset and model.
+
+    Parameters:
+    - fingerprint: The content hash of the uploaded file.
+    - table_name: The table the profiles describe.
+    - row_count / columns: The output of schema_summary.summarize_table.
+
+    Returns:
+    - A ColumnIndex, or None when embeddings are unavailable.
+    """
+    path = os.path.join(INDEX_DIR, f"{fingerprint}-{table_name}-{re.sub(r'[^A-Za-z0-9]+', '_', EMBEDDING_MODEL)}.npy")
+    if os.path.exists(path):
+        matrix = np.load(path)
+        if len(matrix) == len(columns):
+            return ColumnIndex(table_name, row_count, columns, matrix)
+
+    matrix = embed([column_text(column) for column in columns])
+    if matrix is None:
+        return None
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    np.save(path, matrix.astype(np.float32))
+    return ColumnIndex(table_name, row_count, columns, matrix)
@@ -1,5 +1,7 @@
 import pandas as pd
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 def get_datetime_columns(metadata, client):
     """
@@ -12,6 +14,7 @@ def get_datetime_columns(metadata, client):
 
     Returns:
     - dict: A dictionary where keys are column names and values are the inferred datetime formats.
+      A failed request or unparsable response raises, so that it is not cached as a verdict.
     """
     # Extract metadata: column names and their first few non-null values    
     # OpenAI system prompt
@@ -24,153 +27,273 @@ def get_datetime_columns(metadata, client):
     )
 
     # Call the OpenAI client
-    try:
-        chat_completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Metadata: {metadata}"}
-            ],
-            response_format=
-            {
-            "type": "json_schema",
-            "json_schema": {
-                "name": "datetime_columns",
-                "schema": {
+    chat_completion = client.chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"Metadata: {metadata}"}
+        ],
+        response_format=
+        {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "datetime_columns",
+            "schema": {
+                "type": "object",
+                "properties": {
+                "columns": {
+                    "type": "array",
+                    "description": "A collection of columns  most likely to represent datetime data defined by their name and format.",
+                    "items": {
                     "type": "object",
                     "properties": {
-                    "columns": {
-                        "type": "array",
-                        "description": "A collection of columns  most likely to represent datetime data defined by their name and format.",
-                        "items": {
-                        "type": "object",
-                        "properties": {
-                            "column_name": {
-                            "type": "string",
-                            "description": "The name of the datetime column."
-                            },
-                            "datetime_format": {
-                            "type": "string",
-                            "description": "The  strftime format codes of the datetime for this column."
-                            }
+                        "column_name": {
+                        "type": "string",
+                        "description": "The name of the datetime column."
                         },
-                        "required": [
-                            "column_name",
-                            "datetime_format"
-                        ],
-                        "additionalProperties": False
+                        "datetime_format": {
+                        "type": "string",
+                        "description": "The  strftime format codes of the datetime for this column."
                         }
-                    }
                     },
                     "required": [
-                    "columns"
+                        "column_name",
+                        "datetime_format"
                     ],
                     "additionalProperties": False
-                },
-                "strict": True
+                    }
                 }
-        },
+                },
+                "required": [
+                "columns"
+                ],
+                "additionalProperties": False
+            },
+            "strict": True
+            }
+    },
+            
                 
-                    
-            temperature=0,
-            max_completion_tokens=2048,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
-        
-        result = json.loads(chat_completion.choices[0].message.content)
-        print(result)
-        
-        # Parse and return the dictionary of datetime columns with formats
-        return result["columns"]
-
-    except Exception as e:
-        print(f"Error processing the response: {e}")
-        return {}
+        temperature=0,
+        max_completion_tokens=2048,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0
+    )
+    
+    result = json.loads(chat_completion.choices[0].message.content)
+    print(result)
+    
+    # Parse and return the dictionary of datetime columns with formats
+    return result["columns"]
+
+
+# Candidate types in order of preference when success rates tie
+CANDIDATE_TYPES = ("integer", "boolean", "json_string")
+TRUTHY_FALSY_MAP = {'true': True, 'false': False, '1': True, '0': False, 'yes': True, 'no': False}
+
+
+def to_json_strings(series: pd.Series) -> pd.Series:
+    """
+    Returns the valid JSON object/array strings of a series (single quotes replaced
+    with double quotes) and None elsewhere. Values that do not start with '{' or '['
+    are rejected with a vectorized prefix check before any parsing.
+    """
+    result = pd.Series(None, index=series.index, dtype=object)
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+        return result
+    candidates = series[series.str.lstrip().str[:1].isin(["{", "["])].str.replace("'", '"', regex=False)
+
+    def validate(x):
+        try:
+            json.loads(x)  # Validate JSON structure
+            return x
+        except Exception:
+            return None
+
+    result.loc[candidates.index] = [validate(x) for x in candidates]
+    return result
+
+
+def convert_column(series: pd.Series, kind: str, datetime_format: str = None, downcast: bool = True) -> pd.Series:
+    """
+    Converts a column to the given type, with values that do not convert set to missing
+    (or False for booleans).
+
+    Parameters:
+    - series: pd.Series - The column to convert.
+    - kind: str - One of 'datetime', 'integer', 'boolean' or 'json_string'.
+    - datetime_format: str - The strftime format used for 'datetime' columns.
+    - downcast: bool - Whether integer columns are downcast to the smallest dtype.
+
+    Returns:
+    - pd.Series - The converted column.
+    """
+    if kind == "datetime":
+        return pd.to_datetime(series, errors='coerce', format=datetime_format)
+    if kind == "integer":
+        return pd.to_numeric(series, errors='coerce', downcast='integer' if downcast else None)
+    if kind == "boolean":
+        return series.str.strip().str.lower().map(TRUTHY_FALSY_MAP).fillna(False).astype(bool)
+    if kind == "json_string":
+        return to_json_strings(series)
+    raise ValueError(f"Unknown column type: {kind}")
+
+
+def success_rates(series: pd.Series) -> dict:
+    """
+    Computes the proportion of values that convert successfully for each candidate type.
+    """
+    rates = {"integer": pd.to_numeric(series, errors='coerce').notna().mean()}
+    if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+        # Already typed by the CSV reader; only the numeric conversion applies
+        rates["boolean"] = rates["json_string"] = 0
+        return rates
+    try:
+        rates["boolean"] = series.str.strip().str.lower().map(TRUTHY_FALSY_MAP).notna().mean()
+    except Exception:
+        rates["boolean"] = 0
+    try:
+        rates["json_string"] = to_json_strings(series).notna().mean()
+    except Exception:
+        rates["json_string"] = 0
+    return rates
+
+
+def run_per_column(function, columns, max_workers=None):
+    """
+    Applies function to every column on a thread pool and returns the results in order.
+    """
+    if max_workers == 1 or len(columns) <= 1:
+        return [function(column) for column in columns]
+    with ThreadPoolExecutor(max_workers=max_workers or min(8, os.cpu_count() or 1)) as executor:
+        return list(executor.map(function, columns))
+
+
+def infer_column_types(
+    df: pd.DataFrame,
+    datetime_columns: list = None,
+    threshold: float = 0.8,
+    sample_size: int = 10000,
+    max_workers: int = None,
+) -> dict:
+    """
+    Decides the most appropriate type of every column from a bounded random sample.
+
+    Parameters:
+    - df: pd.DataFrame - The input DataFrame.
+    - datetime_columns: list - Datetime columns and formats as returned by get_datetime_columns.
+    - threshold: float - The minimum proportion of valid conversions required to change a column's type.
+    - sample_size: int - The maximum number of rows inspected per column.
+    - max_workers: int - The number of columns inspected in parallel.
+
+    Returns:
+    - dict - Column name to 'datetime', 'integer', 'boolean' or 'json_string'. Columns that
+      should remain strings are omitted.
+    """
+    datetime_column_names = {item["column_name"] for item in datetime_columns or []}
+    sample = df.sample(n=sample_size, random_state=0) if len(df) > sample_size else df
+
+    def infer(column):
+        if column in datetime_column_names:
+            return "datetime"
+        rates = success_rates(sample[column])
+        best = max(CANDIDATE_TYPES, key=lambda kind: rates[kind])
+        return best if rates[best] >= threshold else None
+
+    kinds = run_per_column(infer, list(df.columns), max_workers)
+    return {column: kind for column, kind in zip(df.columns, kinds) if kind is not None}
+
+
+def apply_column_types(
+    df: pd.DataFrame,
+    column_types: dict,
+    datetime_columns: list = None,
+    downcast: bool = True,
+    max_workers: int = None,
+) -> pd.DataFrame:
+    """
+    Converts the columns of a DataFrame to types decided by infer_column_types, e.g. when
+    the same decisions are applied to every chunk of a file.
+
+    Parameters:
+    - df: pd.DataFrame - The input DataFrame.
+    - column_types: dict - Column name to type, as returned by infer_column_types.
+    - datetime_columns: list - Datetime columns and formats as returned by get_datetime_columns.
+    - downcast: bool - Whether integer columns are downcast to the smallest dtype.
+    - max_workers: int - The number of columns converted in parallel.
+
+    Returns:
+    - pd.DataFrame - The DataFrame with converted columns.
+    """
+    datetime_columns_dict = {item["column_name"]: item["datetime_format"] for item in datetime_columns or []}
+    columns = [column for column in column_types if column in df.columns]
+    converted = run_per_column(
+        lambda column: convert_column(df[column], column_types[column], datetime_columns_dict.get(column), downcast),
+        columns,
+        max_workers,
+    )
+    for column, values in zip(columns, converted):
+        df[column] = values
+    return df
 
 
 def convert_string_columns(
     df: pd.DataFrame, 
     datetime_columns: list = None,
     threshold: float = 0.8, 
+    sample_size: int = 10000,
+    max_workers: int = None,
 ) -> pd.DataFrame:
     """
     Converts string columns in a DataFrame to the most appropriate type 
     (int, float, datetime, bool, or valid JSON strings), with the ability 
     to specify columns to be directly treated as datetime.
+
+    The candidate type is decided on a sample of at most sample_size rows and only
+    the winning conversion runs on the full column, in parallel across columns.
     
     Parameters:
     - df: pd.DataFrame - The input DataFrame with all columns as strings.
     - threshold: float - The minimum proportion of valid conversions required to change a column's type.
     - datetime_columns: list - List of column names to be directly converted to datetime.
+    - sample_size: int - The maximum number of rows inspected per column when choosing its type.
+    - max_workers: int - The number of columns converted in parallel.
     
     Returns:
     - pd.DataFrame - The DataFrame with converted columns.
     """
     datetime_columns = datetime_columns or []
     print(datetime_columns)
-    for column in df.columns:
-        # Directly convert specified datetime columns
-        datetime_column_names = [item["column_name"] for item in datetime_columns]
-        datetime_columns_dict = {item["column_name"]: item["datetime_format"] for item in datetime_columns}
-        if column in datetime_column_names:
-            try:
-                df[column] = pd.to_datetime(df[column], errors='coerce', format=datetime_columns_dict[column])
-                print(f"Column {column} directly converted to datetime")
-            except Exception as e:
-                print(f"Column {column} could not be converted to datetime: {e}")
-            continue  # Skip further checks for this column
-        
-        conversion_success = {}
-        
-        # Attempt integer conversion
-        try:
-            temp = pd.to_numeric(df[column], errors='coerce', downcast='integer')
-            success_rate = temp.notna().mean()
-            conversion_success['integer'] = (success_rate, temp)
-        except Exception:
-            conversion_success['integer'] = (0, None)
-        
-        # Attempt float conversion
-        try:
-            temp = pd.to_numeric(df[column], errors='coerce', downcast='float')
-            success_rate = temp.notna().mean()
-            conversion_success['float'] = (success_rate, temp)
-        except Exception:
-            conversion_success['float'] = (0, None)
-        
-        # Attempt boolean conversion
-        try:
-            truthy_falsy_map = {'true': True, 'false': False, '1': True, '0': False, 'yes': True, 'no': False}
-            temp = df[column].str.strip().str.lower().map(truthy_falsy_map)
-            success_rate = temp.notna().mean()
-            conversion_success['boolean'] = (success_rate, temp.fillna(False).astype(bool))
-        except Exception:
-            conversion_success['boolean'] = (0, None)
-        
-        # Attempt JSON conversion (ensure valid JSON strings)
+    column_types = infer_column_types(df, datetime_columns, threshold, sample_size, max_workers)
+    datetime_columns_dict = {item["column_name"]: item["datetime_format"] for item in datetime_columns}
+
+    def convert(column):
+        kind = column_types.get(column)
+        if kind is None:
+            return None
         try:
-            def to_json_string(x):
-                try:
-                    x = x.replace("'", '"')  # Replace single quotes with double quotes
-                    json.loads(x)  # Validate JSON structure
-                    return x  # Return as a valid JSON string
-                except Exception:
-                    return None  # If invalid JSON, return None
-            
-            temp = df[column].apply(lambda x: to_json_string(x) if pd.notna(x) else None)
-            success_rate = temp.notna().mean()
-            conversion_success['json_string'] = (success_rate, temp)
-        except Exception:
-            conversion_success['json_string'] = (0, None)
-        
-        # Identify the best conversion based on the threshold
-        best_conversion = max(conversion_success.items(), key=lambda x: x[1][0])
-        if best_conversion[1][0] >= threshold:  # If success rate meets the threshold
-            df[column] = best_conversion[1][1]
-            print(f"Column {column} converted to {best_conversion[0]}")
+            if kind == "boolean":
+                mapped = df[column].str.strip().str.lower().map(TRUTHY_FALSY_MAP)
+                success_rate = mapped.notna().mean()
+                values = mapped.fillna(False).astype(bool)
+            else:
+                values = convert_column(df[column], kind, datetime_columns_dict.get(column))
+                success_rate = values.notna().mean()
+        except Exception as e:
+            print(f"Column {column} could not be converted to {kind}: {e}")
+            return None
+        # The sample chose the type; the full column must still meet the threshold
+        if kind != "datetime" and success_rate < threshold:
+            return None
+        return values
+
+    converted = run_per_column(convert, list(df.columns), max_workers)
+    for column, values in zip(list(df.columns), converted):
+        if values is not None:
+            df[column] = values
+            print(f"Column {column} converted to {column_types[column]}")
         else:
             print(f"Column {column} could not be reliably converted and remains as string")
-    
+
     return df
@@ -1,9 +1,49 @@
 import openai
+import os
 import re
 import json
+from cache import get_cache, make_key
+from telemetry import record_cache_hit, retrying
+from llm_client import LLMUnavailableError
+from embeddings import embed
+from schema_summary import metadata_context
+from column_index import WIDE_TABLE_COLUMNS
+from sql_validation import validate_sql
+from query_results import fetch_result
+from rollups import route_to_rollup
+from sampling import approximate_query, attach_error_bounds
 
-def create_metadata(df):
-    return df.head().to_string()
+# Minimum cosine similarity for serving a near-duplicate question from the SQL cache;
+# the semantic lookup is disabled unless this is set
+SEMANTIC_CACHE_THRESHOLD = os.getenv("DOCUMENTCHAT_SEMANTIC_CACHE_THRESHOLD")
+
+# Attempts at generating SQL that executes, each seeing the errors of the previous ones
+MAX_SQL_ATTEMPTS = 3
+
+sql_cache = get_cache("sql_queries", max_entries=10000, ttl=30 * 24 * 3600)
+
+
+def normalize_question(text: str) -> str:
+    """
+    Normalizes a question for cache lookups by lowercasing, collapsing whitespace
+    and dropping trailing punctuation.
+    """
+    return re.sub(r"\s+", " ", text).strip().lower().rstrip("?.! ")
+
+def schema_fingerprint(connectdf, table_names):
+    """
+    Hashes the column names and types of the given tables as seen by the connection.
+    """
+    return make_key([[table, connectdf.execute(f"DESCRIBE {table}").fetchall()] for table in table_names])
+
+def question_embedding(question):
+    """
+    Embeds a normalized question for the semantic SQL cache, or returns None when disabled.
+    """
+    if not SEMANTIC_CACHE_THRESHOLD:
+        return None
+    vectors = embed([question])
+    return None if vectors is None else vectors[0]
 
 def clean_query(text: str) -> str:
     """
@@ -15,9 +55,25 @@ def clean_query(text: str) -> str:
     clean_text = re.sub(r"```", "", clean_text.strip())
     return clean_text.strip()
 
+def run_query(connectdf, sql_query, session_state, method):
+    """
+    Runs a validated query, on a precomputed rollup when one answers it exactly or, in
+    approximate mode, on the sample or with sketches, keeping the query as written in the
+    result's attrs.
+    """
+    routed = route_to_rollup(connectdf, sql_query, getattr(session_state, "rollups", None))
+    approximation = None
+    if routed == sql_query and getattr(session_state, "approximate", False):
+        routed, approximation = approximate_query(connectdf, sql_query, getattr(session_state, "sample", None))
+    result = fetch_result(connectdf, routed, method)
+    if approximation is not None:
+        attach_error_bounds(result, approximation)
+    result.attrs["sql"] = sql_query
+    return result
+
 def get_data(viz, user_input, session_state, forecasting, client, connectdf):
     """
-    Generates and executes an SQL query for a data visualization with up to three retries.
+    Generates and executes an SQL query for a data visualization in up to MAX_SQL_ATTEMPTS attempts.
 
     Parameters:
     - viz: The type of visualization requested.
@@ -28,16 +84,19 @@ def get_data(viz, user_input, session_state, forecasting, client, connectdf):
     - forecasting: A boolean indicating if forecasting-related data is included.
 
     Returns:
-    - A DataFrame containing the query result.
+    - A DataFrame containing the query result, at most MAX_RESULT_ROWS rows; see
+      query_results.fetch_result for the attrs describing the full result.
     """
-    # Create metadata based on the forecasting flag
+    # The dataset descriptions are computed once per upload, see schema_summary; wide
+    # tables are described by the columns relevant to the question only
+    main_metadata = None
+    column_index = getattr(session_state, "column_index", None)
+    if column_index is not None and len(column_index) > WIDE_TABLE_COLUMNS:
+        vectors = embed([user_input])
+        if vectors is not None:
+            main_metadata = column_index.describe(user_input, vectors[0])
+    retrieved_context = metadata_context(session_state, forecasting, main_metadata)
     if forecasting:
-        metadata_df = create_metadata(session_state.df)
-        metadata_forecast_df = create_metadata(session_state.forecast_df)
-        retrieved_context = (
-            f"Main DataFrame Metadata:\n{metadata_df}\n\n"
-            f"Forecast DataFrame Metadata:\n{metadata_forecast_df}"
-        )
         table_names = "Table Names: 'dataframe' (main dataset), 'forecast_dataframe' (forecasted data)"
         system_prompt = (
             "Given the prompt, the metadata of two dataframes below, and the form of a data visualization, "
@@ -47,8 +106,6 @@ def get_data(viz, user_input, session_state, forecasting, client, connectdf):
             "Please ensure the query is executable and returns the desired output for visualization."
         )
     else:
-        metadata_df = create_metadata(session_state.df)
-        retrieved_context = f"Main DataFrame Metadata:\n{metadata_df}"
         table_names = "Table Name: 'dataframe'"
         system_prompt = (
             "Given the prompt, the metadata of a dataframe below, and the form of a data visualization, "
@@ -57,11 +114,33 @@ def get_data(viz, user_input, session_state, forecasting, client, connectdf):
             "Please ensure the query is executable and returns the desired output for visualization."
         )
 
+    # Serve previously validated SQL for the same schema, question, chart and forecasting flag
+    question = normalize_question(user_input)
+    table_list = ["dataframe", "forecast_dataframe"] if forecasting else ["dataframe"]
+    # Numbers in the question are part of the partition so "2023" never serves "2024"
+    partition = make_key(
+        schema_fingerprint(connectdf, table_list), viz.Method if viz else None, forecasting,
+        re.findall(r"\d+(?:\.\d+)?", question)
+    )
+    cache_key = make_key(partition, question)
+    embedding = question_embedding(question)
+    cached_query = sql_cache.get(cache_key)
+    if cached_query is None and embedding is not None:
+        cached_query = sql_cache.nearest(partition, embedding, float(SEMANTIC_CACHE_THRESHOLD))
+    if cached_query is not None:
+        try:
+            print(f"Cached Query:\n{cached_query}")
+            result = run_query(connectdf, validate_sql(connectdf, cached_query, table_list), session_state, viz.Method if viz else None)
+            record_cache_hit("get_data")
+            return result
+        except Exception as e:
+            print(f"Cached query failed: {str(e)}")
+
     attempt_count = 0
     previous_responses = []
     previous_errors = []
 
-    while attempt_count < 5:
+    while attempt_count < MAX_SQL_ATTEMPTS:
         attempt_count += 1
         try:
             # Initial message setup
@@ -99,42 +178,52 @@ def get_data(viz, user_input, session_state, forecasting, client, connectdf):
             print(f"ATTEMPT {attempt_count}")
 
             # Generate SQL query using GPT-4
-            chat_completion = client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                temperature=0,
-                response_format={
-                    "type": "json_schema",
-                    "json_schema": {
-                        "name": "sql_query_schema",
-                        "schema": {
-                            "type": "object",
-                            "properties": {
-                            "query": {
-                                "type": "string",
-                                "description": "The SQL query string used to retrieve or manipulate data."
-                            }
+            with retrying(attempt_count > 1):
+                chat_completion = client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                    temperature=0,
+                    response_format={
+                        "type": "json_schema",
+                        "json_schema": {
+                            "name": "sql_query_schema",
+                            "schema": {
+                                "type": "object",
+                                "properties": {
+                                "query": {
+                                    "type": "string",
+                                    "description": "The SQL query string used to retrieve or manipulate data."
+                                }
+                                },
+                                "required": [
+                                "query"
+                                ],
+                                "additionalProperties": False
                             },
-                            "required": [
-                            "query"
-                            ],
-                            "additionalProperties": False
-                        },
-                        "strict": True
-                        }
-                                        },
-            )
+                            "strict": True
+                            }
+                                            },
+                )
             sql_query = clean_query(json.loads(chat_completion.choices[0].message.content)["query"])
             print(f"Generated Query (Attempt {attempt_count}):\n{sql_query}")
             previous_responses.append(sql_query)
 
-            # Execute the query
-            return connectdf.execute(sql_query).fetchdf()
+            # Bind the query with EXPLAIN and repair trivial problems locally, so only
+            # precise binder errors go back to the LLM and no bad query scans the data
+            sql_query = validate_sql(connectdf, sql_query, table_list)
+
+            # Execute the query with a bounded result, on a rollup when one matches, and remember it once it has run successfully
+            result = run_query(connectdf, sql_query, session_state, viz.Method if viz else None)
+            sql_cache.set(cache_key, sql_query, partition, embedding)
+            return result
 
+        except LLMUnavailableError:
+            # Transient API errors were already retried with backoff by the client
+            raise
         except Exception as e:
             print(f"Error (Attempt {attempt_count}): {str(e)}")
             previous_errors.append(str(e))
 
-            if attempt_count == 3:
+            if attempt_count == MAX_SQL_ATTEMPTS:
                 print("Maximum retries reached.")
                 raise Exception(f"Final Exception: {str(e)}")
\ No newline at end of file
@@ -1,7 +1,19 @@
 from models import ForecastFlag, ForecastRequestFlag
+from statistical_forecast import statistical_forecasting, forecast_methods
+from rollups import MEASURE_TYPES, has_type
+from sql_validation import quote_identifier
+from telemetry import retrying
 import json
+import os
 import pandas as pd
 
+# Forecasting backends selectable from the app; the LLM backend is opt-in
+forecast_backends = {**forecast_methods, "llm": "GPT-4o (remote)"}
+# Most recent rows of a DuckDB table read as forecasting history
+FORECAST_HISTORY_ROWS = int(os.getenv("DOCUMENTCHAT_FORECAST_HISTORY_ROWS", "5000"))
+# Requests per batch; later ones only ask for the timestamps still missing
+MAX_BATCH_ATTEMPTS = 2
+
 def is_forecast_request(prompt, client):
     """
     Determines if the provided prompt is asking for a forecast.
@@ -105,11 +117,8 @@ def potential_timeseries_forecasting(metadata, client):
         frequency_penalty=0,
         presence_penalty=0
     )
-    try:
-        print(chat_completion.choices[0].message.content)
-        return ForecastFlag.model_validate_json(chat_completion.choices[0].message.content).forecasting_possible
-    except Exception as e:
-        return False
+    print(chat_completion.choices[0].message.content)
+    return ForecastFlag.model_validate_json(chat_completion.choices[0].message.content).forecasting_possible
 
 
 def identify_timeseries_datetime_column(metadata, client):
@@ -121,7 +130,8 @@ def identify_timeseries_datetime_column(metadata, client):
         client: The OpenAI client instance.
 
     Returns:
-        str: The name of the datetime column if identified, otherwise None.
+        str: The name of the datetime column if identified, otherwise None. A response
+        that cannot be parsed raises, so that it is not cached as a verdict.
     """
     # Extract the head of the dataframe to send as context
     system_prompt = (
@@ -165,16 +175,12 @@ def identify_timeseries_datetime_column(metadata, client):
         presence_penalty=0
     )
 
-    try:
-        # Parse the response
-        response_content = chat_completion.choices[0].message.content
-        response_json = json.loads(response_content)
+    # Parse the response
+    response_content = chat_completion.choices[0].message.content
+    response_json = json.loads(response_content)
 
-        # Return the identified column or None
-        return response_json.get("datetime_column")
-    except Exception as e:
-        print(f"Error processing the response: {e}")
-        return None
+    # Return the identified column or None
+    return response_json.get("datetime_column")
 
 
 def iterative_forecasting(df, datetime_column, client):
@@ -226,6 +232,216 @@ def iterative_forecasting(df, datetime_column, client):
     return forecast_df
 
 
+def run_forecasting(df, datetime_column, client, backend="exponential_smoothing"):
+    """
+    Fills the forecast DataFrame with the selected forecasting backend.
+
+    Parameters:
+        df (pd.DataFrame): The input DataFrame containing the time series data.
+        datetime_column (str): The name of the datetime column.
+        client: The OpenAI client instance, only used by the llm backend.
+        backend (str): One of the keys of forecast_backends.
+
+    Returns:
+        pd.DataFrame: A DataFrame containing the forecasted results for each step.
+    """
+    if backend == "llm":
+        return batched_forecasting(df, datetime_column, client)
+    return statistical_forecasting(df, datetime_column, method=backend)
+
+
+def load_forecast_history(con, datetime_column, columns, table_name="dataframe", max_rows=FORECAST_HISTORY_ROWS):
+    """
+    Reads the history to forecast from a DuckDB table without pulling the whole table
+    into pandas: only the datetime column and the numeric columns, of the most recent
+    max_rows rows.
+
+    Parameters:
+        con: The DuckDB connection holding the table.
+        datetime_column (str): The name of the datetime column.
+        columns (list): The column profiles from schema_summary.summarize_table.
+        table_name (str): The table to read.
+        max_rows (int): The number of most recent rows read.
+
+    Returns:
+        pd.DataFrame: The history, oldest first.
+    """
+    measures = [
+        column["name"] for column in columns
+        if column["name"] != datetime_column and has_type(column, MEASURE_TYPES)
+    ]
+    datetime_name = quote_identifier(datetime_column)
+    selected = ", ".join([datetime_name] + [quote_identifier(name) for name in measures])
+    return con.execute(
+        f"SELECT * FROM (SELECT {selected} FROM {quote_identifier(table_name)} "
+        f"ORDER BY {datetime_name} DESC LIMIT ?) ORDER BY {datetime_name}",
+        [max_rows]
+    ).df()
+
+
+def batched_forecasting(df, datetime_column, client, batch_size=24, context_window=48):
+    """
+    Forecasts the same target timestamps as iterative_forecasting, but requests many
+    timestamps per chat completion and only sends a bounded window of history.
+
+    Parameters:
+        df (pd.DataFrame): The input DataFrame containing the time series data.
+        datetime_column (str): The name of the datetime column.
+        client: The OpenAI client instance.
+        batch_size (int): The number of target timestamps forecast per request.
+        context_window (int): The number of rows preceding a batch sent as context.
+
+    Returns:
+        pd.DataFrame: A DataFrame containing the forecasted results for each step.
+    """
+    # Ensure the DataFrame is sorted by the datetime column
+    df[datetime_column] = pd.to_datetime(df[datetime_column])
+    df.sort_values(by=datetime_column, inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    time_diff = df[datetime_column].iloc[-1] - df[datetime_column].iloc[-2]
+
+    # Target i is forecast from rows before it, the final target is one step past the data
+    targets = list(df[datetime_column].iloc[2:]) + [df[datetime_column].iloc[-1] + time_diff]
+
+    rows = []
+    for batch_start in range(0, len(targets), batch_size):
+        batch = targets[batch_start:batch_start + batch_size]
+        # Rows strictly before the first target of the batch
+        context_end = batch_start + 2
+        context = df.iloc[max(0, context_end - context_window):context_end]
+        forecasts = {}
+        for attempt in range(MAX_BATCH_ATTEMPTS):
+            missing = [timestamp for timestamp in batch if forecast_key(timestamp) not in forecasts]
+            if not missing:
+                break
+            try:
+                with retrying(attempt > 0):
+                    forecasts.update(get_batch_forecast(context, missing, datetime_column, client))
+            except Exception as e:
+                print(f"Error during forecasting for timestamps {missing[0]} to {missing[-1]}: {e}")
+        # Forecasts are matched to the targets by their forecast_time, never by position
+        for target_timestamp in batch:
+            forecast = forecasts.get(forecast_key(target_timestamp))
+            if forecast is None:
+                print(f"No forecast returned for timestamp {target_timestamp}")
+                continue
+            # Repeated timestamps share one returned forecast, so each row gets its own copy
+            rows.append(dict(forecast, forecast_time=target_timestamp))
+
+    if not rows:
+        # Nothing came back; keep the columns callers select from
+        columns = [column for column in df.columns if column != datetime_column]
+        return pd.DataFrame(columns=columns + ["forecast_time"])
+    return pd.DataFrame(rows)
+
+
+def forecast_key(timestamp):
+    """
+    Normalizes a target or returned forecast timestamp for matching, or returns None.
+    """
+    timestamp = pd.to_datetime(timestamp, errors="coerce")
+    if pd.isna(timestamp):
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp
+
+
+def get_batch_forecast(df, timestamps, datetime_column, client):
+    """
+    Requests forecasts for several timestamps in a single chat completion.
+
+    Parameters:
+        df (pd.DataFrame): The history used as context for the forecast.
+        timestamps (list): The target timestamps, in order.
+        datetime_column (str): The name of the datetime column.
+        client: The OpenAI client instance.
+
+    Returns:
+        dict: One dictionary of column name to forecast value per returned timestamp,
+        keyed by its forecast_key. Timestamps that were not requested are dropped.
+    """
+    target_list = ", ".join(str(timestamp) for timestamp in timestamps)
+    response = client.chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    f"Given the dataframe please provide the forecast for each of the following timestamps: {target_list}. "
+                    "Return exactly one forecast per timestamp, in the same order, in the format provided. "
+                    f"Use forecast_time for the forecast timestamp and drop {datetime_column}"
+                )
+            },
+            {
+                "role": "user",
+                "content": df.to_json(orient="records", date_format="iso")
+            },
+        ],
+        response_format={
+            "type": "json_schema",
+            "json_schema": {
+                "name": "dataframe_forecasts",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "forecasts": {
+                            "type": "array",
+                            "description": "One forecast per requested timestamp, in the requested order.",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "forecast_time": {
+                                        "type": "string",
+                                        "description": "The timestamp this forecast is for."
+                                    },
+                                    "data": {
+                                        "type": "array",
+                                        "description": "An array of objects representing the columns of the forecast row.",
+                                        "items": {
+                                            "type": "object",
+                                            "properties": {
+                                                "column_name": {
+                                                    "type": "string",
+                                                    "description": "The name of the column."
+                                                },
+                                                "value": {
+                                                    "type": "string",
+                                                    "description": "The value corresponding to the column name."
+                                                }
+                                            },
+                                            "required": ["column_name", "value"],
+                                            "additionalProperties": False
+                                        }
+                                    }
+                                },
+                                "required": ["forecast_time", "data"],
+                                "additionalProperties": False
+                            }
+                        }
+                    },
+                    "required": ["forecasts"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        temperature=1,
+        max_completion_tokens=16384,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0
+    )
+    data = json.loads(response.choices[0].message.content)
+    requested = {forecast_key(timestamp) for timestamp in timestamps}
+    forecasts = {}
+    for forecast in data["forecasts"]:
+        key = forecast_key(forecast["forecast_time"])
+        if key in requested:
+            forecasts[key] = {item["column_name"]: item["value"] for item in forecast["data"]}
+    return forecasts
+
+
 def get_forecast(df, timestamp,datetime_column, client):
     response = client.chat.completions.create(
     model="gpt-4o",
@@ -4,10 +4,14 @@ from bs4 import BeautifulSoup
 import plotly.express as px
 import math
 import json
+from plotly_docs import get_documentation
+from chart_arguments import build_chart_arguments
+from telemetry import retrying
 
 def fetch_documentation(plot_type):
     """
-    Fetches the documentation for a given plot type from Plotly's Python API reference.
+    Fetches the documentation for a given plot type from the local documentation store,
+    falling back to Plotly's Python API reference for methods that are not stored.
 
     Parameters:
     - plot_type: The type of plot for which to fetch documentation.
@@ -15,6 +19,15 @@ def fetch_documentation(plot_type):
     Returns:
     - A tuple containing the documentation text and the blockquote text.
     """
+    # Serve the documentation built from the installed plotly's docstrings
+    try:
+        stored = get_documentation(plot_type)
+    except Exception as e:
+        print(f"Documentation store unavailable: {e}")
+        stored = None
+    if stored is not None:
+        return stored
+
     # URL of the page to scrape
     url = f'https://plotly.com/python-api-reference/generated/plotly.express.{plot_type}.html'
 
@@ -99,6 +112,17 @@ def get_data_visualisation(data, viz, client, st):
     Returns:
     - A Plotly visualization.
     """
+    # Common chart types are built from the result's dtypes; the LLM handles the rest
+    arguments = build_chart_arguments(data, viz.Method)
+    if arguments is not None:
+        try:
+            plot_data = data
+            if viz.Method in ("line", "area"):
+                plot_data = data.sort_values(arguments["x"])
+            return getattr(px, viz.Method)(plot_data, **arguments)
+        except Exception as e:
+            print(f"Rule-based chart arguments {arguments} failed: {e}")
+
     documentation, _ = fetch_documentation(viz.Method)
 
     system_prompt = (
@@ -119,7 +143,12 @@ def get_data_visualisation(data, viz, client, st):
 
     token_limit = get_token_count(system_prompt + user_message)
     if token_limit > 6000:
-        documentation = trim_documentation(documentation, client)
+        # Prefer the pre-trimmed stored variant over a summarisation round trip
+        try:
+            trimmed = get_documentation(viz.Method, trimmed=True)
+        except Exception:
+            trimmed = None
+        documentation = trimmed[0] if trimmed is not None else trim_documentation(documentation, client)
         user_message = (
             f"DataFrame Top 20 Rows: {data.head(20).to_string()}, "
             f"Data Description: {data.describe().to_string()}, "
@@ -155,13 +184,14 @@ def get_data_visualisation(data, viz, client, st):
         messages.append({"role": "assistant", "content": chat_completion.choices[0].message.content})
         messages.append({"role": "user", "content": error_message})
 
-        chat_completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            response_format={
-                "type": "json_object"
-            },
-            temperature=0
-        )
+        with retrying():
+            chat_completion = client.chat.completions.create(
+                model="gpt-4o",
+                messages=messages,
+                response_format={
+                    "type": "json_object"
+                },
+                temperature=0
+            )
 
         return getattr(px, viz.Method, None)(data, **json.loads(chat_completion.choices[0].message.content))
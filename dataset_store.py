@@ -0,0 +1,374 @@
+"""
+A process-wide registry of uploaded datasets, keyed by content hash and backed by one
+persistent DuckDB database file. Each dataset lives in its own schema and is loaded (and
+type-inferred) once, however many sessions open it; sessions query it through read-only
+cursors, and datasets no session holds are dropped least recently used first.
+
+Several processes can share a prepared store by opening it read-only with
+DOCUMENTCHAT_STORE_READ_ONLY=1; uploads that are not in it then fall back to the
+per-session connection.
+"""
+import json
+import os
+import re
+import threading
+import time
+import weakref
+import duckdb
+from ingestion import DATA_DIR, MATERIALIZE_AFTER_QUERIES, materialize_table, remove_spooled_uploads
+
+STORE_PATH = os.getenv("DOCUMENTCHAT_STORE_PATH", os.path.join(DATA_DIR, "datasets.duckdb"))
+SHARED_STORE = os.getenv("DOCUMENTCHAT_SHARED_STORE", "1") != "0"
+STORE_READ_ONLY = os.getenv("DOCUMENTCHAT_STORE_READ_ONLY", "0") == "1"
+# Datasets kept on disk while no session has them open
+MAX_IDLE_DATASETS = int(os.getenv("DOCUMENTCHAT_MAX_IDLE_DATASETS", "8"))
+
+READ_STATEMENTS = {duckdb.StatementType.SELECT, duckdb.StatementType.EXPLAIN}
+# Schemas every dataset may read besides its own
+SYSTEM_SCHEMAS = {"information_schema", "pg_catalog"}
+# Table functions that read neither files nor SQL strings; any other (read_csv,
+# parquet_scan, glob, query, ...) could reach data outside the dataset
+SAFE_TABLE_FUNCTIONS = {
+    "range", "generate_series", "unnest", "json_each", "json_tree",
+    "duckdb_tables", "duckdb_views", "duckdb_columns", "duckdb_functions", "duckdb_types", "pragma_table_info",
+}
+
+
+class ReadOnlyError(Exception):
+    """
+    Raised when a statement that could modify the store, or that reads another dataset,
+    is run on a read-only cursor.
+    """
+
+
+def check_read_only(con, sql):
+    """
+    Raises ReadOnlyError unless every statement in sql only reads data.
+    """
+    for statement in con.extract_statements(sql):
+        if statement.type not in READ_STATEMENTS:
+            raise ReadOnlyError(f"Only SELECT queries are allowed, got {statement.type.name}")
+        if statement.type == duckdb.StatementType.EXPLAIN:
+            check_read_only(con, explained_query(statement))
+
+
+def explained_query(statement):
+    # EXPLAIN ANALYZE runs the statement it explains
+    if statement.type != duckdb.StatementType.EXPLAIN:
+        return statement.query
+    return re.sub(r"^\s*EXPLAIN\s+(?:ANALY[SZ]E\s+)?", "", statement.query, flags=re.IGNORECASE)
+
+
+def referenced_tables(node, found, ctes):
+    """
+    Collects the table references and table function calls of a serialized query, and
+    the names of its common table expressions.
+    """
+    if isinstance(node, list):
+        for item in node:
+            referenced_tables(item, found, ctes)
+    elif isinstance(node, dict):
+        if node.get("type") in ("BASE_TABLE", "TABLE_FUNCTION"):
+            found.append(node)
+        if isinstance(node.get("cte_map"), dict):
+            ctes.update(item["key"].lower() for item in node["cte_map"]["map"])
+        for item in node.values():
+            referenced_tables(item, found, ctes)
+    return found
+
+
+def known_tables(con, schema):
+    """
+    The tables and views of the dataset's schema and the views registered on the cursor.
+    """
+    return {row[0].lower() for row in con.execute(
+        "SELECT table_name FROM duckdb_tables() WHERE database_name = current_database() AND schema_name = ? "
+        "UNION ALL SELECT view_name FROM duckdb_views() "
+        "WHERE (database_name = current_database() AND schema_name = ?) OR temporary",
+        [schema, schema]
+    ).fetchall()}
+
+
+def check_schema(con, sql, schema):
+    """
+    Raises ReadOnlyError if sql reads anything but the dataset: a table outside its
+    schema, a file (read_csv(...), FROM 'file.parquet') or a name that is not one of its
+    tables, which DuckDB would otherwise resolve with a replacement scan.
+    """
+    known = None
+    for statement in con.extract_statements(sql):
+        result = json.loads(con.execute("SELECT json_serialize_sql(?)", [explained_query(statement)]).fetchone()[0])
+        if result.get("error"):
+            raise ReadOnlyError(f"Cannot check the tables the query reads: {result.get('error_message')}")
+        ctes = set()
+        for table in referenced_tables(result["statements"], [], ctes):
+            if table["type"] == "TABLE_FUNCTION":
+                name = table["function"].get("function_name", "").lower()
+                if name not in SAFE_TABLE_FUNCTIONS:
+                    raise ReadOnlyError(f"The table function {name} is not allowed")
+                continue
+            name = table["table_name"]
+            table_schema = table["schema_name"].lower()
+            if table["catalog_name"] or table_schema not in {"", schema.lower()} | SYSTEM_SCHEMAS:
+                qualified = ".".join(part for part in (table["catalog_name"], table["schema_name"], name) if part)
+                raise ReadOnlyError(f"Only the tables of this dataset can be queried, got {qualified}")
+            if table_schema in SYSTEM_SCHEMAS or (not table_schema and name.lower() in ctes):
+                continue
+            if known is None:
+                known = known_tables(con, schema)
+            if "/" in name or "." in name or name.lower() not in known:
+                raise ReadOnlyError(f"Only the tables of this dataset can be queried, got {name}")
+
+
+class ReadOnlyCursor:
+    """
+    A session's cursor on one dataset's schema. Unqualified table names resolve to the
+    dataset; statements that write or read other datasets' schemas are rejected.
+    register() stays available, as the views it creates (e.g. forecast_dataframe) are
+    private to the cursor.
+    """
+
+    def __init__(self, cursor, schema):
+        self._cursor = cursor
+        self._schema = schema
+
+    def execute(self, sql, parameters=None):
+        check_read_only(self._cursor, sql)
+        check_schema(self._cursor, sql, self._schema)
+        if parameters is None:
+            self._cursor.execute(sql)
+        else:
+            self._cursor.execute(sql, parameters)
+        return self
+
+    def register(self, name, data):
+        self._cursor.register(name, data)
+        return self
+
+    def unregister(self, name):
+        self._cursor.unregister(name)
+        return self
+
+    def table(self, name):
+        check_schema(self._cursor, f"SELECT * FROM {name}", self._schema)
+        return self._cursor.table(name)
+
+    def extract_statements(self, sql):
+        return self._cursor.extract_statements(sql)
+
+    def close(self):
+        self._cursor.close()
+
+    def __getattr__(self, name):
+        # Result fetching only; everything else could bypass the statement check
+        if name.startswith("fetch") or name in ("df", "arrow", "description"):
+            return getattr(self._cursor, name)
+        raise AttributeError(f"{name} is not available on a read-only cursor")
+
+
+class DatasetHandle:
+    """
+    A session's reference to a stored dataset. The reference is released by close() or,
+    at the latest, when the handle is garbage collected with its session.
+    """
+
+    def __init__(self, store, fingerprint, cursor):
+        self.fingerprint = fingerprint
+        self.cursor = cursor
+        self._finalizer = weakref.finalize(self, store.release, fingerprint, cursor)
+
+    def close(self):
+        self._finalizer()
+
+
+class DatasetStore:
+    """
+    The persistent DuckDB database holding one schema per dataset.
+
+    Parameters:
+    - path: The database file.
+    - read_only: Whether to open it read-only, e.g. when several processes share it.
+    - max_idle: How many datasets that no session holds are kept.
+    """
+
+    def __init__(self, path=STORE_PATH, read_only=STORE_READ_ONLY, max_idle=MAX_IDLE_DATASETS):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.read_only = read_only
+        self.max_idle = max_idle
+        self.con = duckdb.connect(path, read_only=read_only)
+        self._lock = threading.Lock()
+        # Per schema; held while a dataset is loaded, written to or dropped
+        self._load_locks = {}
+        self._refcounts = {}
+        self._query_counts = {}
+        # Datasets stored by earlier runs are the first candidates for eviction
+        self._last_used = {
+            row[0]: 0.0 for row in self.con.execute(
+                "SELECT schema_name FROM information_schema.schemata WHERE schema_name LIKE 'ds\\_%' ESCAPE '\\'"
+            ).fetchall()
+        }
+
+    @staticmethod
+    def schema(fingerprint):
+        return f"ds_{fingerprint[:32]}"
+
+    def contains(self, fingerprint):
+        cursor = self.con.cursor()
+        try:
+            return bool(cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = ? AND table_name = 'dataframe'",
+                [self.schema(fingerprint)],
+            ).fetchone()[0])
+        finally:
+            cursor.close()
+
+    def can_open(self, fingerprint):
+        return not self.read_only or self.contains(fingerprint)
+
+    def open(self, fingerprint, loader):
+        """
+        Opens a dataset for a session, loading it first if it is not stored yet.
+        Concurrent opens of the same dataset wait for a single load.
+
+        Parameters:
+        - fingerprint: The content hash of the upload.
+        - loader: Called with a writable cursor whose default schema is the dataset's;
+          it must create the 'dataframe' table or view.
+
+        Returns:
+        - A DatasetHandle with a read-only cursor on the dataset.
+        """
+        schema = self.schema(fingerprint)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(schema, threading.Lock())
+            # Counted before loading, so the dataset cannot be evicted in the meantime
+            self._refcounts[schema] = self._refcounts.get(schema, 0) + 1
+            self._last_used[schema] = time.time()
+        try:
+            with load_lock:
+                if not self.contains(fingerprint):
+                    if self.read_only:
+                        raise ReadOnlyError(f"Dataset {fingerprint} is not in the read-only store")
+                    self._load(schema, loader)
+            cursor = self.con.cursor()
+            cursor.execute(f"USE {schema}")
+        except Exception:
+            self.release(fingerprint)
+            raise
+        self._evict()
+        return DatasetHandle(self, fingerprint, ReadOnlyCursor(cursor, schema))
+
+    def _load(self, schema, loader):
+        cursor = self.con.cursor()
+        try:
+            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+            cursor.execute(f"USE {schema}")
+            loader(cursor)
+        except Exception:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+            raise
+        finally:
+            cursor.close()
+
+    def release(self, fingerprint, cursor=None):
+        """
+        Drops a session's reference to a dataset.
+        """
+        if cursor is not None:
+            cursor.close()
+        schema = self.schema(fingerprint)
+        with self._lock:
+            self._refcounts[schema] = max(0, self._refcounts.get(schema, 0) - 1)
+            self._last_used[schema] = time.time()
+        self._evict()
+
+    def record_query(self, fingerprint):
+        """
+        Counts a question answered from a dataset, across sessions, and materializes
+        datasets that are views (Parquet, JSON Lines) once they are queried often.
+        """
+        schema = self.schema(fingerprint)
+        with self._lock:
+            count = self._query_counts[schema] = self._query_counts.get(schema, 0) + 1
+        if count == MATERIALIZE_AFTER_QUERIES:
+            self.write(fingerprint, materialize_table)
+
+    def write(self, fingerprint, function):
+        """
+        Runs function with a writable cursor on a stored dataset, e.g. to build tables
+        derived from it, one session at a time. Does nothing on a read-only store.
+
+        Returns:
+        - What function returns, or None on a read-only store.
+        """
+        if self.read_only:
+            return None
+        with self._lock:
+            load_lock = self._load_locks.setdefault(self.schema(fingerprint), threading.Lock())
+        with load_lock:
+            cursor = self.con.cursor()
+            try:
+                cursor.execute(f"USE {self.schema(fingerprint)}")
+                return function(cursor)
+            finally:
+                cursor.close()
+
+    def _evict(self):
+        if self.read_only:
+            return
+        with self._lock:
+            idle = sorted(
+                (schema for schema in self._last_used if not self._refcounts.get(schema)),
+                key=self._last_used.get,
+            )
+            candidates = idle[:max(0, len(idle) - self.max_idle)]
+        for schema in candidates:
+            with self._lock:
+                load_lock = self._load_locks.setdefault(schema, threading.Lock())
+            # An open() of the same dataset either counted its reference before this check,
+            # or waits for the drop and loads the dataset again
+            with load_lock:
+                with self._lock:
+                    if schema not in self._last_used or self._refcounts.get(schema):
+                        continue
+                    self._last_used.pop(schema, None)
+                    self._refcounts.pop(schema, None)
+                    self._query_counts.pop(schema, None)
+                print(f"Evicting dataset {schema} from the store")
+                cursor = self.con.cursor()
+                try:
+                    cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+                finally:
+                    cursor.close()
+                # Parquet and JSON Lines datasets are views over their spooled upload
+                remove_spooled_uploads(schema[len("ds_"):])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "datasets": len(self._last_used),
+                "open": sum(1 for count in self._refcounts.values() if count),
+            }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Returns the process-wide dataset store, or None when it is disabled with
+    DOCUMENTCHAT_SHARED_STORE=0 or cannot be opened (e.g. another process holds it).
+    """
+    global _store
+    if not SHARED_STORE:
+        return None
+    with _store_lock:
+        if _store is None:
+            try:
+                _store = DatasetStore()
+            except duckdb.Error as e:
+                print(f"Shared dataset store unavailable: {e}")
+                _store = False
+    return _store or None
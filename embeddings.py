@@ -0,0 +1,45 @@
+import os
+import threading
+
+EMBEDDING_MODEL = os.getenv("DOCUMENTCHAT_EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_embedding_model():
+    """
+    Loads the sentence-transformers model once per process.
+
+    Returns:
+    - The SentenceTransformer model, or None when sentence-transformers is unavailable
+      or embeddings are disabled with DOCUMENTCHAT_EMBEDDINGS=0.
+    """
+    global _model
+    if os.getenv("DOCUMENTCHAT_EMBEDDINGS", "1") == "0":
+        return None
+    with _model_lock:
+        if _model is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(EMBEDDING_MODEL)
+            except Exception as e:
+                print(f"Embeddings unavailable: {e}")
+                _model = False
+    return _model or None
+
+
+def embed(texts):
+    """
+    Embeds texts into L2-normalized vectors.
+
+    Parameters:
+    - texts: A list of strings.
+
+    Returns:
+    - np.ndarray of shape (len(texts), dim), or None when embeddings are unavailable.
+    """
+    model = get_embedding_model()
+    if model is None:
+        return None
+    return model.encode(texts, normalize_embeddings=True, convert_to_numpy=True)
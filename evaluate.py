@@ -1,81 +1,213 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from llm_guard.input_scanners import Toxicity, Sentiment, PromptInjection, Gibberish
 from llm_guard.input_scanners.toxicity import MatchType as InputToxicityMatchType
 from llm_guard.input_scanners.prompt_injection import MatchType as InputPromptInjectionMatchType
 from llm_guard.input_scanners.gibberish import MatchType as InputGibberishMatchType
-from llm_guard.output_scanners import Bias, Gibberish as OutputGibberish, Toxicity as OutputToxicity
+from llm_guard.output_scanners import Bias
 from llm_guard.output_scanners.bias import MatchType as OutputBiasMatchType
-from llm_guard.output_scanners.gibberish import MatchType as OutputGibberishMatchType
-from llm_guard.output_scanners.toxicity import MatchType as OutputToxicityMatchType
-
-def evaluate_prompt(prompt):
-    results = {}
-
-    # Evaluate prompt for toxicity
-    toxicity_scanner = Toxicity(threshold=0.5, match_type=InputToxicityMatchType.SENTENCE)
-    sanitized_prompt, is_valid, risk_score = toxicity_scanner.scan(prompt)
-    results['prompt_toxicity'] = {
-        "sanitized_prompt": sanitized_prompt,
-        "is_valid": is_valid,
-        "risk_score": risk_score
-    }
-
-    # Evaluate prompt for sentiment
-    sentiment_scanner = Sentiment(threshold=0)
-    sanitized_prompt, is_valid, risk_score = sentiment_scanner.scan(prompt)
-    results['prompt_sentiment'] = {
-        "sanitized_prompt": sanitized_prompt,
-        "is_valid": is_valid,
-        "risk_score": risk_score
-    }
-
-    # Evaluate prompt for prompt injections
-    prompt_injection_scanner = PromptInjection(threshold=0.5, match_type=InputPromptInjectionMatchType.FULL)
-    sanitized_prompt, is_valid, risk_score = prompt_injection_scanner.scan(prompt)
-    results['prompt_injection'] = {
-        "sanitized_prompt": sanitized_prompt,
-        "is_valid": is_valid,
-        "risk_score": risk_score
-    }
-
-    # Evaluate prompt for gibberish
-    gibberish_scanner = Gibberish(match_type=InputGibberishMatchType.FULL)
-    sanitized_prompt, is_valid, risk_score = gibberish_scanner.scan(prompt)
-    results['prompt_gibberish'] = {
-        "sanitized_prompt": sanitized_prompt,
-        "is_valid": is_valid,
-        "risk_score": risk_score
-    }
 
+# The output Toxicity and Gibberish scanners only wrap the input scanners and scan the
+# output text, so one instance (and one model) per check serves both directions; prompt
+# and output checks of that instance take turns on its scan lock
+scanner_factories = {
+    "toxicity": lambda: Toxicity(threshold=0.5, match_type=InputToxicityMatchType.SENTENCE),
+    "sentiment": lambda: Sentiment(threshold=0),
+    "prompt_injection": lambda: PromptInjection(threshold=0.5, match_type=InputPromptInjectionMatchType.FULL),
+    "gibberish": lambda: Gibberish(match_type=InputGibberishMatchType.FULL),
+    "bias": lambda: Bias(threshold=0.5, match_type=OutputBiasMatchType.FULL),
+}
+
+# Scanners that take both the prompt and the output
+output_only_scanners = {"bias"}
+
+prompt_checks = {
+    "prompt_toxicity": "toxicity",
+    "prompt_sentiment": "sentiment",
+    "prompt_injection": "prompt_injection",
+    "prompt_gibberish": "gibberish",
+}
+
+output_checks = {
+    "output_bias": "bias",
+    "output_gibberish": "gibberish",
+    "output_toxicity": "toxicity",
+}
+
+_scanners = {}
+_scanner_locks = {name: threading.Lock() for name in scanner_factories}
+# Held while a scanner scans: the instances are shared across threads and sessions, and
+# their Hugging Face fast tokenizers are not re-entrant ("Already borrowed")
+_scan_locks = {name: threading.Lock() for name in scanner_factories}
+
+# One worker per scanner, so every model can run at the same time
+executor = ThreadPoolExecutor(max_workers=len(scanner_factories), thread_name_prefix="guardrails")
+
+
+def get_scanner(name):
+    """
+    Returns the process-wide scanner with the given name, loading its model on first use.
+
+    Parameters:
+    - name: One of the keys of scanner_factories.
+
+    Returns:
+    - The llm_guard scanner.
+    """
+    scanner = _scanners.get(name)
+    if scanner is None:
+        with _scanner_locks[name]:
+            scanner = _scanners.get(name)
+            if scanner is None:
+                scanner = _scanners[name] = scanner_factories[name]()
+    return scanner
+
+
+def warm_up(names=None, background=False):
+    """
+    Loads scanner models ahead of the first request.
+
+    Parameters:
+    - names: The scanners to load, all of them by default.
+    - background: Whether to load them on a daemon thread and return immediately.
+
+    Returns:
+    - The loading thread when background is True, otherwise None.
+    """
+    names = list(names or scanner_factories)
+
+    def load():
+        for name in names:
+            get_scanner(name)
+
+    if background:
+        thread = threading.Thread(target=load, name="guardrail-warm-up", daemon=True)
+        thread.start()
+        return thread
+    load()
+    return None
+
+
+def run_scanner(name, prompt, model_output=None):
+    """
+    Runs one scanner on a prompt, or on a model output when one is given.
+
+    Returns:
+    - A tuple of the sanitized text, whether it is valid and the risk score.
+    """
+    scanner = get_scanner(name)
+    with _scan_locks[name]:
+        if name in output_only_scanners:
+            return scanner.scan(prompt, model_output)
+        return scanner.scan(prompt if model_output is None else model_output)
+
+
+def run_checks(checks, prompts, model_outputs=None, parallel=True):
+    """
+    Runs a set of checks over a batch of prompts (or model outputs).
+
+    Each scanner works through the whole batch on its own worker, so the different
+    models run concurrently while each model processes the batch back to back.
+
+    Parameters:
+    - checks: Result key to scanner name, e.g. prompt_checks.
+    - prompts: A list of prompts.
+    - model_outputs: The model output for each prompt, when checking outputs.
+    - parallel: Whether the scanners run concurrently.
+
+    Returns:
+    - A list with one dictionary of check results per prompt.
+    """
+    text_key = "sanitized_prompt" if model_outputs is None else "sanitized_output"
+    model_outputs = model_outputs if model_outputs is not None else [None] * len(prompts)
+
+    def scan_batch(name):
+        return [run_scanner(name, prompt, model_output) for prompt, model_output in zip(prompts, model_outputs)]
+
+    names = sorted(set(checks.values()))
+    if parallel:
+        batches = dict(zip(names, executor.map(scan_batch, names)))
+    else:
+        batches = {name: scan_batch(name) for name in names}
+
+    results = []
+    for index in range(len(prompts)):
+        results.append({})
+        for check, name in checks.items():
+            sanitized_text, is_valid, risk_score = batches[name][index]
+            results[-1][check] = {
+                text_key: sanitized_text,
+                "is_valid": is_valid,
+                "risk_score": risk_score
+            }
     return results
 
-def evaluate_output(prompt, model_output):
-    results = {}
-
-    # Evaluate output for bias
-    bias_scanner = Bias(threshold=0.5, match_type=OutputBiasMatchType.FULL)
-    sanitized_output, is_valid, risk_score = bias_scanner.scan(prompt, model_output)
-    results['output_bias'] = {
-        "sanitized_output": sanitized_output,
-        "is_valid": is_valid,
-        "risk_score": risk_score
-    }
-
-    # Evaluate output for gibberish
-    gibberish_scanner = OutputGibberish(match_type=OutputGibberishMatchType.FULL)
-    sanitized_output, is_valid, risk_score = gibberish_scanner.scan(prompt, model_output)
-    results['output_gibberish'] = {
-        "sanitized_output": sanitized_output,
-        "is_valid": is_valid,
-        "risk_score": risk_score
-    }
-
-    # Evaluate output for toxicity
-    toxicity_scanner = OutputToxicity(threshold=0.5, match_type=OutputToxicityMatchType.SENTENCE)
-    sanitized_output, is_valid, risk_score = toxicity_scanner.scan(prompt, model_output)
-    results['output_toxicity'] = {
-        "sanitized_output": sanitized_output,
-        "is_valid": is_valid,
-        "risk_score": risk_score
-    }
-
-    return results
\ No newline at end of file
+
+def passes_checks(checks, prompt, model_output=None):
+    """
+    Runs the checks concurrently and returns as soon as one of them fails.
+
+    Parameters:
+    - checks: Result key to scanner name, e.g. prompt_checks.
+    - prompt: The prompt.
+    - model_output: The model output, when checking outputs.
+
+    Returns:
+    - bool: True if every check passes.
+    """
+    futures = [executor.submit(run_scanner, name, prompt, model_output) for name in set(checks.values())]
+    try:
+        for future in as_completed(futures):
+            _, is_valid, _ = future.result()
+            if not is_valid:
+                return False
+        return True
+    finally:
+        # Scanners that have not started yet are skipped
+        for future in futures:
+            future.cancel()
+
+
+def evaluate_prompt(prompt, parallel=True):
+    return run_checks(prompt_checks, [prompt], parallel=parallel)[0]
+
+
+def evaluate_output(prompt, model_output, parallel=True):
+    return run_checks(output_checks, [prompt], [model_output], parallel=parallel)[0]
+
+
+def is_prompt_safe(prompt):
+    return passes_checks(prompt_checks, prompt)
+
+
+def is_output_safe(prompt, model_output):
+    return passes_checks(output_checks, prompt, model_output)
+
+
+def scan_many(prompts, parallel=True):
+    """
+    Evaluates several prompts with the shared scanners.
+
+    Parameters:
+    - prompts: A list of prompts.
+    - parallel: Whether the scanners run concurrently.
+
+    Returns:
+    - A list with the evaluate_prompt results for each prompt.
+    """
+    return run_checks(prompt_checks, list(prompts), parallel=parallel)
+
+
+def scan_many_outputs(prompts, model_outputs, parallel=True):
+    """
+    Evaluates several model outputs with the shared scanners.
+
+    Parameters:
+    - prompts: A list of prompts.
+    - model_outputs: The model output for each prompt.
+    - parallel: Whether the scanners run concurrently.
+
+    Returns:
+    - A list with the evaluate_output results for each pair.
+    """
+    return run_checks(output_checks, list(prompts), list(model_outputs), parallel=parallel)
@@ -1,91 +1,107 @@
 from models import Explanation
+from sampling import describe_approximation
+from telemetry import retrying
 import json
 
-def get_explanation(user_input, metadata, client, data):
-    flag_format = "{\"explanation\": string}"
-    system_prompt = f"Given the question, the head of the orginal dataframe, and the head, tail and description extracted dataframe in response to the query below, can you write the worded answer to the question for which the dataframe was extracted? Your response needs to be in the JSON format: {json.dumps(flag_format)}."
-    messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Question:  {user_input}  \n  Extracted Data Head: `{data.head().to_string()}`  \n Extracted Data Tail: `{data.tail().to_string()}`  \n Extracted Data Description: `{data.describe().to_string()}`  \n Original DataFrame Head: `{metadata}` "},
-        ]
-    chat_completion = client.chat.completions.create(
-        messages=messages,
-        model="gpt-4o",
-        response_format={"type": "json_schema",
+# Attempts at getting a valid explanation, each seeing the error of the previous one
+MAX_EXPLANATION_ATTEMPTS = 3
+
+EXPLANATION_FORMAT = {
+    "type": "json_schema",
     "json_schema": {
-      "name": "textual_explanation",
-      "strict": True,
-      "schema": {
-        "type": "object",
-        "properties": {
-          "explanation": {
-            "type": "string",
-            "description": "A textual explanation."
-          }
-        },
-        "required": [
-          "explanation"
-        ],
-        "additionalProperties": False
-      }
-    }},
-        temperature=0    
-    )
-    try:
-        explanation  = Explanation.model_validate_json(chat_completion.choices[0].message.content)
-        return explanation
-    except Exception as e:
-        messages+= [{"role": "assistant", "content": chat_completion.choices[0].message.content}, 
-                    {"role": "user", "content": f"This generated the following Exception: {str(e)}. Can you please return just the corrected explanation json"}] 
-        chat_completion = client.chat.completions.create(
-            messages = messages,         
-            model="gpt-4o",
-            temperature=0, 
-            response_format={
-      "name": "textual_explanation",
-      "strict": True,
-      "schema": {
-        "type": "object",
-        "properties": {
-          "explanation": {
-            "type": "string",
-            "description": "A textual explanation."
-          }
-        },
-        "required": [
-          "explanation"
-        ],
-        "additionalProperties": False
-      }
+        "name": "textual_explanation",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "explanation": {
+                    "type": "string",
+                    "description": "A textual explanation."
+                }
+            },
+            "required": [
+                "explanation"
+            ],
+            "additionalProperties": False
+        }
     }
+}
+
+def explanation_messages(user_input, metadata, data, streaming=False):
+    """
+    Builds the prompt for explaining an extracted result; a streamed explanation is
+    written as plain prose instead of JSON so it can be shown as it is generated.
+    """
+    task = "Given the question, the head of the orginal dataframe, and the head, tail and description extracted dataframe in response to the query below, can you write the worded answer to the question for which the dataframe was extracted?"
+    if streaming:
+        system_prompt = f"{task} Respond with the answer only, in plain prose."
+    else:
+        flag_format = "{\"explanation\": string}"
+        system_prompt = f"{task} Your response needs to be in the JSON format: {json.dumps(flag_format)}."
+    if data.attrs.get("truncated"):
+        # Only part of the result was fetched; describe the full result with the exact
+        # statistics computed in DuckDB instead of the fetched rows
+        rows_kept = "a uniform sample" if data.attrs.get("sampled") else "the first rows"
+        description = (
+            f"The full result has {data.attrs['row_count']} rows; the head and tail are from {rows_kept} ({len(data)} rows). "
+            f"Exact statistics of the full result: {data.attrs['statistics']}"
         )
-        try:
-            explanation  = Explanation.model_validate_json(chat_completion.choices[0].message.content)
-            return explanation
-        except Exception as e:
-            messages+= [{"role": "assistant", "content": chat_completion.choices[0].message.content}, 
-                        {"role": "user", "content": f"This generated the following Exception: {str(e)}. Can you please return just the corrected explanation json"}] 
+    else:
+        description = data.describe().to_string()
+    if data.attrs.get("approximate"):
+        description += (
+            f"\n{describe_approximation(data.attrs['approximate'])} "
+            "Say that the figures are approximate and state their error bounds."
+        )
+    return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"Question:  {user_input}  \n  Extracted Data Head: `{data.head().to_string()}`  \n Extracted Data Tail: `{data.tail().to_string()}`  \n Extracted Data Description: `{description}`  \n Original DataFrame Head: `{metadata}` "},
+        ]
+
+def get_explanation(user_input, metadata, client, data):
+    messages = explanation_messages(user_input, metadata, data)
+    for attempt in range(MAX_EXPLANATION_ATTEMPTS):
+        with retrying(attempt > 0):
             chat_completion = client.chat.completions.create(
-                messages = messages,         
+                messages=messages,
                 model="gpt-4o",
-                temperature=0, 
-                response_format={
-      "name": "textual_explanation",
-      "strict": True,
-      "schema": {
-        "type": "object",
-        "properties": {
-          "explanation": {
-            "type": "string",
-            "description": "A textual explanation."
-          }
-        },
-        "required": [
-          "explanation"
-        ],
-        "additionalProperties": False
-      }
-    } 
+                response_format=EXPLANATION_FORMAT,
+                temperature=0
             )
-            explanation  = Explanation.model_validate_json(chat_completion.choices[0].message.content)
+        try:
+            explanation = Explanation.model_validate_json(chat_completion.choices[0].message.content)
             return explanation
+        except Exception as e:
+            if attempt == MAX_EXPLANATION_ATTEMPTS - 1:
+                raise
+            messages += [{"role": "assistant", "content": chat_completion.choices[0].message.content},
+                         {"role": "user", "content": f"This generated the following Exception: {str(e)}. Can you please return just the corrected explanation json"}]
+
+def stream_explanation(user_input, metadata, client, data):
+    """
+    Starts a streamed explanation of an extracted result.
+
+    Parameters:
+    - user_input: The user's question.
+    - metadata: The description of the uploaded dataset.
+    - client: The OpenAI client.
+    - data: The extracted DataFrame.
+
+    Returns:
+    - A generator of the explanation's text as it arrives, e.g. for st.write_stream.
+      The request is already sent when this returns.
+    """
+    stream = client.chat.completions.create(
+        messages=explanation_messages(user_input, metadata, data, streaming=True),
+        model="gpt-4o",
+        temperature=0,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    return explanation_text(stream)
+
+def explanation_text(stream):
+    for chunk in stream:
+        # The last chunk only carries the usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
@@ -0,0 +1,343 @@
+import glob
+import os
+import re
+import shutil
+import tempfile
+import time
+import duckdb
+import pandas as pd
+from cache import CACHE_DIR
+from data_correction import infer_column_types, apply_column_types
+
+DATA_DIR = os.getenv("DOCUMENTCHAT_DATA_DIR", os.path.join(CACHE_DIR, "datasets"))
+
+# Uploads larger than this are streamed into DuckDB by default
+STREAMING_THRESHOLD_BYTES = 200 * 1024 * 1024
+PREVIEW_ROWS = 1000
+
+# Datasets queried this many times are copied from their view into a native table
+MATERIALIZE_AFTER_QUERIES = int(os.getenv("DOCUMENTCHAT_MATERIALIZE_AFTER_QUERIES", "3"))
+
+# Formats accepted by the uploader; every format but CSV carries its own column types
+UPLOAD_TYPES = ["csv", "parquet", "arrow", "feather", "ipc", "jsonl", "ndjson", "xlsx"]
+TYPED_FORMATS = set(UPLOAD_TYPES) - {"csv"}
+
+# Streamed databases and spooled uploads no session has used for this long are deleted
+DATA_MAX_AGE_SECONDS = float(os.getenv("DOCUMENTCHAT_DATA_MAX_AGE_HOURS", "24")) * 3600
+# Files named after an upload's content hash: its database (and write-ahead log), its
+# spooled copy and partial spools left behind by a crash
+DATASET_FILE = re.compile(
+    r"(?P<fingerprint>[0-9a-f]{64})\.(duckdb(\.wal)?|" + "|".join(sorted(TYPED_FORMATS)) + r")(\..+\.part)?"
+)
+
+
+def connect_dataset(fingerprint):
+    """
+    Opens the on-disk DuckDB database holding a streamed dataset.
+
+    Parameters:
+    - fingerprint: The content hash of the uploaded file.
+
+    Returns:
+    - A DuckDB connection to the dataset's database file.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return duckdb.connect(os.path.join(DATA_DIR, f"{fingerprint}.duckdb"))
+
+
+def touch_dataset(fingerprint):
+    """
+    Marks the files of a dataset as used now, so sweep_datasets keeps them.
+    """
+    for path in glob.glob(os.path.join(glob.escape(DATA_DIR), f"{fingerprint}.*")):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+
+def sweep_datasets(max_age=DATA_MAX_AGE_SECONDS, keep=None):
+    """
+    Deletes the streamed databases and spooled uploads that no session has touched for
+    max_age seconds, e.g. those of sessions that ended or moved on to another file.
+
+    Parameters:
+    - max_age: Seconds since a file was last used, see touch_dataset.
+    - keep: A predicate on fingerprints whose files are kept regardless, e.g. the
+      datasets of the shared store, which deletes their files itself.
+
+    Returns:
+    - int: The number of files deleted.
+    """
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(DATA_DIR) if os.path.isdir(DATA_DIR) else ():
+        match = DATASET_FILE.fullmatch(entry.name)
+        if match is None or not entry.is_file():
+            continue
+        try:
+            if entry.stat().st_mtime >= cutoff:
+                continue
+            if keep is not None and keep(match.group("fingerprint")):
+                continue
+            os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def table_exists(con, table_name):
+    """
+    Checks whether a table or view with the given name exists in the connection's
+    current schema.
+    """
+    return bool(con.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ? AND table_schema = current_schema()",
+        [table_name]
+    ).fetchone()[0])
+
+
+def read_preview(con, table_name="dataframe", preview_rows=PREVIEW_ROWS):
+    """
+    Materializes a bounded preview of a DuckDB table for display and prompt metadata.
+    """
+    return con.execute(f"SELECT * FROM {table_name} LIMIT {int(preview_rows)}").fetchdf()
+
+
+def ingest_csv(file, con, table_name="dataframe", datetime_columns=None, chunksize=200_000, preview_rows=PREVIEW_ROWS):
+    """
+    Streams a CSV into a DuckDB table in chunks, so the full file is never held as a
+    single DataFrame. Column types are decided on the first chunk and the same
+    conversions are applied to every chunk, which is written to a Parquet part on disk;
+    the parts are then loaded into the table with their types unified.
+
+    Parameters:
+    - file: A path or binary file-like object with the CSV contents.
+    - con: The DuckDB connection to create the table on.
+    - table_name: The name of the table to create.
+    - datetime_columns: Datetime columns and formats as returned by get_datetime_columns.
+    - chunksize: The number of rows converted at a time.
+    - preview_rows: The number of rows returned for display.
+
+    Returns:
+    - pd.DataFrame: The first preview_rows rows of the converted data.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix="ingest-", dir=DATA_DIR)
+    preview = None
+    column_types = None
+    try:
+        for index, chunk in enumerate(pd.read_csv(file, chunksize=chunksize)):
+            if column_types is None:
+                column_types = infer_column_types(chunk, datetime_columns)
+                print(f"Streaming ingestion column types: {column_types}")
+            # No integer downcasting, so every chunk gets the same width for a column
+            chunk = apply_column_types(chunk, column_types, datetime_columns, downcast=False)
+            if preview is None:
+                preview = chunk.head(preview_rows).reset_index(drop=True)
+            part_path = os.path.join(staging_dir, f"part-{index:06d}.parquet")
+            con.register("ingest_chunk", chunk)
+            try:
+                con.execute(f"COPY (SELECT * FROM ingest_chunk) TO '{part_path}' (FORMAT PARQUET)")
+            finally:
+                con.unregister("ingest_chunk")
+
+        if preview is None:
+            raise ValueError("The uploaded file contains no rows")
+
+        con.execute(
+            f"CREATE OR REPLACE TABLE {table_name} AS "
+            f"SELECT * FROM read_parquet('{os.path.join(staging_dir, '*.parquet')}', union_by_name = true)"
+        )
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return preview
+
+
+def file_format(file_name):
+    """
+    Returns the lowercase extension of an uploaded file name, e.g. 'parquet'.
+    """
+    return os.path.splitext(file_name)[1].lstrip(".").lower()
+
+
+def spool_upload(file, path, chunk_size=1 << 20):
+    """
+    Writes an uploaded file to path once, so DuckDB and pyarrow can read it from disk.
+
+    Parameters:
+    - file: A binary file-like object.
+    - path: The destination path; an existing file is reused as is.
+    - chunk_size: The number of bytes copied per read.
+
+    Returns:
+    - str: The path of the spooled file.
+    """
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A unique partial file per writer, so concurrent uploads of the same file do not
+        # write into each other; the last complete copy wins the rename
+        descriptor, partial_path = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix=".part", dir=os.path.dirname(path))
+        try:
+            file.seek(0)
+            with os.fdopen(descriptor, "wb") as out:
+                shutil.copyfileobj(file, out, chunk_size)
+            os.replace(partial_path, path)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+    return path
+
+
+def remove_spooled_uploads(fingerprint):
+    """
+    Deletes the files spool_upload wrote for a dataset, e.g. once it is evicted from the
+    store. fingerprint may be a prefix of the content hash.
+    """
+    for format in TYPED_FORMATS:
+        for path in glob.glob(os.path.join(glob.escape(DATA_DIR), f"{fingerprint}*.{format}")):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def load_typed_file(file, format, fingerprint, con, table_name="dataframe", preview_rows=PREVIEW_ROWS, materialize=False):
+    """
+    Exposes a Parquet, Arrow IPC/Feather, JSON Lines or Excel upload to DuckDB as
+    table_name without going through pandas type inference. Parquet and JSON Lines
+    become views over the file on disk and Arrow files are memory-mapped, so those
+    are never copied into a DataFrame; Excel sheets are read with openpyxl.
+
+    Parameters:
+    - file: A binary file-like object with the upload contents.
+    - format: One of TYPED_FORMATS.
+    - fingerprint: The content hash of the upload, used to name the spooled file.
+    - con: The DuckDB connection to register the data on.
+    - table_name: The name the data is queried by.
+    - preview_rows: The number of rows returned for display.
+    - materialize: Whether Arrow and Excel data is copied into a table rather than
+      registered, so that it persists in an on-disk database.
+
+    Returns:
+    - pd.DataFrame: The first preview_rows rows of the data.
+    """
+    def register(data):
+        if materialize:
+            con.register("upload_data", data)
+            try:
+                con.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM upload_data")
+            finally:
+                con.unregister("upload_data")
+        else:
+            con.register(table_name, data)
+
+    path = spool_upload(file, os.path.join(DATA_DIR, f"{fingerprint}.{format}"))
+    if format == "parquet":
+        con.execute(f"CREATE OR REPLACE VIEW {table_name} AS SELECT * FROM read_parquet('{path}')")
+    elif format in ("jsonl", "ndjson"):
+        con.execute(
+            f"CREATE OR REPLACE VIEW {table_name} AS "
+            f"SELECT * FROM read_json_auto('{path}', format = 'newline_delimited')"
+        )
+    elif format in ("arrow", "feather", "ipc"):
+        import pyarrow as pa
+        source = pa.memory_map(path)
+        try:
+            table = pa.ipc.open_file(source).read_all()
+        except pa.ArrowInvalid:
+            # Arrow IPC stream format rather than the file (Feather v2) format
+            source.seek(0)
+            table = pa.ipc.open_stream(source).read_all()
+        register(table)
+    elif format == "xlsx":
+        register(pd.read_excel(path, engine="openpyxl"))
+    else:
+        raise ValueError(f"Unsupported file format: {format}")
+    return read_preview(con, table_name, preview_rows)
+
+
+def materialize_table(con, table_name="dataframe"):
+    """
+    Replaces a view or registered DataFrame with a native DuckDB table of the same name
+    and computes its column statistics, so queries skip the pandas or file scan path.
+    The swap runs in one transaction, so concurrent readers always find the name.
+
+    Parameters:
+    - con: The DuckDB connection; the table is created in its current schema.
+    - table_name: The view or registration to materialize.
+
+    Returns:
+    - bool: Whether a view was materialized; False when the name is already a table.
+    """
+    view = con.execute(
+        "SELECT temporary FROM duckdb_views() WHERE view_name = ? AND (temporary OR schema_name = current_schema())",
+        [table_name]
+    ).fetchone()
+    if view is None:
+        return False
+    native_name = f"{table_name}__native"
+    con.execute("BEGIN TRANSACTION")
+    try:
+        con.execute(f"CREATE OR REPLACE TABLE {native_name} AS SELECT * FROM {table_name}")
+        if view[0]:
+            con.unregister(table_name)
+        else:
+            con.execute(f"DROP VIEW {table_name}")
+        con.execute(f"ALTER TABLE {native_name} RENAME TO {table_name}")
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    con.execute(f"ANALYZE {table_name}")
+    print(f"Materialized {table_name} into a native table")
+    return True
+
+
+class Registrations:
+    """
+    Tracks which version of the data each name is bound to on one DuckDB connection, so
+    DataFrames are registered once and only re-registered when the data changes.
+
+    Parameters:
+    - con: The connection the names are registered on.
+    """
+
+    def __init__(self, con):
+        self.con = con
+        self.versions = {}
+        self.native = set()
+        self.queries = 0
+
+    def register(self, name, data, version):
+        """
+        Binds name to data unless this version is already bound; None removes the binding.
+        """
+        if data is None:
+            self.drop(name)
+            return
+        if self.versions.get(name) == version:
+            return
+        self.drop(name)
+        self.con.register(name, data)
+        self.versions[name] = version
+
+    def drop(self, name):
+        if name not in self.versions:
+            return
+        if name in self.native:
+            self.con.execute(f"DROP TABLE IF EXISTS {name}")
+            self.native.discard(name)
+        else:
+            self.con.unregister(name)
+        del self.versions[name]
+
+    def record_query(self, name="dataframe"):
+        """
+        Counts a question answered from name and materializes it once it is queried often.
+        """
+        self.queries += 1
+        if self.queries == MATERIALIZE_AFTER_QUERIES and materialize_table(self.con, name):
+            self.native.add(name)
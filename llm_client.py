@@ -0,0 +1,340 @@
+"""
+The process-wide LLM client: one pooled HTTP connection pool, a shared requests- and
+tokens-per-minute budget, jittered exponential backoff on transient errors, a cap on
+concurrent calls per session and a circuit breaker that fails fast while the API is down.
+
+Every module receives the client returned by get_client() instead of building its own,
+so the limits hold across modules, threads and Streamlit sessions.
+"""
+import contextvars
+import json
+import math
+import os
+import random
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from types import SimpleNamespace
+import httpx
+import openai
+from openai import OpenAI
+from telemetry import InstrumentedClient, record_retry
+
+REQUESTS_PER_MINUTE = int(os.getenv("DOCUMENTCHAT_LLM_RPM", "500"))
+TOKENS_PER_MINUTE = int(os.getenv("DOCUMENTCHAT_LLM_TPM", "30000"))
+MAX_CONNECTIONS = int(os.getenv("DOCUMENTCHAT_LLM_MAX_CONNECTIONS", "32"))
+MAX_RETRIES = int(os.getenv("DOCUMENTCHAT_LLM_MAX_RETRIES", "5"))
+SESSION_CONCURRENCY = int(os.getenv("DOCUMENTCHAT_LLM_SESSION_CONCURRENCY", "4"))
+# How long a call waits for one of its session's slots before giving up
+SLOT_TIMEOUT_SECONDS = float(os.getenv("DOCUMENTCHAT_LLM_SLOT_TIMEOUT_SECONDS", "120"))
+BREAKER_FAILURES = int(os.getenv("DOCUMENTCHAT_LLM_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("DOCUMENTCHAT_LLM_BREAKER_RESET_SECONDS", "30"))
+
+# Errors worth retrying after a pause; anything else (bad request, auth) is raised at once
+RETRYABLE_ERRORS = (
+    openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError,
+)
+
+_session_id = contextvars.ContextVar("llm_session", default=None)
+
+
+class LLMUnavailableError(Exception):
+    """
+    Raised when the API is unavailable: retries are exhausted or the circuit breaker is open.
+    Callers' own answer-correction loops should not retry on it.
+    """
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket refilled continuously at capacity per minute.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        """
+        Blocks until amount tokens are available and takes them. Requests larger than the
+        capacity wait for a full bucket instead of waiting forever.
+        """
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def adjust(self, amount):
+        """
+        Returns (positive) or charges (negative) tokens once the real usage is known.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and lets a single trial call
+    through once reset_seconds have passed.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURES, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return
+        raise LLMUnavailableError("The LLM API is failing; calls are paused by the circuit breaker")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+@contextmanager
+def llm_session(session_id):
+    """
+    Attributes the LLM calls made inside the block (and in executor tasks submitted with
+    telemetry.submit) to a session, for the per-session concurrency cap.
+    """
+    token = _session_id.set(session_id)
+    try:
+        yield
+    finally:
+        _session_id.reset(token)
+
+
+def estimate_tokens(request):
+    """
+    Estimates the tokens a request will use, at about four characters per token plus the
+    completion budget, for reserving them from the tokens-per-minute bucket.
+    """
+    prompt_tokens = math.ceil(len(json.dumps(request.get("messages", []), default=str)) / 4)
+    completion_tokens = request.get("max_completion_tokens") or request.get("max_tokens") or 500
+    return prompt_tokens + completion_tokens
+
+
+def retry_after(error):
+    """
+    Returns the server's Retry-After delay in seconds, or None.
+    """
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class SessionStream:
+    """
+    Iterates a streamed completion for LLMClient. on_end(usage) is called once, with the
+    usage of the last chunk, when the stream is exhausted, fails or is closed, or when it
+    is garbage collected, even if it was never started.
+    """
+
+    def __init__(self, stream, on_end):
+        self._stream = stream
+        self._iterator = iter(stream)
+        # Shared with the finalizer, which must not refer to the stream object itself
+        self._usage = {"usage": None}
+        self._finalizer = weakref.finalize(self, lambda usage: on_end(usage["usage"]), self._usage)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+        self._usage["usage"] = getattr(chunk, "usage", None) or self._usage["usage"]
+        return chunk
+
+    def close(self):
+        close = getattr(self._stream, "close", None)
+        if close is not None:
+            close()
+        self._finalizer()
+
+
+class LLMClient:
+    """
+    Wraps a client whose own retries are disabled and adds the shared limits to
+    chat.completions.create.
+
+    Parameters:
+    - client: The underlying client, e.g. from create_openai_client.
+    - requests_per_minute / tokens_per_minute: The shared budgets.
+    - max_retries: Retries of a transient error before LLMUnavailableError is raised.
+    - session_concurrency: Concurrent calls allowed per llm_session.
+    - slot_timeout: Seconds a call waits for a session slot before LLMUnavailableError.
+    - base_delay / max_delay: The exponential backoff range in seconds.
+    """
+
+    def __init__(self, client, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 max_retries=MAX_RETRIES, session_concurrency=SESSION_CONCURRENCY, base_delay=0.5, max_delay=20.0,
+                 breaker=None, slot_timeout=SLOT_TIMEOUT_SECONDS):
+        self._client = client
+        self.slot_timeout = slot_timeout
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.session_concurrency = session_concurrency
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        # Held only by the calls and streams using them, so a session's entry goes away
+        # once it has nothing in flight; a new one starts with every slot free anyway
+        self._session_slots = weakref.WeakValueDictionary()
+        self._slots_lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _slots(self):
+        session_id = _session_id.get()
+        if session_id is None:
+            return None
+        with self._slots_lock:
+            slots = self._session_slots.get(session_id)
+            if slots is None:
+                slots = self._session_slots[session_id] = threading.BoundedSemaphore(self.session_concurrency)
+            return slots
+
+    def backoff(self, attempt, error):
+        # Full jitter, unless the server says how long to wait
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return delay
+
+    def _create(self, **kwargs):
+        slots = self._slots()
+        if slots is not None and not slots.acquire(timeout=self.slot_timeout):
+            raise LLMUnavailableError(f"No LLM slot of this session became free within {self.slot_timeout:.0f}s")
+        # acquire takes at most a full bucket, so only that much is settled against the usage
+        reserved = min(estimate_tokens(kwargs), self.tokens.capacity)
+        streaming = False
+        try:
+            response = self._create_with_retries(kwargs, reserved)
+            if kwargs.get("stream"):
+                # The slot is released by the stream once it ends
+                streaming = True
+                return SessionStream(response, lambda usage: self._end_stream(usage, reserved, slots))
+            usage = getattr(response, "usage", None)
+            if usage is not None and usage.total_tokens is not None:
+                self.tokens.adjust(reserved - usage.total_tokens)
+            return response
+        finally:
+            if slots is not None and not streaming:
+                slots.release()
+
+    def _end_stream(self, usage, reserved, slots):
+        """
+        Releases the session's slot held by a stream and settles the token budget with the
+        usage of its last chunk (sent when stream_options={"include_usage": True}).
+        """
+        if usage is not None and usage.total_tokens is not None:
+            self.tokens.adjust(reserved - usage.total_tokens)
+        if slots is not None:
+            slots.release()
+
+    def _create_with_retries(self, kwargs, reserved):
+        for attempt in range(self.max_retries + 1):
+            self.breaker.allow()
+            self.requests.acquire()
+            self.tokens.acquire(reserved)
+            try:
+                response = self._client.chat.completions.create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                # A failed attempt used no tokens
+                self.tokens.adjust(reserved)
+                self.breaker.record_failure()
+                if attempt == self.max_retries:
+                    raise LLMUnavailableError(f"LLM call failed after {attempt + 1} attempts: {e}") from e
+                delay = self.backoff(attempt, e)
+                print(f"LLM call failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                record_retry()
+                time.sleep(delay)
+                continue
+            except Exception:
+                # The API answered; the request itself was wrong
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return response
+
+
+def create_openai_client(api_key=None, base_url=None, max_connections=MAX_CONNECTIONS, timeout=60.0):
+    """
+    Builds an OpenAI client on a pooled HTTP client, with the SDK's own retries disabled
+    so that LLMClient owns the retry policy.
+    """
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        timeout=httpx.Timeout(timeout, connect=5.0),
+    )
+    return OpenAI(
+        api_key=api_key or os.getenv("OPENAI_API_KEY"),
+        base_url=base_url or os.getenv("OPENAI_BASE_URL"),
+        http_client=http_client,
+        max_retries=0,
+    )
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the process-wide instrumented, rate-limited OpenAI client.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = InstrumentedClient(LLMClient(create_openai_client()))
+        return _client
@@ -0,0 +1,333 @@
+"""
+Recorded-response stand-in for the OpenAI chat completions API.
+
+RecordingClient wraps a real client and appends every completion to a JSONL file.
+ReplayClient is a drop-in replacement for OpenAI() that answers from such a file by a
+hash of the request, with configurable latency and error injection, and synthesizes a
+schema-valid answer for requests that were never recorded. Requests with stream=True
+are answered as a stream of chunks. serve() exposes the same replay over HTTP for
+anything that talks to an OpenAI base URL.
+
+Usage:
+    python mock_openai.py serve --recordings recordings.jsonl --port 8000 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from cache import make_key
+
+# Request fields that determine the completion
+KEY_FIELDS = ("model", "messages", "response_format", "tools", "tool_choice")
+
+# Values used for string properties of synthesized answers, by property name
+SYNTHETIC_STRINGS = {"query": "SELECT * FROM dataframe LIMIT 10"}
+
+
+def request_key(request):
+    """
+    Hashes the fields of a chat completion request that determine its answer.
+    """
+    return make_key({field: request.get(field) for field in KEY_FIELDS})
+
+
+def load_recordings(path):
+    """
+    Reads a JSONL recording file into a dictionary of request key to response payload.
+    """
+    recordings = {}
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                entry = json.loads(line)
+                recordings[entry["key"]] = entry["response"]
+    return recordings
+
+
+def synthesize_value(schema, name=None):
+    """
+    Builds a minimal value that satisfies a JSON schema.
+    """
+    types = schema.get("type", "object")
+    if isinstance(types, list):
+        if "null" in types:
+            return None
+        types = types[0]
+    if types == "object":
+        properties = schema.get("properties", {})
+        return {key: synthesize_value(value, key) for key, value in properties.items()}
+    if types == "array":
+        return []
+    if types == "boolean":
+        return False
+    if types in ("integer", "number"):
+        return 0
+    return SYNTHETIC_STRINGS.get(name, "")
+
+
+def synthesize_response(request):
+    """
+    Builds a chat completion payload whose content matches the request's response_format.
+    """
+    response_format = request.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        content = json.dumps(synthesize_value(response_format["json_schema"].get("schema", {})))
+    elif response_format.get("type") == "json_object":
+        content = "{}"
+    else:
+        content = ""
+    prompt_tokens = math.ceil(len(json.dumps(request.get("messages", []))) / 4)
+    completion_tokens = math.ceil(len(content) / 4)
+    return {
+        "id": f"chatcmpl-mock-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "mock"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+            "logprobs": None,
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def response_chunks(response, include_usage=False):
+    """
+    Splits a chat completion payload into the chunk payloads of the equivalent stream, a
+    word at a time, ending with a usage chunk when include_usage is set.
+    """
+    choice = response["choices"][0]
+    pieces = re.findall(r"\s*\S+", choice["message"].get("content") or "") or [""]
+    base = {"id": response["id"], "object": "chat.completion.chunk", "created": response["created"], "model": response["model"]}
+    chunks = []
+    for index, piece in enumerate(pieces):
+        delta = {"role": "assistant", "content": piece} if index == 0 else {"content": piece}
+        finish_reason = (choice.get("finish_reason") or "stop") if index == len(pieces) - 1 else None
+        chunks.append(dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason, "logprobs": None}]))
+    if include_usage:
+        chunks.append(dict(base, choices=[], usage=response.get("usage")))
+    return chunks
+
+
+def include_usage(request):
+    return bool((request.get("stream_options") or {}).get("include_usage"))
+
+
+class MockBackend:
+    """
+    Answers chat completion requests from recordings, with latency and error injection.
+
+    Parameters:
+    - recordings: Request key to response payload, see load_recordings.
+    - latency: Seconds added to every request.
+    - latency_jitter: Up to this many seconds added at random on top of latency.
+    - error_rate: The probability that a request fails with error_status.
+    - error_status: The HTTP status of injected errors, e.g. 429 or 500.
+    - synthesize: Whether unrecorded requests get a synthesized answer instead of a 404.
+    - seed: Seed for reproducible latency and error injection.
+    """
+
+    def __init__(self, recordings=None, latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 error_status=429, synthesize=True, seed=None):
+        self.recordings = recordings or {}
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.synthesize = synthesize
+        self.requests = 0
+        self.errors = 0
+        self.misses = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def respond(self, request):
+        """
+        Returns (status, payload) for a request body.
+        """
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.random() * self.latency_jitter
+            fail = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            with self._lock:
+                self.errors += 1
+            return self.error_status, {"error": {"message": "Injected error", "type": "mock_error", "code": self.error_status}}
+
+        response = self.recordings.get(request_key(request))
+        if response is None:
+            with self._lock:
+                self.misses += 1
+            if not self.synthesize:
+                return 404, {"error": {"message": "No recorded response for request", "type": "mock_miss"}}
+            response = synthesize_response(request)
+        return 200, response
+
+
+class ReplayClient:
+    """
+    A drop-in replacement for the OpenAI client that answers from a MockBackend in-process.
+
+    Keyword arguments are passed to MockBackend; recordings may also be given as a path.
+    """
+
+    def __init__(self, recordings=None, **options):
+        if isinstance(recordings, str):
+            recordings = load_recordings(recordings)
+        self.backend = MockBackend(recordings, **options)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        import httpx
+        import openai
+        from openai.types.chat import ChatCompletion
+
+        status, payload = self.backend.respond(kwargs)
+        if status != 200:
+            response = httpx.Response(
+                status, json=payload, request=httpx.Request("POST", "http://mock/v1/chat/completions")
+            )
+            error_class = {429: openai.RateLimitError, 404: openai.NotFoundError}.get(
+                status, openai.InternalServerError if status >= 500 else openai.APIStatusError
+            )
+            raise error_class(payload["error"]["message"], response=response, body=payload)
+        if kwargs.get("stream"):
+            from openai.types.chat import ChatCompletionChunk
+            return iter([ChatCompletionChunk.model_validate(chunk) for chunk in response_chunks(payload, include_usage(kwargs))])
+        return ChatCompletion.model_validate(payload)
+
+
+class RecordingClient:
+    """
+    Wraps a real client and appends every chat completion to a JSONL recording file.
+    """
+
+    def __init__(self, client, path):
+        self._client = client
+        self._path = path
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        response = self._client.chat.completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return self._record_stream(kwargs, response)
+        self._write(kwargs, response.model_dump())
+        return response
+
+    def _record_stream(self, request, stream):
+        # Recorded as the equivalent complete response once the stream is consumed
+        content, last, usage = [], None, None
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                content.append(chunk.choices[0].delta.content)
+            last = chunk if chunk.choices else last
+            usage = chunk.usage or usage
+            yield chunk
+        if last is not None:
+            self._write(request, {
+                "id": last.id, "object": "chat.completion", "created": last.created, "model": last.model,
+                "choices": [{
+                    "index": 0, "message": {"role": "assistant", "content": "".join(content)},
+                    "finish_reason": last.choices[0].finish_reason or "stop", "logprobs": None,
+                }],
+                "usage": usage.model_dump() if usage is not None else None,
+            })
+
+    def _write(self, request, response):
+        entry = {"key": request_key(request), "request": request, "response": response}
+        with self._lock, open(self._path, "a") as file:
+            file.write(json.dumps(entry, default=str) + "\n")
+
+
+def serve(backend, host="127.0.0.1", port=8000):
+    """
+    Serves POST /v1/chat/completions from a MockBackend until interrupted.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send(404, {"error": {"message": f"Unknown path {self.path}", "type": "mock_miss"}})
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            status, payload = backend.respond(request)
+            if status == 200 and request.get("stream"):
+                self._send_stream(response_chunks(payload, include_usage(request)))
+                return
+            self._send(status, payload)
+
+        def _send_stream(self, chunks):
+            # Server-sent events, as the API streams completions
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for chunk in chunks:
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    print(f"Mock OpenAI server on http://{host}:{port}/v1")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded OpenAI chat completions.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Serve recordings over HTTP")
+    serve_parser.add_argument("--recordings", help="JSONL file written by RecordingClient")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    serve_parser.add_argument("--latency-jitter", type=float, default=0.0)
+    serve_parser.add_argument("--error-rate", type=float, default=0.0)
+    serve_parser.add_argument("--error-status", type=int, default=429)
+    serve_parser.add_argument("--no-synthesize", action="store_true", help="Return 404 for unrecorded requests")
+    serve_parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    recordings = load_recordings(args.recordings) if args.recordings else {}
+    backend = MockBackend(
+        recordings, latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+        error_status=args.error_status, synthesize=not args.no_synthesize, seed=args.seed,
+    )
+    serve(backend, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import NamedTuple, Optional
+from visualization import is_visualisation_necessary, cached_visualisation_type
+from data_extraction_openai import get_data
+from explanation import get_explanation, stream_explanation
+from data_visualisation_openai import get_data_visualisation
+from data_forecast import is_forecast_request
+from models import ChartType, Explanation
+from telemetry import run_in_stage, stage, submit, trace
+
+# Shared across Streamlit sessions; every task is an I/O-bound chat completion
+executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="insightsense")
+# Request the chart type alongside the visualisation flag; saves a round trip per charted
+# question at the cost of one chart type call for questions that need no chart
+SPECULATIVE_CHART_TYPE = os.getenv("DOCUMENTCHAT_SPECULATIVE_CHART_TYPE", "1") == "1"
+
+
+class Answer(NamedTuple):
+    visualisation: Optional[ChartType]
+    data: object
+    explanation: Explanation
+    figure: object
+    trace_id: Optional[str] = None
+
+
+def snapshot_state(session_state):
+    """
+    Copies the session state into a plain namespace that worker threads can read
+    without a Streamlit script run context.
+
+    Parameters:
+    - session_state: st.session_state or any object with attribute access.
+
+    Returns:
+    - A SimpleNamespace with the same attributes.
+    """
+    items = session_state.to_dict() if hasattr(session_state, "to_dict") else vars(session_state)
+    return SimpleNamespace(**items)
+
+
+def classify_question(user_query, session_state, forecasting_flag, client):
+    """
+    Runs the independent intent classifiers for a question concurrently.
+
+    With SPECULATIVE_CHART_TYPE the chart type is requested alongside the visualisation
+    flag and discarded when no chart is needed; otherwise it is requested once a chart is
+    known to be needed. Chart types are cached per question, see cached_visualisation_type.
+    When the dataset supports forecasting, the visualisation classifiers see the forecast
+    table in their context without waiting for is_forecast_request.
+
+    Parameters:
+    - user_query: The user's question.
+    - session_state: An object containing the state, including dataframes and metadata.
+    - forecasting_flag: Whether the uploaded dataset supports forecasting.
+    - client: The OpenAI client for generating queries.
+
+    Returns:
+    - A tuple of the forecasting flag for the question and the ChartType (or None).
+    """
+    session_state = snapshot_state(session_state)
+    forecast_request = submit(executor, "forecast_request", is_forecast_request, user_query, client) if forecasting_flag else None
+    necessary = submit(executor, "visualisation_necessary", is_visualisation_necessary, user_query, session_state, forecasting_flag, client)
+    chart_type = None
+    if SPECULATIVE_CHART_TYPE:
+        chart_type = submit(executor, "visualisation_type", cached_visualisation_type, user_query, session_state, forecasting_flag, client)
+
+    forecasting = bool(forecast_request and forecast_request.result())
+    if necessary.result():
+        if chart_type is None:
+            return forecasting, run_in_stage("visualisation_type", cached_visualisation_type, user_query, session_state, forecasting_flag, client)
+        return forecasting, chart_type.result()
+    # A speculative chart type request is already in flight; its result is dropped
+    return forecasting, None
+
+
+def answer_question(user_query, session_state, forecasting_flag, client, con, approximate=False, stream=False):
+    """
+    Answers a question, serializing only the real dependencies between stages:
+    the classifiers run concurrently, then the SQL, then the explanation and
+    chart concurrently.
+
+    Parameters:
+    - user_query: The user's question.
+    - session_state: An object containing the state, including dataframes and metadata.
+    - forecasting_flag: Whether the uploaded dataset supports forecasting.
+    - client: The OpenAI client for generating queries.
+    - con: The DuckDB connection with the registered dataframes.
+    - approximate: Whether aggregations may be answered from the sample, see sampling.
+    - stream: Whether to return as soon as the data is extracted, with the explanation
+      streaming and the chart still being generated.
+
+    Returns:
+    - An Answer with the chart type, extracted data, explanation, figure (or None) and the
+      telemetry trace id of its LLM calls. When streaming, the explanation is a generator
+      of its text and the figure a Future of it (or None).
+    """
+    session_state = snapshot_state(session_state)
+    session_state.approximate = approximate
+    with trace() as trace_id:
+        forecasting, visualisation = classify_question(user_query, session_state, forecasting_flag, client)
+        print(visualisation)
+        with stage("sql"):
+            data = get_data(visualisation, user_query, session_state, forecasting, client, con)
+
+        explain = stream_explanation if stream else get_explanation
+        explanation = submit(executor, "explanation", explain, user_query, session_state.metadata, client, data)
+        figure = None
+        if visualisation is not None:
+            figure = submit(executor, "chart", get_data_visualisation, data, visualisation, client, None)
+
+        if stream:
+            # The chart is drawn by the caller while the explanation streams
+            return Answer(
+                visualisation=visualisation,
+                data=data,
+                explanation=explanation.result(),
+                figure=figure,
+                trace_id=trace_id,
+            )
+        return Answer(
+            visualisation=visualisation,
+            data=data,
+            explanation=explanation.result(),
+            figure=figure.result() if figure is not None else None,
+            trace_id=trace_id,
+        )
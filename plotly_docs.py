@@ -0,0 +1,141 @@
+import inspect
+import json
+import os
+import re
+import threading
+from visualization import chart_types
+
+DOCS_DIR = os.getenv("DOCUMENTCHAT_PLOTLY_DOCS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "plotly_docs"))
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def parse_docstring(docstring):
+    """
+    Splits a numpydoc-style plotly.express docstring into its description and parameters.
+
+    Parameters:
+    - docstring: The cleaned docstring, e.g. from inspect.getdoc.
+
+    Returns:
+    - A tuple of the description text and a list of (name, type, description) tuples.
+    """
+    lines = docstring.splitlines()
+    description = []
+    parameters = []
+    section = "description"
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if index + 1 < len(lines) and set(lines[index + 1].strip()) == {"-"}:
+            section = stripped.lower()
+            continue
+        if set(stripped) == {"-"}:
+            continue
+        if section == "description":
+            description.append(stripped)
+        elif section == "parameters":
+            if line and not line[0].isspace():
+                name, _, type_ = stripped.partition(":")
+                parameters.append([name.strip(), type_.strip(), []])
+            elif parameters and stripped:
+                parameters[-1][2].append(stripped)
+    description = " ".join(line for line in description if line)
+    return description, [(name, type_, " ".join(text)) for name, type_, text in parameters]
+
+
+def format_documentation(parameters):
+    """
+    Formats parameters like the argument list of the online API reference.
+    """
+    return "\n\n".join(f"{name} ({type_})\n{text}" for name, type_, text in parameters)
+
+
+def trim_parameters(parameters):
+    """
+    Produces a compact variant of the documentation without the data_frame parameter,
+    keeping the first sentence of each parameter description.
+    """
+    trimmed = []
+    for name, type_, text in parameters:
+        if name == "data_frame":
+            continue
+        first_sentence = re.split(r"(?<=\.)\s", text, maxsplit=1)[0]
+        trimmed.append(f"{name} ({type_}): {first_sentence}")
+    return "\n".join(trimmed)
+
+
+def store_path(version):
+    return os.path.join(DOCS_DIR, f"plotly-{version}.json")
+
+
+def build_documentation_store():
+    """
+    Builds the documentation of every plotly.express method in chart_types from the
+    installed plotly's docstrings and writes it to DOCS_DIR, versioned by plotly version.
+
+    Returns:
+    - dict: The store, with the plotly version and full and trimmed documentation per method.
+    """
+    import plotly
+    import plotly.express as px
+
+    methods = {}
+    for chart in chart_types:
+        function = getattr(px, chart["Method"], None)
+        docstring = inspect.getdoc(function) if function is not None else None
+        if not docstring:
+            continue
+        description, parameters = parse_docstring(docstring)
+        methods[chart["Method"]] = {
+            "description": description or "No blockquote found",
+            "documentation": format_documentation(parameters),
+            "trimmed": trim_parameters(parameters),
+        }
+
+    store = {"plotly_version": plotly.__version__, "methods": methods}
+    os.makedirs(DOCS_DIR, exist_ok=True)
+    path = store_path(plotly.__version__)
+    with open(f"{path}.part", "w") as out:
+        json.dump(store, out)
+    os.replace(f"{path}.part", path)
+    return store
+
+
+def load_documentation_store():
+    """
+    Loads the documentation store for the installed plotly version, building it on first use.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            import plotly
+            path = store_path(plotly.__version__)
+            if os.path.exists(path):
+                with open(path) as file:
+                    _store = json.load(file)
+            else:
+                _store = build_documentation_store()
+    return _store
+
+
+def get_documentation(method, trimmed=False):
+    """
+    Returns the stored documentation for a plotly.express method.
+
+    Parameters:
+    - method: The plotly.express function name, e.g. 'bar'.
+    - trimmed: Whether to return the compact variant.
+
+    Returns:
+    - A tuple of the documentation text and the description, or None if the method is not stored.
+    """
+    entry = load_documentation_store()["methods"].get(method)
+    if entry is None:
+        return None
+    return entry["trimmed" if trimmed else "documentation"], entry["description"]
+
+
+if __name__ == "__main__":
+    store = build_documentation_store()
+    print(f"Stored documentation for {len(store['methods'])} methods in {store_path(store['plotly_version'])}")
@@ -0,0 +1,82 @@
+import os
+import pyarrow as pa
+
+# Rows of a query result materialized in pandas for display, charts and the explanation
+MAX_RESULT_ROWS = int(os.getenv("DOCUMENTCHAT_MAX_RESULT_ROWS", "10000"))
+BATCH_ROWS = 2048
+
+# Charts of distributions are drawn from a uniform sample of a truncated result rather
+# than its first rows
+SAMPLED_CHARTS = {"scatter", "histogram", "box", "violin", "strip", "density_heatmap", "density_contour"}
+
+
+def stream_rows(con, sql, max_rows, batch_rows=BATCH_ROWS):
+    """
+    Reads at most max_rows rows of a query as Arrow record batches, so no more than one
+    batch beyond the limit is ever held in memory.
+
+    Returns:
+    - A tuple of the rows as a DataFrame and whether the query had more rows.
+    """
+    reader = con.execute(f"SELECT * FROM ({sql}) AS result LIMIT {int(max_rows) + 1}").fetch_record_batch(batch_rows)
+    batches, rows = [], 0
+    for batch in reader:
+        batches.append(batch)
+        rows += batch.num_rows
+        if rows > max_rows:
+            break
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+    truncated = table.num_rows > max_rows
+    return table.slice(0, max_rows).to_pandas(), truncated
+
+
+def sample_rows(con, sql, max_rows):
+    """
+    Draws a reproducible uniform sample of max_rows rows of a query.
+    """
+    return con.execute(
+        f"SELECT * FROM ({sql}) AS result USING SAMPLE reservoir({int(max_rows)} ROWS) REPEATABLE (42)"
+    ).fetchdf()
+
+
+def result_statistics(con, sql):
+    """
+    Computes exact per-column statistics of a full query result inside DuckDB.
+
+    Returns:
+    - A tuple of the exact row count and the SUMMARIZE output as text.
+    """
+    summary = con.execute(f"SUMMARIZE SELECT * FROM ({sql}) AS result").fetchdf()
+    row_count = int(summary["count"].iloc[0]) if len(summary) else 0
+    columns = [
+        column for column in ("column_name", "column_type", "min", "max", "avg", "std", "q25", "q50", "q75", "null_percentage")
+        if column in summary.columns
+    ]
+    return row_count, summary[columns].to_string(index=False)
+
+
+def fetch_result(con, sql, method=None, max_rows=MAX_RESULT_ROWS):
+    """
+    Runs a query with a bounded result: at most max_rows rows reach pandas however large
+    the result is. A truncated result carries the exact row count and statistics of the
+    full result in its attrs, for the explanation.
+
+    Parameters:
+    - con: The DuckDB connection.
+    - sql: The validated query.
+    - method: The chart method the result is drawn with, if any.
+    - max_rows: The row limit.
+
+    Returns:
+    - A DataFrame whose attrs hold the sql, whether it was truncated, the row count and,
+      when truncated, the statistics of the full result.
+    """
+    data, truncated = stream_rows(con, sql, max_rows)
+    attrs = {"sql": sql, "truncated": truncated, "row_count": len(data)}
+    if truncated:
+        if method in SAMPLED_CHARTS:
+            data = sample_rows(con, sql, max_rows)
+        attrs["row_count"], attrs["statistics"] = result_statistics(con, sql)
+        attrs["sampled"] = method in SAMPLED_CHARTS
+    data.attrs.update(attrs)
+    return data
@@ -0,0 +1,553 @@
+"""
+Pre-aggregated rollups of the uploaded table for dashboard-style questions ("total X by
+Y per month"). At upload time the low-cardinality dimensions, numeric measures and
+datetime columns are found from the column profiles, and rollup tables are built by
+day and month (and by dimensions alone). Generated SQL that only groups and filters by
+those columns and aggregates those measures is rewritten to read the smallest rollup
+that answers it exactly; every other query runs on the table unchanged.
+"""
+import json
+import os
+import re
+import pandas as pd
+from sql_validation import quote_identifier
+
+# Tables smaller than this are fast enough to aggregate directly
+ROLLUP_MIN_ROWS = int(os.getenv("DOCUMENTCHAT_ROLLUP_MIN_ROWS", "100000"))
+MAX_DIMENSION_CARDINALITY = int(os.getenv("DOCUMENTCHAT_ROLLUP_MAX_CARDINALITY", "100"))
+MAX_DIMENSIONS = 6
+MAX_MEASURES = 20
+MAX_DATETIME_COLUMNS = 2
+# A rollup is only kept if it has at most this fraction of the table's rows
+MAX_ROLLUP_FRACTION = 0.1
+
+ROLLUP_CATALOG = "dataframe__rollups"
+
+DIMENSION_TYPES = ("VARCHAR", "BOOLEAN", "ENUM")
+MEASURE_TYPES = (
+    "TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT", "UTINYINT", "USMALLINT",
+    "UINTEGER", "UBIGINT", "FLOAT", "DOUBLE", "DECIMAL",
+)
+DATETIME_TYPES = ("DATE", "TIMESTAMP")
+
+# Each grain is answered by rollups of the grains that divide it
+DIVIDES = {
+    "day": {"day", "week", "month", "quarter", "year"},
+    "month": {"month", "quarter", "year"},
+}
+# The grain needed by functions of a datetime column, by function or date part name
+PART_GRAINS = {
+    "year": "year", "years": "year", "isoyear": "year", "decade": "year", "century": "year", "millennium": "year",
+    "quarter": "quarter", "quarters": "quarter",
+    "month": "month", "months": "month", "monthname": "month",
+    "week": "week", "weeks": "week", "weekofyear": "week", "yearweek": "week",
+    "day": "day", "days": "day", "dayofmonth": "day", "dayofweek": "day", "dayofyear": "day", "dayname": "day",
+    "dow": "day", "isodow": "day", "doy": "day",
+}
+PART_FUNCTIONS = {"date_part", "datepart", "date_trunc", "datetrunc"}
+# strftime codes of a day or coarser; any other code (%H, %M, %S, %p, %c, %X, ...) needs the time of day
+STRFTIME_GRAINS = [("%Y", "year"), ("%y", "year"), ("%G", "year"), ("%m", "month"), ("%B", "month"), ("%b", "month"),
+                   ("%V", "week"), ("%U", "week"), ("%W", "week"), ("%d", "day"), ("%e", "day"), ("%j", "day"),
+                   ("%a", "day"), ("%A", "day"), ("%w", "day"), ("%u", "day"), ("%x", "day")]
+# Comparisons of a datetime column with an aligned boundary select whole days or months
+LOWER_BOUNDS = {"COMPARE_GREATERTHANOREQUALTO"}
+UPPER_BOUNDS = {"COMPARE_LESSTHAN"}
+MIRRORED = {"COMPARE_LESSTHANOREQUALTO": "COMPARE_GREATERTHANOREQUALTO", "COMPARE_GREATERTHAN": "COMPARE_LESSTHAN"}
+
+
+class NotAnswerable(Exception):
+    """
+    Raised while checking a query that a rollup cannot answer exactly.
+    """
+
+
+def has_type(column, types):
+    return column["type"].upper().split("(")[0].split(" ")[0] in types
+
+
+def date_span(column, grain):
+    """
+    Estimates the number of days or months between a datetime column's min and max.
+    """
+    try:
+        start, end = pd.Timestamp(column["min"]), pd.Timestamp(column["max"])
+    except (TypeError, ValueError):
+        return None
+    if pd.isna(start) or pd.isna(end):
+        return None
+    if grain == "month":
+        return (end.year - start.year) * 12 + end.month - start.month + 1
+    return (end.normalize() - start.normalize()).days + 1
+
+
+def rollup_columns(columns):
+    """
+    Picks the rollup dimensions, measures and datetime columns from the column profiles of
+    schema_summary.summarize_table. Datetime columns are those stored as dates or
+    timestamps, which includes the columns found by get_datetime_columns once converted.
+
+    Returns:
+    - A tuple of the dimension profiles, measure names and datetime profiles.
+    """
+    names = {column["name"].lower() for column in columns}
+    dimensions = sorted(
+        (column for column in columns
+         if has_type(column, DIMENSION_TYPES) and column["distinct"] and 1 < column["distinct"] <= MAX_DIMENSION_CARDINALITY),
+        key=lambda column: column["distinct"]
+    )[:MAX_DIMENSIONS]
+    measures = [
+        column["name"] for column in columns
+        if has_type(column, MEASURE_TYPES)
+        and not {f"{column['name']}__{suffix}".lower() for suffix in ("sum", "count", "min", "max")} & names
+    ][:MAX_MEASURES]
+    datetimes = [column for column in columns if has_type(column, DATETIME_TYPES)][:MAX_DATETIME_COLUMNS]
+    return dimensions, measures, datetimes
+
+
+def fit_dimensions(dimensions, periods, max_rows):
+    """
+    Drops the highest-cardinality dimensions until the estimated rollup size fits.
+    """
+    dimensions = list(dimensions)
+    while True:
+        size = periods
+        for column in dimensions:
+            size *= column["distinct"] + 1
+        if size <= max_rows:
+            return dimensions
+        if not dimensions:
+            return None
+        dimensions.pop()
+
+
+def aggregate_list(measures, source=None):
+    """
+    The aggregate columns of a rollup, computed from the table or, when source names
+    measures already rolled up, by re-aggregating a finer rollup.
+    """
+    items = []
+    if source is None:
+        items.append('COUNT(*) AS "__rows"')
+        for measure in measures:
+            column = quote_identifier(measure)
+            items += [
+                f"SUM({column}) AS {quote_identifier(measure + '__sum')}",
+                f"COUNT({column}) AS {quote_identifier(measure + '__count')}",
+                f"MIN({column}) AS {quote_identifier(measure + '__min')}",
+                f"MAX({column}) AS {quote_identifier(measure + '__max')}",
+            ]
+    else:
+        items.append('SUM("__rows")::BIGINT AS "__rows"')
+        for measure in measures:
+            items += [
+                f"SUM({quote_identifier(measure + '__sum')}) AS {quote_identifier(measure + '__sum')}",
+                f"SUM({quote_identifier(measure + '__count')})::BIGINT AS {quote_identifier(measure + '__count')}",
+                f"MIN({quote_identifier(measure + '__min')}) AS {quote_identifier(measure + '__min')}",
+                f"MAX({quote_identifier(measure + '__max')}) AS {quote_identifier(measure + '__max')}",
+            ]
+    return items
+
+
+def create_rollup(con, name, source, datetime_column, grain, dimensions, measures, rolled_up=False):
+    keys = [quote_identifier(column) for column in dimensions]
+    select = list(keys)
+    if datetime_column is not None:
+        column = quote_identifier(datetime_column["name"])
+        select.insert(0, f"CAST(date_trunc('{grain}', {column}) AS {datetime_column['type']}) AS {column}")
+        keys.insert(0, "1")
+    group_by = f" GROUP BY {', '.join(str(index + 1) for index in range(len(keys)))}" if keys else ""
+    con.execute(
+        f"CREATE OR REPLACE TABLE {quote_identifier(name)} AS "
+        f"SELECT {', '.join(select + aggregate_list(measures, source if rolled_up else None))} "
+        f"FROM {quote_identifier(source)}{group_by}"
+    )
+    return con.execute(f"SELECT COUNT(*) FROM {quote_identifier(name)}").fetchone()[0]
+
+
+def build_rollups(con, row_count, columns, table_name="dataframe"):
+    """
+    Builds the rollups of a table once, unless they exist already, and records them in a
+    catalog table next to it. Each datetime column gets a rollup by day, which the rollup
+    by month is aggregated from; one more rollup groups by the dimensions alone.
+
+    Parameters:
+    - con: A writable DuckDB connection holding the table.
+    - row_count / columns: The output of schema_summary.summarize_table for the table.
+    - table_name: The table to roll up.
+
+    Returns:
+    - The rollups, as returned by load_rollups.
+    """
+    existing = load_rollups(con)
+    if existing or row_count < ROLLUP_MIN_ROWS:
+        return existing
+    dimensions, measures, datetimes = rollup_columns(columns)
+    if not dimensions and not datetimes:
+        return []
+
+    max_rows = row_count * MAX_ROLLUP_FRACTION
+    plans = []
+    for datetime_column in datetimes:
+        day_dimensions = fit_dimensions(dimensions, date_span(datetime_column, "day") or max_rows + 1, max_rows)
+        if day_dimensions is not None:
+            plans.append((datetime_column, "day", day_dimensions))
+        month_dimensions = fit_dimensions(dimensions, date_span(datetime_column, "month") or max_rows + 1, max_rows)
+        if month_dimensions is not None:
+            plans.append((datetime_column, "month", month_dimensions))
+    overall_dimensions = fit_dimensions(dimensions, 1, max_rows)
+    if dimensions and overall_dimensions:
+        plans.append((None, None, overall_dimensions))
+
+    rollups = []
+    for index, (datetime_column, grain, plan_dimensions) in enumerate(plans):
+        name = f"{table_name}__rollup_{index}"
+        names = [column["name"] for column in plan_dimensions]
+        # Month rollups are re-aggregated from the day rollup of the same column when it has their dimensions
+        day = next((
+            rollup for rollup in rollups
+            if datetime_column is not None and rollup["datetime_column"] == datetime_column["name"]
+            and rollup["grain"] == "day" and set(names) <= set(rollup["dimensions"])
+        ), None)
+        source, rolled_up = (day["name"], True) if grain == "month" and day else (table_name, False)
+        rollup_rows = create_rollup(con, name, source, datetime_column, grain, names, measures, rolled_up)
+        if rollup_rows > max_rows:
+            con.execute(f"DROP TABLE {quote_identifier(name)}")
+            continue
+        rollups.append({
+            "name": name,
+            "datetime_column": datetime_column["name"] if datetime_column else None,
+            "datetime_type": datetime_column["type"] if datetime_column else None,
+            "grain": grain,
+            "dimensions": names,
+            "measures": measures,
+            "row_count": rollup_rows,
+        })
+        print(f"Built rollup {name}: {rollup_rows} rows by {grain or 'dimensions'} x {names}")
+
+    con.execute(f'CREATE OR REPLACE TABLE "{ROLLUP_CATALOG}" (rollup VARCHAR, source VARCHAR, definition VARCHAR)')
+    for rollup in rollups:
+        con.execute(f'INSERT INTO "{ROLLUP_CATALOG}" VALUES (?, ?, ?)', [rollup["name"], table_name, json.dumps(rollup)])
+    return load_rollups(con)
+
+
+def load_rollups(con):
+    """
+    Returns the rollups recorded for the connection's dataset, smallest first.
+    """
+    exists = con.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ? AND table_schema = current_schema()",
+        [ROLLUP_CATALOG]
+    ).fetchone()[0]
+    if not exists:
+        return []
+    rollups = [json.loads(row[0]) for row in con.execute(f'SELECT definition FROM "{ROLLUP_CATALOG}"').fetchall()]
+    return sorted(rollups, key=lambda rollup: rollup["row_count"])
+
+
+def constant_text(node):
+    """
+    The text of a constant, or of a constant cast to a type, or None.
+    """
+    if node["class"] == "CAST":
+        node = node["child"]
+    if node["class"] != "CONSTANT" or node["value"]["is_null"]:
+        return None
+    return str(node["value"]["value"])
+
+
+def aligned(text, grain):
+    """
+    Whether a datetime literal falls on a boundary of the grain.
+    """
+    try:
+        value = pd.Timestamp(text)
+    except (TypeError, ValueError):
+        return False
+    if pd.isna(value) or value != value.normalize():
+        return False
+    return grain == "day" or value.day == 1
+
+
+def finer(grain, other):
+    return grain if other is None or grain in DIVIDES.get(other, {other}) else other
+
+
+class RollupMatcher:
+    """
+    Checks a parsed SELECT against one rollup and rewrites it to read the rollup.
+    """
+
+    def __init__(self, rollup, aggregates, aliases):
+        self.rollup = rollup
+        self.aggregates = aggregates
+        self.aliases = aliases
+        self.dimensions = {name.lower(): name for name in rollup["dimensions"]}
+        self.measures = {name.lower(): name for name in rollup["measures"]}
+        self.datetime = (rollup["datetime_column"] or "").lower()
+        self.grain = rollup["grain"]
+        self.aggregated = False
+
+    def column_name(self, node, qualifiers):
+        names = node["column_names"]
+        if len(names) > 2 or (len(names) == 2 and names[0].lower() not in qualifiers):
+            raise NotAnswerable(f"column {'.'.join(names)}")
+        return names[-1].lower()
+
+    def require_grain(self, grain):
+        if self.grain is None or grain not in DIVIDES[self.grain]:
+            raise NotAnswerable(f"{grain} grain on a {self.grain} rollup")
+
+    def is_datetime(self, node, qualifiers):
+        return (
+            node is not None and node["class"] == "COLUMN_REF" and bool(self.datetime)
+            and self.column_name(node, qualifiers) == self.datetime
+        )
+
+    def time_function(self, node, qualifiers):
+        """
+        Checks a function applied to the datetime column and returns True, or returns
+        False when the function does not involve the column directly.
+        """
+        children = node["children"]
+        datetime_children = [child for child in children if self.is_datetime(child, qualifiers)]
+        if not datetime_children:
+            return False
+        name = node["function_name"].lower()
+        if name in PART_FUNCTIONS:
+            part = constant_text(children[0]) if children else None
+            if part is None or part.lower() not in PART_GRAINS:
+                raise NotAnswerable(f"{name} of the datetime column")
+            self.require_grain(PART_GRAINS[part.lower()])
+        elif name in PART_GRAINS:
+            self.require_grain(PART_GRAINS[name])
+        elif name == "strftime" and len(children) == 2:
+            text = constant_text(children[1])
+            if text is None:
+                raise NotAnswerable("strftime format")
+            codes = [code.replace("-", "") for code in re.findall(r"%%|%-?[A-Za-z]", text) if code != "%%"]
+            grain = None
+            for code in codes:
+                if code not in dict(STRFTIME_GRAINS):
+                    raise NotAnswerable(f"strftime {code} of the datetime column")
+                grain = finer(dict(STRFTIME_GRAINS)[code], grain)
+            self.require_grain(grain or "year")
+        else:
+            raise NotAnswerable(f"{name} of the datetime column")
+        for child in children:
+            if child not in datetime_children:
+                self.check(child, qualifiers)
+        return True
+
+    def check(self, node, qualifiers, in_aggregate=False):
+        """
+        Walks an expression, raising NotAnswerable for anything the rollup cannot
+        answer exactly.
+        """
+        if node is None:
+            return
+        kind = node["class"]
+        if kind == "CONSTANT":
+            return
+        if kind == "COLUMN_REF":
+            name = self.column_name(node, qualifiers)
+            if name in self.dimensions and not in_aggregate:
+                return
+            if name == self.datetime and not in_aggregate:
+                # A bare datetime only matches when the rollup keeps its values as they are
+                if self.grain == "day" and self.rollup["datetime_type"].upper() == "DATE":
+                    return
+                raise NotAnswerable("bare datetime column")
+            if len(node["column_names"]) == 1 and name in self.aliases and name not in self.measures:
+                return
+            raise NotAnswerable(f"column {name}")
+        if kind == "FUNCTION":
+            name = node["function_name"].lower()
+            if name in self.aggregates or name == "count_star":
+                if in_aggregate or node["distinct"] or node["filter"] is not None or node["order_bys"]["orders"]:
+                    raise NotAnswerable(f"{name} aggregate")
+                if name == "count_star":
+                    self.aggregated = True
+                    return
+                if name not in ("sum", "count", "min", "max", "avg", "mean") or len(node["children"]) != 1:
+                    raise NotAnswerable(f"{name} aggregate")
+                child = node["children"][0]
+                if child["class"] != "COLUMN_REF" or self.column_name(child, qualifiers) not in self.measures:
+                    raise NotAnswerable(f"{name} of a non-measure")
+                self.aggregated = True
+                return
+            if self.time_function(node, qualifiers):
+                return
+            for child in node["children"]:
+                self.check(child, qualifiers, in_aggregate)
+            return
+        if kind == "CAST":
+            if self.is_datetime(node["child"], qualifiers):
+                if node["cast_type"]["id"] != "DATE":
+                    raise NotAnswerable("cast of the datetime column")
+                self.require_grain("day")
+                return
+            self.check(node["child"], qualifiers, in_aggregate)
+            return
+        if kind == "COMPARISON":
+            left, right, comparison = node["left"], node["right"], node["type"]
+            if self.is_datetime(right, qualifiers):
+                left, right, comparison = right, left, MIRRORED.get(comparison, comparison)
+            if self.is_datetime(left, qualifiers) and self.grain is not None:
+                text = constant_text(right)
+                if comparison in LOWER_BOUNDS | UPPER_BOUNDS and text is not None and aligned(text, self.grain):
+                    return
+            self.check(left, qualifiers, in_aggregate)
+            self.check(right, qualifiers, in_aggregate)
+            return
+        if kind in ("CONJUNCTION", "OPERATOR"):
+            for child in node["children"]:
+                self.check(child, qualifiers, in_aggregate)
+            return
+        if kind == "BETWEEN":
+            for key in ("input", "lower", "upper"):
+                self.check(node[key], qualifiers, in_aggregate)
+            return
+        if kind == "CASE":
+            for case in node["case_checks"]:
+                self.check(case["when_expr"], qualifiers, in_aggregate)
+                self.check(case["then_expr"], qualifiers, in_aggregate)
+            self.check(node["else_expr"], qualifiers, in_aggregate)
+            return
+        raise NotAnswerable(f"{kind} expression")
+
+    def rewrite(self, node, templates):
+        """
+        Replaces every aggregate of a measure with its re-aggregation over the rollup.
+        """
+        if isinstance(node, list):
+            return [self.rewrite(item, templates) for item in node]
+        if not isinstance(node, dict):
+            return node
+        if node.get("class") == "FUNCTION":
+            name = node["function_name"].lower()
+            if name == "count_star":
+                return dict(templates("__rows", "count"), alias=node["alias"])
+            if name in ("sum", "count", "min", "max", "avg", "mean") and name in self.aggregates:
+                measure = self.measures[node["children"][0]["column_names"][-1].lower()]
+                return dict(templates(measure, "avg" if name == "mean" else name), alias=node["alias"])
+        return {key: self.rewrite(value, templates) for key, value in node.items()}
+
+
+REAGGREGATIONS = {
+    "sum": 'SUM("{measure}__sum")',
+    "count": 'COALESCE(SUM("{measure}__count"), 0)::BIGINT',
+    "min": 'MIN("{measure}__min")',
+    "max": 'MAX("{measure}__max")',
+    "avg": 'SUM("{measure}__sum")::DOUBLE / SUM("{measure}__count")',
+}
+
+
+def parse(con, sql):
+    result = json.loads(con.execute("SELECT json_serialize_sql(?)", [sql]).fetchone()[0])
+    return None if result.get("error") else result
+
+
+def table_query(parsed, table_name):
+    """
+    Returns the SELECT node of a parsed query that reads a single table directly, without
+    joins, CTEs or sampling, or None for any other query.
+    """
+    if parsed is None or len(parsed["statements"]) != 1:
+        return None
+    node = parsed["statements"][0]["node"]
+    source = node.get("from_table") or {}
+    if (
+        node["type"] != "SELECT_NODE" or node["cte_map"]["map"] or source.get("type") != "BASE_TABLE"
+        or source["table_name"].lower() != table_name or source["schema_name"] or source["sample"] is not None
+        or node["sample"] is not None
+    ):
+        return None
+    return node
+
+
+def result_names(con, sql):
+    """
+    The column names of a query's result, found without running it.
+    """
+    return [column[0] for column in con.execute(f"SELECT * FROM ({sql}) AS result LIMIT 0").description]
+
+
+def aggregate_functions(con):
+    return {row[0].lower() for row in con.execute(
+        "SELECT DISTINCT function_name FROM duckdb_functions() WHERE function_type = 'aggregate'"
+    ).fetchall()}
+
+
+def route_to_rollup(con, sql, rollups, table_name="dataframe"):
+    """
+    Rewrites a validated query to read the smallest rollup that answers it exactly: a
+    single aggregating SELECT on the table whose groups and filters only use the rollup's
+    dimensions and whole days or months of its datetime column, and whose aggregates are
+    sum, count, min, max or avg of its measures.
+
+    Parameters:
+    - con: The DuckDB connection.
+    - sql: The validated query.
+    - rollups: The rollups from load_rollups.
+    - table_name: The table the rollups were built from.
+
+    Returns:
+    - str: The rewritten query, or sql itself when no rollup matches.
+    """
+    if not rollups:
+        return sql
+    try:
+        parsed = parse(con, sql)
+        node = table_query(parsed, table_name)
+        if node is None or node["qualify"] is not None or len(node["group_sets"]) > 1:
+            return sql
+        source = node["from_table"]
+        qualifiers = {table_name, (source["alias"] or table_name).lower()}
+        aliases = {item["alias"].lower() for item in node["select_list"] if item["alias"]}
+        order_expressions = [
+            order["expression"] for modifier in node["modifiers"] if modifier["type"] == "ORDER_MODIFIER"
+            for order in modifier["orders"]
+            # ORDER BY ALL
+            if not (order["expression"]["class"] == "STAR" and order["expression"].get("columns"))
+        ]
+        limits = [
+            modifier[key] for modifier in node["modifiers"] if modifier["type"] == "LIMIT_MODIFIER"
+            for key in ("limit", "offset")
+        ]
+        aggregates = aggregate_functions(con)
+        for rollup in rollups:
+            matcher = RollupMatcher(rollup, aggregates, aliases)
+            try:
+                for expression in node["select_list"] + node["group_expressions"] + order_expressions + limits:
+                    matcher.check(expression, qualifiers)
+                matcher.check(node["where_clause"], qualifiers)
+                matcher.check(node["having"], qualifiers)
+            except NotAnswerable:
+                continue
+            # Without aggregation every table row is a result row, which a rollup does not have
+            if not matcher.aggregated and not node["group_expressions"] and node["aggregate_handling"] != "FORCE_AGGREGATES":
+                continue
+
+            templates = {}
+
+            def template(measure, function):
+                key = (measure, function)
+                if key not in templates:
+                    expression = "COALESCE(SUM(\"__rows\"), 0)::BIGINT" if measure == "__rows" else \
+                        REAGGREGATIONS[function].format(measure=measure.replace('"', '""'))
+                    templates[key] = parse(con, f"SELECT {expression}")["statements"][0]["node"]["select_list"][0]
+                return templates[key]
+
+            rewritten = matcher.rewrite(node, template)
+            # Charts refer to the result columns by name, so the rewrite keeps them
+            for item, name in zip(rewritten["select_list"], result_names(con, sql)):
+                item["alias"] = name
+            # Keep the table's name as the alias, so qualified column references still bind
+            rewritten["from_table"] = dict(source, table_name=rollup["name"], alias=source["alias"] or table_name)
+            parsed["statements"][0]["node"] = rewritten
+            routed = con.execute("SELECT json_deserialize_sql(?)", [json.dumps(parsed)]).fetchone()[0]
+            print(f"Routed query to rollup {rollup['name']} ({rollup['row_count']} rows)")
+            return routed
+    except Exception as e:
+        print(f"Rollup routing skipped: {e}")
+    return sql
@@ -0,0 +1,318 @@
+"""
+Approximate answers for exploring very large uploads. A sample of the table is built
+once per dataset, stratified by a dimension so small groups keep enough rows, and each
+sampled row carries the weight of the rows it stands for. In approximate mode counts,
+sums and averages are estimated from the sample with 95% error bounds. Distinct counts
+and quantiles, which a sample does not estimate well, use DuckDB's sketches
+(approx_count_distinct, approx_quantile) on the full table instead.
+"""
+import copy
+import json
+import math
+import os
+import pandas as pd
+from ingestion import table_exists
+from rollups import aggregate_functions, parse, result_names, rollup_columns, table_query
+from sql_validation import quote_identifier
+
+# Tables smaller than this are answered exactly in approximate mode too
+APPROXIMATE_MIN_ROWS = int(os.getenv("DOCUMENTCHAT_APPROXIMATE_MIN_ROWS", "1000000"))
+SAMPLE_ROWS = int(os.getenv("DOCUMENTCHAT_SAMPLE_ROWS", "100000"))
+# Every stratum keeps at least this many rows (or all of its rows)
+MIN_STRATUM_ROWS = 200
+Z_95 = 1.96
+
+SAMPLE_TABLE = "dataframe__sample"
+
+# Estimates from the weighted sample and the half-width of their 95% confidence interval
+ESTIMATES = {
+    "count_star": 'ROUND(SUM("__weight"))::BIGINT',
+    "count": 'ROUND(SUM(CASE WHEN "__arg__" IS NULL THEN 0 ELSE "__weight" END))::BIGINT',
+    "sum": 'SUM("__weight" * "__arg__")',
+    "avg": 'SUM("__weight" * "__arg__") / SUM(CASE WHEN "__arg__" IS NULL THEN NULL ELSE "__weight" END)',
+}
+MARGINS = {
+    "count_star": f'{Z_95} * SQRT(SUM("__weight" * ("__weight" - 1)))',
+    "count": f'{Z_95} * SQRT(SUM(CASE WHEN "__arg__" IS NULL THEN 0 ELSE "__weight" * ("__weight" - 1) END))',
+    "sum": f'{Z_95} * SQRT(SUM("__weight" * ("__weight" - 1) * "__arg__" * "__arg__"))',
+    # The weighted average is a ratio of sums; its variance Σ w(w-1)(x - avg)² / (Σ w)² is
+    # expanded into plain sums since avg itself is an aggregate
+    "avg": (
+        f'{Z_95} * SQRT(GREATEST('
+        'SUM("__weight" * ("__weight" - 1) * "__arg__" * "__arg__")'
+        ' - 2 * (SUM("__weight" * "__arg__") / SUM(CASE WHEN "__arg__" IS NULL THEN NULL ELSE "__weight" END))'
+        ' * SUM("__weight" * ("__weight" - 1) * "__arg__")'
+        ' + POW(SUM("__weight" * "__arg__") / SUM(CASE WHEN "__arg__" IS NULL THEN NULL ELSE "__weight" END), 2)'
+        ' * SUM(CASE WHEN "__arg__" IS NULL THEN 0 ELSE "__weight" * ("__weight" - 1) END), 0))'
+        ' / SUM(CASE WHEN "__arg__" IS NULL THEN NULL ELSE "__weight" END)'
+    ),
+}
+QUANTILES = {"median", "quantile", "quantile_cont", "quantile_disc"}
+
+
+def build_sample(con, row_count, columns, table_name="dataframe", sample_rows=SAMPLE_ROWS):
+    """
+    Builds the sample of a table once, unless it exists already. With a low-cardinality
+    dimension the sample is stratified by it: each row is kept with a probability that is
+    raised for small strata, and weighted by its inverse. Without one it is a reservoir
+    sample of sample_rows rows, each weighted by the sampling ratio.
+
+    Parameters:
+    - con: A writable DuckDB connection holding the table.
+    - row_count / columns: The output of schema_summary.summarize_table for the table.
+    - table_name: The table to sample.
+    - sample_rows: The approximate size of the sample.
+
+    Returns:
+    - The sample, as returned by load_sample, or None for small tables.
+    """
+    if table_exists(con, SAMPLE_TABLE) or row_count < APPROXIMATE_MIN_ROWS:
+        return load_sample(con)
+    dimensions, _, _ = rollup_columns(columns)
+    fraction = sample_rows / row_count
+    table = quote_identifier(table_name)
+    if dimensions:
+        # The coarsest dimension (fewest groups, at least two): the groups questions most
+        # often compare, each kept at MIN_STRATUM_ROWS or more rows, without the per-group
+        # floor inflating the sample as it would for a dimension of ~100 groups
+        stratum_name = dimensions[0]["name"]
+        stratum = quote_identifier(stratum_name)
+        con.execute("SELECT setseed(0.42)")
+        con.execute(
+            f'CREATE OR REPLACE TABLE "{SAMPLE_TABLE}" AS '
+            f'SELECT * EXCLUDE (__draw, __probability), 1.0 / __probability AS "__weight" FROM ('
+            f"  SELECT data.*, random() AS __draw,"
+            f"  LEAST(1.0, GREATEST({fraction}::DOUBLE, {MIN_STRATUM_ROWS} / strata.size)) AS __probability"
+            f"  FROM {table} AS data JOIN (SELECT {stratum} AS value, COUNT(*) AS size FROM {table} GROUP BY 1) AS strata"
+            f"  ON data.{stratum} IS NOT DISTINCT FROM strata.value"
+            # Drawn per table row; a bare random() filter would be pushed into the strata
+            f") WHERE __draw < __probability"
+        )
+        con.execute(f"COMMENT ON TABLE \"{SAMPLE_TABLE}\" IS {quote_literal(json.dumps({'stratum': stratum_name}))}")
+    else:
+        con.execute(
+            f'CREATE OR REPLACE TABLE "{SAMPLE_TABLE}" AS '
+            f'SELECT *, {row_count / sample_rows}::DOUBLE AS "__weight" FROM {table} '
+            f"USING SAMPLE reservoir({int(sample_rows)} ROWS) REPEATABLE (42)"
+        )
+    sample = load_sample(con)
+    print(f"Built sample {SAMPLE_TABLE}: {sample['rows']} of {row_count} rows")
+    return sample
+
+
+def quote_literal(text):
+    return "'" + text.replace("'", "''") + "'"
+
+
+def load_sample(con):
+    """
+    Returns the size of the connection's sample, the number of rows it stands for and the
+    column it is stratified by, or None when there is no sample.
+    """
+    if not table_exists(con, SAMPLE_TABLE):
+        return None
+    rows, weight = con.execute(f'SELECT COUNT(*), SUM("__weight") FROM "{SAMPLE_TABLE}"').fetchone()
+    comment = con.execute(
+        "SELECT comment FROM duckdb_tables() WHERE table_name = ? AND schema_name = current_schema()", [SAMPLE_TABLE]
+    ).fetchone()
+    stratum = json.loads(comment[0]).get("stratum") if comment and comment[0] else None
+    return {"name": SAMPLE_TABLE, "rows": rows, "row_count": round(weight or 0), "stratum": stratum}
+
+
+def expression(con, text, **arguments):
+    """
+    Parses an expression, replacing the columns named in arguments with expression nodes.
+    """
+    node = parse(con, f"SELECT {text}")["statements"][0]["node"]["select_list"][0]
+    return substitute(node, arguments)
+
+
+def substitute(value, arguments):
+    if isinstance(value, list):
+        return [substitute(item, arguments) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if value.get("class") == "COLUMN_REF" and len(value["column_names"]) == 1 and value["column_names"][0] in arguments:
+        return copy.deepcopy(arguments[value["column_names"][0]])
+    return {key: substitute(item, arguments) for key, item in value.items()}
+
+
+def aggregate_calls(value, aggregates, calls):
+    """
+    Collects the aggregate calls in an expression tree. Returns False when it holds a
+    subquery or window function, which are left exact.
+    """
+    if isinstance(value, list):
+        return all(aggregate_calls(item, aggregates, calls) for item in value)
+    if not isinstance(value, dict):
+        return True
+    if value.get("class") in ("SUBQUERY", "WINDOW"):
+        return False
+    if value.get("class") == "FUNCTION" and value["function_name"].lower() in aggregates | {"count_star"}:
+        calls.append(value)
+    return all(aggregate_calls(item, aggregates, calls) for item in value.values())
+
+
+def function_key(call):
+    name = call["function_name"].lower()
+    return "avg" if name == "mean" else name
+
+
+def on_sample(call):
+    """
+    Whether the weighted sample answers an aggregate call.
+    """
+    name = function_key(call)
+    if call["distinct"] or call["filter"] is not None or call["order_bys"]["orders"]:
+        return False
+    if name == "count_star":
+        return True
+    # Minima and maxima of a sample miss the extremes of the table, so they are exact
+    return len(call["children"]) == 1 and name in ESTIMATES
+
+
+def sketch(con, call):
+    """
+    Returns the sketch that replaces an exact distinct count or quantile, or None.
+    """
+    name = function_key(call)
+    children = call["children"]
+    if call["filter"] is not None or not children:
+        return None
+    if name == "count" and call["distinct"] and len(children) == 1:
+        return expression(con, 'approx_count_distinct("__arg__")', __arg__=children[0])
+    if call["distinct"]:
+        return None
+    if name == "median" and len(children) == 1:
+        return expression(con, 'approx_quantile("__arg__", 0.5)', __arg__=children[0])
+    if name in QUANTILES and len(children) == 2 and children[1]["class"] == "CONSTANT":
+        return expression(con, 'approx_quantile("__arg__", "__q__")', __arg__=children[0], __q__=children[1])
+    return None
+
+
+def replace_calls(value, replacements):
+    if isinstance(value, list):
+        return [replace_calls(item, replacements) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if id(value) in replacements:
+        return replacements[id(value)]
+    return {key: replace_calls(item, replacements) for key, item in value.items()}
+
+
+def approximate_query(con, sql, sample, table_name="dataframe"):
+    """
+    Rewrites a validated query for approximate mode. Aggregations of counts, sums and
+    averages read the weighted sample, with an extra column holding the 95% margin of
+    error of each in the select list. Otherwise exact distinct counts and quantiles are
+    replaced by sketches on the full table, and anything else (e.g. minima and maxima)
+    is answered exactly.
+
+    Parameters:
+    - con: The DuckDB connection.
+    - sql: The validated query.
+    - sample: The sample from load_sample, or None for tables too small to approximate,
+      whose queries are answered exactly.
+    - table_name: The table the sample was drawn from.
+
+    Returns:
+    - A tuple of the query to run and a dictionary describing the approximation, or of
+      sql itself and None when the query is answered exactly.
+    """
+    if sample is None:
+        return sql, None
+    try:
+        parsed = parse(con, sql)
+        node = table_query(parsed, table_name)
+        if node is None:
+            return sql, None
+        aggregates = aggregate_functions(con)
+        calls = []
+        if not aggregate_calls(node, aggregates, calls) or not calls:
+            # Listing rows is no faster on a sample, and is answered exactly
+            return sql, None
+        names = result_names(con, sql)
+
+        if all(on_sample(call) for call in calls):
+            replacements = {}
+            for call in calls:
+                key = function_key(call)
+                if key in ESTIMATES:
+                    arguments = {"__arg__": call["children"][0]} if call["children"] else {}
+                    replacements[id(call)] = expression(con, ESTIMATES[key], **arguments)
+            margins = {}
+            margin_items = []
+            for index, (item, name) in enumerate(zip(node["select_list"], names)):
+                if item.get("class") == "FUNCTION" and function_key(item) in MARGINS and id(item) in replacements:
+                    arguments = {"__arg__": item["children"][0]} if item["children"] else {}
+                    margin = dict(expression(con, MARGINS[function_key(item)], **arguments), alias=f"__margin_{index}")
+                    margins[name] = margin["alias"]
+                    margin_items.append(margin)
+            rewritten = replace_calls(node, replacements)
+            for item, name in zip(rewritten["select_list"], names):
+                item["alias"] = name
+            rewritten["select_list"] += margin_items
+            source = rewritten["from_table"]
+            rewritten["from_table"] = dict(source, table_name=sample["name"], alias=source["alias"] or table_name)
+            info = {
+                "method": "sample", "sample_rows": sample["rows"], "row_count": sample["row_count"],
+                "stratum": sample["stratum"], "margins": margins,
+            }
+        else:
+            replacements = {id(call): replacement for call in calls if (replacement := sketch(con, call)) is not None}
+            if not replacements:
+                return sql, None
+            rewritten = replace_calls(node, replacements)
+            for item, name in zip(rewritten["select_list"], names):
+                item["alias"] = name
+            functions = {"count distinct" if call["distinct"] else function_key(call) for call in calls if id(call) in replacements}
+            info = {"method": "sketch", "functions": sorted(functions)}
+
+        parsed["statements"][0]["node"] = rewritten
+        approximate = con.execute("SELECT json_deserialize_sql(?)", [json.dumps(parsed)]).fetchone()[0]
+        print(f"Approximate query ({info['method']}):\n{approximate}")
+        return approximate, info
+    except Exception as e:
+        print(f"Approximate rewrite skipped: {e}")
+        return sql, None
+
+
+def attach_error_bounds(data, info):
+    """
+    Moves the margin columns of an approximate result into its attrs, as the largest
+    relative 95% error bound of each estimated column across the fetched rows.
+    """
+    bounds = {}
+    for column, margin in info.get("margins", {}).items():
+        if column not in data.columns or margin not in data.columns:
+            continue
+        estimate = pd.to_numeric(data[column], errors="coerce").abs()
+        relative = (pd.to_numeric(data[margin], errors="coerce") / estimate.where(estimate > 0)).dropna()
+        bounds[column] = float(relative.max()) if len(relative) else None
+    data.drop(columns=[margin for margin in info.get("margins", {}).values() if margin in data.columns], inplace=True)
+    data.attrs["approximate"] = dict({key: value for key, value in info.items() if key != "margins"}, error_bounds=bounds)
+    return data
+
+
+def describe_approximation(info):
+    """
+    One or two sentences on how an approximate result was computed and how far off it
+    may be, for the explanation and the caption under the result.
+    """
+    if info["method"] == "sketch":
+        # DuckDB's HyperLogLog and t-digest sketches give no error guarantee: distinct
+        # counts can be off by tens of percent
+        return (
+            f"Approximate answer: {', '.join(info['functions'])} computed with sketches "
+            "(approx_count_distinct, approx_quantile) over the full table. These estimates have no error bound "
+            "and can be far off, e.g. distinct counts by tens of percent; run the question exactly for exact figures."
+        )
+    kind = f"sample stratified by {info['stratum']}" if info.get("stratum") else "uniform sample"
+    text = f"Approximate answer from a {kind} of {info['sample_rows']:,} of about {info['row_count']:,} rows."
+    bounds = [
+        f"{column} ±{bound:.1%}" for column, bound in info.get("error_bounds", {}).items()
+        if bound is not None and math.isfinite(bound)
+    ]
+    if bounds:
+        text += f" 95% error bounds (largest across rows): {', '.join(bounds)}."
+    return text
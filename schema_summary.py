@@ -0,0 +1,129 @@
+import math
+
+# Upper bound on the tokens a table description may take in a prompt
+METADATA_TOKEN_BUDGET = 1500
+SAMPLE_VALUES = 3
+SAMPLE_ROWS = 1000
+MAX_VALUE_LENGTH = 40
+
+
+def estimate_tokens(text):
+    # About four characters per token for English text and identifiers
+    return math.ceil(len(text) / 4)
+
+
+def shorten(value, length=MAX_VALUE_LENGTH):
+    text = str(value)
+    return text if len(text) <= length else text[:length - 3] + "..."
+
+
+def summarize_table(con, table_name):
+    """
+    Profiles every column of a table in a single DuckDB SUMMARIZE pass.
+
+    Parameters:
+    - con: The DuckDB connection holding the table.
+    - table_name: The table or view to profile.
+
+    Returns:
+    - A tuple of the row count and a list of per-column dictionaries with the name, type,
+      null percentage, approximate distinct count, min, max and a few sample values.
+    """
+    summary = con.execute(f'SUMMARIZE "{table_name}"').fetchdf()
+    sample = con.execute(f'SELECT * FROM "{table_name}" LIMIT {SAMPLE_ROWS}').fetchdf()
+    row_count = int(summary["count"].iloc[0]) if len(summary) else 0
+
+    columns = []
+    for row in summary.itertuples(index=False):
+        samples = []
+        if row.column_name in sample.columns:
+            samples = [shorten(value) for value in sample[row.column_name].dropna().unique()[:SAMPLE_VALUES]]
+        columns.append({
+            "name": row.column_name,
+            "type": row.column_type,
+            "null_percentage": float(row.null_percentage) if row.null_percentage is not None else 0.0,
+            "distinct": int(row.approx_unique) if row.approx_unique is not None else None,
+            "min": row.min,
+            "max": row.max,
+            "samples": samples,
+        })
+    return row_count, columns
+
+
+def describe_column(column, detail):
+    """
+    Formats one column at a level of detail: 2 is everything, 1 drops the sample values
+    and 0 keeps only the name and type.
+    """
+    text = f"- {column['name']} ({column['type']})"
+    if detail >= 1:
+        text += f" nulls={column['null_percentage']:.1f}% distinct~{column['distinct']}"
+        if column["min"] is not None:
+            text += f" range=[{shorten(column['min'])}, {shorten(column['max'])}]"
+    if detail >= 2 and column["samples"]:
+        text += " e.g. " + ", ".join(column["samples"])
+    return text
+
+
+def format_summary(table_name, row_count, columns, token_budget=METADATA_TOKEN_BUDGET):
+    """
+    Renders a table profile as prompt text that fits the token budget, dropping sample
+    values, then statistics, then trailing columns until it does.
+
+    Parameters:
+    - table_name: The table name shown in the header.
+    - row_count: The number of rows in the table.
+    - columns: The column profiles from summarize_table.
+    - token_budget: The maximum size of the description in estimated tokens.
+
+    Returns:
+    - str: The table description.
+    """
+    header = f"Table '{table_name}': {row_count} rows, {len(columns)} columns"
+    for detail in (2, 1, 0):
+        text = "\n".join([header] + [describe_column(column, detail) for column in columns])
+        if estimate_tokens(text) <= token_budget:
+            return text
+
+    lines, used = [header], estimate_tokens(header)
+    for index, column in enumerate(columns):
+        line = describe_column(column, 0)
+        # Keep room for the note about the omitted columns
+        if used + estimate_tokens(line) + 10 > token_budget:
+            lines.append(f"... and {len(columns) - index} more columns")
+            break
+        lines.append(line)
+        used += estimate_tokens(line) + 1
+    return "\n".join(lines)
+
+
+def describe_table(con, table_name="dataframe", token_budget=METADATA_TOKEN_BUDGET):
+    """
+    Builds the token-budgeted description of a table used as metadata in every prompt.
+    It is computed once per dataset and stored in the session state (and the on-disk
+    cache) rather than per request.
+
+    Parameters:
+    - con: The DuckDB connection holding the table.
+    - table_name: The table or view to describe.
+    - token_budget: The maximum size of the description in estimated tokens.
+
+    Returns:
+    - str: The table description.
+    """
+    row_count, columns = summarize_table(con, table_name)
+    return format_summary(table_name, row_count, columns, token_budget)
+
+
+def metadata_context(session_state, forecasting, main_metadata=None):
+    """
+    Returns the retrieved context shared by the prompt builders: the description of the
+    main table (or main_metadata in its place) and, when forecasting, of the forecast table.
+    """
+    main_metadata = main_metadata or session_state.metadata
+    if forecasting:
+        return (
+            f"Main DataFrame Metadata:\n{main_metadata}\n\n"
+            f"Forecast DataFrame Metadata:\n{session_state.forecast_metadata}"
+        )
+    return f"Main DataFrame Metadata:\n{main_metadata}"
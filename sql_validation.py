@@ -0,0 +1,176 @@
+import difflib
+import re
+import duckdb
+
+# Local repairs tried before a query goes back to the LLM
+MAX_LOCAL_FIXES = 5
+
+STRING_LITERAL = re.compile(r"('(?:[^']|'')*')")
+SIMPLE_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class SQLValidationError(Exception):
+    """
+    Raised when a query does not bind against the registered tables and cannot be
+    repaired locally. The message carries DuckDB's error and the closest valid names.
+    """
+
+
+def outside_strings(sql, function):
+    """
+    Applies function to the parts of a query outside single-quoted string literals.
+    """
+    parts = STRING_LITERAL.split(sql)
+    return "".join(part if index % 2 else function(part) for index, part in enumerate(parts))
+
+
+def strip_fences(sql):
+    """
+    Removes what clean_query leaves behind: inline fences, a language tag or label on the
+    first line, surrounding quotes and trailing semicolons.
+    """
+    sql = sql.strip()
+    sql = re.sub(r"^`+\s*(?:sql|duckdb)?\s*", "", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"`{3,}\s*$", "", sql)
+    sql = re.sub(r"^(?:sql|query|duckdb)\s*:\s*", "", sql, flags=re.IGNORECASE)
+    if len(sql) > 1 and sql[0] == sql[-1] and sql[0] in "\"'" and " " in sql:
+        sql = sql[1:-1]
+    return sql.strip().rstrip(";").strip()
+
+
+def table_columns(con, table_names):
+    """
+    Returns the column names of each table as seen by the connection.
+    """
+    return {table: [row[0] for row in con.execute(f'DESCRIBE "{table}"').fetchall()] for table in table_names}
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def normalize_identifier(name):
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def quote_identifiers(sql, columns):
+    """
+    Turns MySQL-style backtick quoting into double quotes and quotes column names that
+    need it (spaces, punctuation) wherever they appear bare.
+    """
+    sql = outside_strings(sql, lambda part: re.sub(r"`([^`]+)`", lambda m: quote_identifier(m.group(1)), part))
+    for name in sorted({name for names in columns.values() for name in names}, key=len, reverse=True):
+        if SIMPLE_IDENTIFIER.match(name):
+            continue
+        pattern = re.compile(r'(?<![\w"])' + re.escape(name) + r'(?![\w"])')
+        sql = outside_strings(sql, lambda part: pattern.sub(quote_identifier(name), part))
+    return sql
+
+
+def replace_identifier(sql, wrong, right):
+    """
+    Replaces an identifier, quoted or bare and in any case, outside string literals.
+    """
+    quoted = re.compile(r'"' + re.escape(wrong) + r'"', re.IGNORECASE)
+    bare = re.compile(r'(?<![\w"])' + re.escape(wrong) + r'(?![\w"])', re.IGNORECASE)
+    return outside_strings(sql, lambda part: bare.sub(right, quoted.sub(right, part)))
+
+
+def explain_error(con, sql):
+    """
+    Binds and plans a query with EXPLAIN, without reading any data.
+
+    Returns:
+    - The DuckDB error message, or None when the query is valid.
+    """
+    try:
+        con.execute(f"EXPLAIN {sql}")
+        return None
+    except duckdb.Error as e:
+        message = str(e)
+        if "LINE 1: EXPLAIN " in message:
+            # Point the caret at the query the LLM wrote, not the EXPLAIN wrapper
+            message = message.replace("LINE 1: EXPLAIN ", "LINE 1: ")
+            message = re.sub(r"\n {8}( *\^)", r"\n\1", message)
+        return message
+
+
+def repair(sql, error, columns):
+    """
+    Fixes a query locally when the error names an identifier with an unambiguous
+    replacement: a table that only differs by case or a near miss, or a column that
+    matches an existing column once case, spaces and punctuation are ignored.
+
+    Returns:
+    - The repaired query, or None when there is no safe fix.
+    """
+    tables = list(columns)
+    match = re.search(r'Table with name "?([^"!\s]+)"? does not exist', error)
+    if match:
+        suggestion = re.search(r'Did you mean "([^"]+)"', error)
+        if suggestion and suggestion.group(1) in tables:
+            return replace_identifier(sql, match.group(1), suggestion.group(1))
+        candidates = difflib.get_close_matches(match.group(1).lower(), tables, n=1, cutoff=0.6)
+        return replace_identifier(sql, match.group(1), candidates[0]) if candidates else None
+
+    match = (
+        re.search(r'Referenced column "([^"]+)" not found', error)
+        or re.search(r'does not have a column named "([^"]+)"', error)
+    )
+    if match:
+        wanted = normalize_identifier(match.group(1))
+        candidates = {name for names in columns.values() for name in names if normalize_identifier(name) == wanted}
+        if len(candidates) == 1:
+            return replace_identifier(sql, match.group(1), quote_identifier(candidates.pop()))
+    return None
+
+
+def explain_for_llm(error, columns):
+    """
+    Adds the closest valid names to a binder or catalog error, for the correction prompt.
+    """
+    match = (
+        re.search(r'Referenced column "([^"]+)" not found', error)
+        or re.search(r'does not have a column named "([^"]+)"', error)
+    )
+    if match:
+        names = [name for names in columns.values() for name in names]
+        close = difflib.get_close_matches(match.group(1), names, n=5, cutoff=0.4)
+        if close:
+            return f"{error}\nClosest existing columns: {', '.join(quote_identifier(name) for name in close)}"
+    if "Table with name" in error:
+        return f"{error}\nAvailable tables: {', '.join(columns)}"
+    return error
+
+
+def validate_sql(con, sql, table_names):
+    """
+    Checks a generated query against the registered schema before it runs, repairing
+    trivial problems locally.
+
+    Parameters:
+    - con: The DuckDB connection with the registered tables.
+    - sql: The query, after clean_query.
+    - table_names: The tables the query may use.
+
+    Returns:
+    - str: A query that binds, possibly repaired.
+
+    Raises:
+    - SQLValidationError: With the precise error when the query cannot be repaired locally.
+    """
+    columns = table_columns(con, table_names)
+    sql = quote_identifiers(strip_fences(sql), columns)
+    error = explain_error(con, sql)
+    fixes = 0
+    while error is not None and fixes < MAX_LOCAL_FIXES:
+        repaired = repair(sql, error, columns)
+        if repaired is None or repaired == sql:
+            break
+        print(f"Repaired query locally after: {error.splitlines()[0]}")
+        sql = repaired
+        fixes += 1
+        error = explain_error(con, sql)
+    if error is None:
+        return sql
+    raise SQLValidationError(explain_for_llm(error, columns))
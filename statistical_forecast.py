@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+
+
+def _infer_season(time_diff):
+    """
+    Infers a seasonal period from the spacing of the time series.
+
+    Parameters:
+    - time_diff: The time difference between consecutive observations.
+
+    Returns:
+    - int: The number of observations in one season (1 when no season is recognised).
+    """
+    if time_diff <= pd.Timedelta(hours=1):
+        return 24
+    if time_diff <= pd.Timedelta(days=1):
+        return 7
+    if time_diff <= pd.Timedelta(days=7):
+        return 52
+    if time_diff <= pd.Timedelta(days=31):
+        return 12
+    if time_diff <= pd.Timedelta(days=92):
+        return 4
+    return 1
+
+
+def seasonal_naive(values, season):
+    """
+    One-step-ahead seasonal naive forecasts for every target position.
+
+    Parameters:
+    - values: np.ndarray of shape (n, m) with one column per numeric series.
+    - season: The seasonal period in observations.
+
+    Returns:
+    - np.ndarray of shape (n - 1, m): forecasts for positions 2..n, where position n is one step past the data.
+    """
+    positions = np.arange(2, len(values) + 1)
+    source = positions - season
+    # Fall back to the last observation until a full season of history exists
+    source = np.where(source >= 0, source, positions - 1)
+    return values[source]
+
+
+def exponential_smoothing(values, alpha=0.3):
+    """
+    One-step-ahead simple exponential smoothing forecasts for every target position.
+
+    Parameters:
+    - values: np.ndarray of shape (n, m) with one column per numeric series.
+    - alpha: The smoothing factor.
+
+    Returns:
+    - np.ndarray of shape (n - 1, m): forecasts for positions 2..n.
+    """
+    level = pd.DataFrame(values).ewm(alpha=alpha, adjust=False).mean().to_numpy()
+    # The forecast for position i is the level after observing position i - 1
+    return level[1:]
+
+
+def linear_trend(values, x, x_next):
+    """
+    One-step-ahead least-squares linear trend forecasts for every target position,
+    fitted on the expanding prefix before each target using cumulative sums.
+
+    Parameters:
+    - values: np.ndarray of shape (n, m) with one column per numeric series.
+    - x: np.ndarray of shape (n,) with the time of each observation in steps.
+    - x_next: The time of the step past the end of the data.
+
+    Returns:
+    - np.ndarray of shape (n - 1, m): forecasts for positions 2..n.
+    """
+    count = np.arange(1, len(x) + 1, dtype=float)[:, None]
+    sum_x = np.cumsum(x)[:, None]
+    sum_xx = np.cumsum(x * x)[:, None]
+    sum_y = np.cumsum(values, axis=0)
+    sum_xy = np.cumsum(values * x[:, None], axis=0)
+
+    # Prefixes of length 2..n predict positions 2..n
+    count, sum_x, sum_xx, sum_y, sum_xy = (
+        arr[1:] for arr in (count, sum_x, sum_xx, sum_y, sum_xy)
+    )
+    denominator = count * sum_xx - sum_x ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(denominator != 0, (count * sum_xy - sum_x * sum_y) / denominator, 0.0)
+    intercept = (sum_y - slope * sum_x) / count
+    x_target = np.append(x[2:], x_next)[:, None]
+    return intercept + slope * x_target
+
+
+forecast_methods = {
+    "exponential_smoothing": "Exponential smoothing",
+    "seasonal_naive": "Seasonal naive",
+    "linear_trend": "Linear trend",
+}
+
+
+def statistical_forecasting(df, datetime_column, method="exponential_smoothing", season=None, alpha=0.3):
+    """
+    Produces the same one-step-ahead forecasts as iterative_forecasting, computed
+    in-process for every numeric column at once.
+
+    Parameters:
+        df (pd.DataFrame): The input DataFrame containing the time series data.
+        datetime_column (str): The name of the datetime column.
+        method (str): One of the keys of forecast_methods.
+        season (int): The seasonal period for seasonal_naive, inferred from the spacing when None.
+        alpha (float): The smoothing factor for exponential_smoothing.
+
+    Returns:
+        pd.DataFrame: A DataFrame containing the forecasted results for each step.
+    """
+    if method not in forecast_methods:
+        raise ValueError(f"Unknown forecasting method: {method}")
+
+    # Ensure the DataFrame is sorted by the datetime column
+    df[datetime_column] = pd.to_datetime(df[datetime_column])
+    df.sort_values(by=datetime_column, inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    timestamps = df[datetime_column]
+    time_diff = timestamps.iloc[-1] - timestamps.iloc[-2]
+
+    forecast_columns = [column for column in df.columns if column != datetime_column]
+    numeric_columns = [
+        column for column in df.select_dtypes(include="number").columns
+        if column != datetime_column
+    ]
+    values = df[numeric_columns].ffill().bfill().fillna(0).to_numpy(dtype=float)
+
+    if method == "seasonal_naive":
+        predicted = seasonal_naive(values, season or _infer_season(time_diff))
+    elif method == "exponential_smoothing":
+        predicted = exponential_smoothing(values, alpha)
+    else:
+        step = time_diff if time_diff > pd.Timedelta(0) else pd.Timedelta(seconds=1)
+        x = ((timestamps - timestamps.iloc[0]) / step).to_numpy(dtype=float)
+        predicted = linear_trend(values, x, x[-1] + 1)
+
+    forecast_df = pd.DataFrame(predicted, columns=numeric_columns)
+    # Non-numeric columns carry the last observed value forward
+    for column in forecast_columns:
+        if column not in numeric_columns:
+            forecast_df[column] = df[column].iloc[1:].to_numpy()
+    forecast_df = forecast_df[forecast_columns]
+    forecast_df["forecast_time"] = list(timestamps.iloc[2:]) + [timestamps.iloc[-1] + time_diff]
+    return forecast_df
@@ -0,0 +1,333 @@
+"""
+Per-stage instrumentation of LLM calls: wall time, token usage, retries and cache hits.
+
+InstrumentedClient wraps any client exposing chat.completions.create. Calls are
+attributed to the stage set with `with stage("sql"):`, or to the calling function's
+name when no stage is set. Metrics are kept per process and exported in the
+Prometheus text format (optionally on DOCUMENTCHAT_METRICS_PORT) and, when
+opentelemetry is installed, as spans.
+"""
+import contextvars
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+try:
+    from opentelemetry import trace as _otel_trace
+    _tracer = _otel_trace.get_tracer("documentchat")
+except ImportError:
+    _tracer = None
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_stage = contextvars.ContextVar("stage", default=None)
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_retry = contextvars.ContextVar("retry", default=False)
+
+
+class StageMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.seconds = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.streams = 0
+        self.first_token_seconds = 0.0
+
+
+class Metrics:
+    """
+    Process-wide per-stage counters and a bounded log of recent spans.
+    """
+
+    def __init__(self, max_spans=2000):
+        self.stages = {}
+        self.spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def _stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageMetrics()
+        return self.stages[name]
+
+    def record_call(self, name, seconds, prompt_tokens=0, completion_tokens=0, retry=False, error=False,
+                    first_token_seconds=None, trace_id=None):
+        with self._lock:
+            metrics = self._stage(name)
+            metrics.calls += 1
+            if first_token_seconds is not None:
+                metrics.streams += 1
+                metrics.first_token_seconds += first_token_seconds
+            metrics.errors += int(error)
+            metrics.retries += int(retry)
+            metrics.seconds += seconds
+            metrics.prompt_tokens += prompt_tokens
+            metrics.completion_tokens += completion_tokens
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    metrics.buckets[index] += 1
+            self.spans.append({
+                "trace_id": trace_id or _trace_id.get(), "stage": name, "seconds": seconds,
+                "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "retry": retry, "error": error, "cache_hit": False, "end": time.time(),
+                "first_token_seconds": first_token_seconds,
+            })
+
+    def record_retry(self, name):
+        with self._lock:
+            self._stage(name).retries += 1
+
+    def record_cache_hit(self, name):
+        with self._lock:
+            self._stage(name).cache_hits += 1
+            self.spans.append({
+                "trace_id": _trace_id.get(), "stage": name, "seconds": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0,
+                "retry": False, "error": False, "cache_hit": True, "end": time.time(),
+            })
+
+    def trace(self, trace_id):
+        """
+        Returns the spans recorded for one trace, oldest first.
+        """
+        with self._lock:
+            return [span for span in self.spans if span["trace_id"] == trace_id]
+
+    def since(self, timestamp):
+        """
+        Returns the spans that ended at or after a time.time() timestamp, oldest first.
+        """
+        with self._lock:
+            return [span for span in self.spans if span["end"] >= timestamp]
+
+    def render_prometheus(self):
+        """
+        Renders the per-stage metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        counters = (
+            ("llm_calls_total", "calls", "Chat completion calls"),
+            ("llm_errors_total", "errors", "Chat completion calls that raised"),
+            ("llm_retries_total", "retries", "Chat completion calls that retried an earlier call"),
+            ("llm_cache_hits_total", "cache_hits", "Answers served from a cache instead of a call"),
+            ("llm_prompt_tokens_total", "prompt_tokens", "Prompt tokens"),
+            ("llm_completion_tokens_total", "completion_tokens", "Completion tokens"),
+        )
+        with self._lock:
+            stages = sorted(self.stages.items())
+            for metric, attribute, help_text in counters:
+                lines.append(f"# HELP documentchat_{metric} {help_text}")
+                lines.append(f"# TYPE documentchat_{metric} counter")
+                for name, metrics in stages:
+                    lines.append(f'documentchat_{metric}{{stage="{name}"}} {getattr(metrics, attribute)}')
+            lines.append("# HELP documentchat_llm_call_seconds Wall time of chat completion calls")
+            lines.append("# TYPE documentchat_llm_call_seconds histogram")
+            for name, metrics in stages:
+                for bound, count in zip(LATENCY_BUCKETS, metrics.buckets):
+                    lines.append(f'documentchat_llm_call_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+                lines.append(f'documentchat_llm_call_seconds_bucket{{stage="{name}",le="+Inf"}} {metrics.calls}')
+                lines.append(f'documentchat_llm_call_seconds_sum{{stage="{name}"}} {metrics.seconds}')
+                lines.append(f'documentchat_llm_call_seconds_count{{stage="{name}"}} {metrics.calls}')
+            lines.append("# HELP documentchat_llm_first_token_seconds Time to the first content token of streamed calls")
+            lines.append("# TYPE documentchat_llm_first_token_seconds summary")
+            for name, metrics in stages:
+                lines.append(f'documentchat_llm_first_token_seconds_sum{{stage="{name}"}} {metrics.first_token_seconds}')
+                lines.append(f'documentchat_llm_first_token_seconds_count{{stage="{name}"}} {metrics.streams}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def stage(name):
+    """
+    Attributes the LLM calls and cache hits made inside the block to a stage.
+    """
+    token = _stage.set(name)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+@contextmanager
+def retrying(retry=True):
+    """
+    Marks the LLM calls made inside the block as retries of an earlier call, e.g. in the
+    second and later iterations of a retry loop: `with retrying(attempt > 0):`.
+    """
+    token = _retry.set(retry)
+    try:
+        yield
+    finally:
+        _retry.reset(token)
+
+
+@contextmanager
+def trace():
+    """
+    Groups the spans recorded inside the block, e.g. everything for one answer.
+
+    Yields:
+    - str: The trace id, see Metrics.trace.
+    """
+    trace_id = uuid.uuid4().hex
+    token = _trace_id.set(trace_id)
+    try:
+        yield trace_id
+    finally:
+        _trace_id.reset(token)
+
+
+def current_stage(default=None):
+    return _stage.get() or default
+
+
+def record_cache_hit(name=None):
+    metrics.record_cache_hit(current_stage(name or "unknown"))
+
+
+def record_retry(name=None):
+    metrics.record_retry(current_stage(name or "unknown"))
+
+
+def run_in_stage(name, function, *args, **kwargs):
+    """
+    Calls function inside stage(name); convenient for executor.submit.
+    """
+    with stage(name):
+        return function(*args, **kwargs)
+
+
+def submit(executor, name, function, *args, **kwargs):
+    """
+    Submits function to an executor inside stage(name), carrying the caller's trace over
+    to the worker thread.
+    """
+    context = contextvars.copy_context()
+    return executor.submit(context.run, run_in_stage, name, function, *args, **kwargs)
+
+
+class InstrumentedClient:
+    """
+    Wraps a client and records every chat completion in metrics.
+
+    A call made inside a retrying() block is counted as a retry. A streamed call
+    (stream=True) is recorded once its stream is consumed or closed.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _create(self, **kwargs):
+        name = current_stage(sys._getframe(1).f_code.co_name)
+        retry = _retry.get()
+
+        span = _tracer.start_as_current_span(f"llm.{name}") if _tracer else None
+        if span is not None:
+            otel_span = span.__enter__()
+        start = time.perf_counter()
+        error = False
+        streaming = False
+        response = None
+        # Lets the wrapped client attribute its own transport retries to this stage
+        stage_token = _stage.set(name)
+        try:
+            response = self._client.chat.completions.create(**kwargs)
+            if kwargs.get("stream"):
+                streaming = True
+                return self._stream(response, name, start, retry, _trace_id.get())
+            return response
+        except Exception:
+            error = True
+            raise
+        finally:
+            _stage.reset(stage_token)
+            seconds = time.perf_counter() - start
+            usage = getattr(response, "usage", None)
+            prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+            completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+            if not streaming:
+                metrics.record_call(name, seconds, prompt_tokens, completion_tokens, retry=retry, error=error)
+            if span is not None:
+                # For a streamed call the span covers opening the stream
+                otel_span.set_attribute("llm.stage", name)
+                otel_span.set_attribute("llm.model", kwargs.get("model", ""))
+                otel_span.set_attribute("llm.prompt_tokens", prompt_tokens)
+                otel_span.set_attribute("llm.completion_tokens", completion_tokens)
+                otel_span.set_attribute("llm.retry", retry)
+                otel_span.set_attribute("llm.stream", streaming)
+                span.__exit__(*sys.exc_info())
+
+    def _stream(self, stream, name, start, retry, trace_id):
+        """
+        Passes the chunks of a streamed completion through and records the call when the
+        stream ends: its total time, the time to the first content token and, if the
+        request set stream_options={"include_usage": True}, the usage of the last chunk.
+        """
+        first_token_seconds = None
+        usage = None
+        error = False
+        try:
+            for chunk in stream:
+                if first_token_seconds is None and chunk.choices and chunk.choices[0].delta.content:
+                    first_token_seconds = time.perf_counter() - start
+                usage = getattr(chunk, "usage", None) or usage
+                yield chunk
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.record_call(
+                name, time.perf_counter() - start,
+                getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0,
+                retry=retry, error=error, first_token_seconds=first_token_seconds, trace_id=trace_id,
+            )
+
+
+_metrics_server = None
+
+
+def start_metrics_server(port=None, host="0.0.0.0"):
+    """
+    Serves metrics.render_prometheus() at /metrics on a daemon thread, once per process.
+
+    Parameters:
+    - port: The port to listen on, DOCUMENTCHAT_METRICS_PORT by default; nothing is started without one.
+    """
+    global _metrics_server
+    port = port or os.getenv("DOCUMENTCHAT_METRICS_PORT")
+    if not port or _metrics_server is not None:
+        return _metrics_server
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200 if self.path.startswith("/metrics") else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    _metrics_server = ThreadingHTTPServer((host, int(port)), Handler)
+    _metrics_server.daemon_threads = True
+    threading.Thread(target=_metrics_server.serve_forever, name="metrics", daemon=True).start()
+    return _metrics_server
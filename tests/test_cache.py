@@ -0,0 +1,91 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+from cache import DiskCache, cached_call, make_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(cache, "time", SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def test_make_key_is_order_independent_for_mappings():
+    assert make_key({"a": 1, "b": 2}, "x") == make_key({"b": 2, "a": 1}, "x")
+    assert make_key("x", 1) != make_key("x", "1 ")
+
+
+def test_entries_expire_after_ttl(tmp_path, clock):
+    store = DiskCache("ttl", directory=str(tmp_path), ttl=60)
+    store.set("key", {"value": 1})
+    clock[0] += 59
+    assert store.get("key") == {"value": 1}
+    clock[0] += 2
+    assert store.get("key", "missing") == "missing"
+    assert store.stats() == {"hits": 1, "semantic_hits": 0, "misses": 1, "entries": 0}
+
+
+def test_reads_do_not_extend_ttl(tmp_path, clock):
+    store = DiskCache("ttl_reads", directory=str(tmp_path), ttl=60)
+    store.set("key", 1)
+    for _ in range(3):
+        clock[0] += 30
+        store.get("key")
+    assert store.get("key") is None
+
+
+def test_evicts_least_recently_used_beyond_max_entries(tmp_path, clock):
+    store = DiskCache("lru", directory=str(tmp_path), max_entries=2)
+    store.set("a", 1)
+    clock[0] += 1
+    store.set("b", 2)
+    clock[0] += 1
+    assert store.get("a") == 1
+    clock[0] += 1
+    store.set("c", 3)
+    assert store.get("b") is None
+    assert (store.get("a"), store.get("c")) == (1, 3)
+
+
+def test_nearest_skips_other_partitions_and_expired_entries(tmp_path, clock):
+    store = DiskCache("nearest", directory=str(tmp_path), ttl=60)
+    store.set("old", "old", partition="p", embedding=[1.0, 0.0])
+    clock[0] += 61
+    store.set("other", "other", partition="q", embedding=[1.0, 0.0])
+    store.set("near", "near", partition="p", embedding=[0.9, 0.1])
+    assert store.nearest("p", [1.0, 0.0], threshold=0.9) == "near"
+    assert store.nearest("p", [0.0, 1.0], threshold=0.9, default="none") == "none"
+
+
+def test_cached_call_does_not_store_the_fallback(tmp_path):
+    store = DiskCache("calls", directory=str(tmp_path))
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError("transient")
+        return "answer"
+
+    assert cached_call(store, "key", flaky, fallback="fallback") == "fallback"
+    assert cached_call(store, "key", flaky, fallback="fallback") == "answer"
+    assert cached_call(store, "key", flaky, fallback="fallback") == "answer"
+    assert len(calls) == 2
+
+
+def test_cached_call_raises_without_fallback(tmp_path):
+    store = DiskCache("raises", directory=str(tmp_path))
+
+    def broken():
+        raise ValueError("broken")
+
+    with pytest.raises(ValueError):
+        cached_call(store, "key", broken)
+    assert store.stats()["entries"] == 0
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_forecast
+from data_forecast import batched_forecasting, forecast_key
+
+
+@pytest.fixture
+def history():
+    return pd.DataFrame({
+        "day": pd.to_datetime(["2024-01-01", "2024-01-02", "2024-01-03", "2024-01-03", "2024-01-04"]),
+        "sales": [1.0, 2.0, 3.0, 4.0, 5.0],
+    })
+
+
+def test_repeated_timestamps_get_their_own_rows(history, monkeypatch):
+    returned = []
+
+    def get_batch_forecast(context, timestamps, datetime_column, client):
+        forecasts = {forecast_key(timestamp): {"sales": "7"} for timestamp in timestamps}
+        returned.extend(forecasts.values())
+        return forecasts
+
+    monkeypatch.setattr(data_forecast, "get_batch_forecast", get_batch_forecast)
+    forecast = batched_forecasting(history, "day", client=None)
+    assert all(row == {"sales": "7"} for row in returned)
+    assert list(forecast["forecast_time"]) == list(pd.to_datetime(["2024-01-03", "2024-01-03", "2024-01-04", "2024-01-05"]))
+    assert list(forecast["sales"]) == ["7"] * 4
+
+
+def test_no_forecasts_keep_the_expected_columns(history, monkeypatch):
+    monkeypatch.setattr(data_forecast, "get_batch_forecast", lambda *args: {})
+    forecast = batched_forecasting(history, "day", client=None)
+    assert forecast.empty
+    assert list(forecast.columns) == ["sales", "forecast_time"]
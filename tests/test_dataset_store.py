@@ -0,0 +1,128 @@
+import io
+import os
+import sys
+import threading
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ingestion
+from dataset_store import DatasetStore, ReadOnlyError
+from ingestion import load_typed_file
+
+OWN = "a" * 64
+OTHER = "b" * 64
+
+
+def parquet_upload(values):
+    buffer = io.BytesIO()
+    pd.DataFrame({"value": values}).to_parquet(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingestion, "DATA_DIR", str(tmp_path))
+    store = DatasetStore(path=str(tmp_path / "datasets.duckdb"), max_idle=8)
+    yield store
+    store.con.close()
+
+
+@pytest.fixture
+def cursors(store):
+    own = store.open(OWN, lambda cursor: cursor.execute("CREATE TABLE dataframe AS SELECT range AS value FROM range(3)"))
+    other = store.open(OTHER, lambda cursor: load_typed_file(parquet_upload([42]), "parquet", OTHER, cursor))
+    own.cursor.register("forecast_dataframe", pd.DataFrame({"value": [1]}))
+    yield own.cursor, other
+    own.close()
+    other.close()
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT SUM(value) FROM dataframe",
+    "WITH totals AS (SELECT SUM(value) AS total FROM dataframe) SELECT * FROM totals",
+    "SELECT * FROM dataframe JOIN forecast_dataframe USING (value)",
+    "SELECT * FROM range(3)",
+    "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = current_schema()",
+    "DESCRIBE dataframe",
+    "EXPLAIN SELECT * FROM dataframe",
+])
+def test_dataset_queries_are_allowed(cursors, sql):
+    cursor, _ = cursors
+    cursor.execute(sql).fetchall()
+
+
+@pytest.mark.parametrize("sql", [
+    f"SELECT * FROM ds_{OTHER[:32]}.dataframe",
+    f"SELECT * FROM dataframe WHERE value IN (SELECT value FROM ds_{OTHER[:32]}.dataframe)",
+    f"EXPLAIN SELECT * FROM ds_{OTHER[:32]}.dataframe",
+    f"SELECT * FROM query_table('ds_{OTHER[:32]}.dataframe')",
+    "SELECT * FROM read_csv('/etc/passwd')",
+    "SELECT * FROM glob('*')",
+    "SELECT * FROM sniff_csv('/etc/passwd')",
+    "SELECT * FROM not_a_table",
+    "CREATE TABLE copied AS SELECT * FROM dataframe",
+])
+def test_reads_outside_the_dataset_are_rejected(cursors, sql):
+    cursor, _ = cursors
+    with pytest.raises(ReadOnlyError):
+        cursor.execute(sql)
+
+
+def test_spooled_uploads_of_other_datasets_are_rejected(cursors):
+    cursor, _ = cursors
+    path = os.path.join(ingestion.DATA_DIR, f"{OTHER}.parquet")
+    assert os.path.exists(path)
+    for sql in (f"SELECT * FROM read_parquet('{path}')", f"SELECT * FROM parquet_scan('{path}')", f"FROM '{path}'"):
+        with pytest.raises(ReadOnlyError):
+            cursor.execute(sql)
+
+
+def test_table_is_checked(cursors):
+    cursor, _ = cursors
+    assert cursor.table("dataframe").fetchall()
+    with pytest.raises(ReadOnlyError):
+        cursor.table(f"ds_{OTHER[:32]}.dataframe")
+
+
+def test_eviction_drops_the_schema_and_spooled_upload(store):
+    store.max_idle = 0
+    handle = store.open(OTHER, lambda cursor: load_typed_file(parquet_upload([42]), "parquet", OTHER, cursor))
+    path = os.path.join(ingestion.DATA_DIR, f"{OTHER}.parquet")
+    assert os.path.exists(path)
+    handle.close()
+    assert not store.contains(OTHER)
+    assert not os.path.exists(path)
+
+
+class OpenedWhileWaiting:
+    """
+    A load lock that lets a session take a reference to the dataset right before the
+    eviction gets the lock, as a concurrent open() would.
+    """
+
+    def __init__(self, store, schema):
+        self.store = store
+        self.schema = schema
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.store._lock:
+            self.store._refcounts[self.schema] = self.store._refcounts.get(self.schema, 0) + 1
+        return self.lock.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.lock.__exit__(*exc_info)
+
+
+def test_eviction_skips_a_dataset_opened_meanwhile(store):
+    handle = store.open(OTHER, lambda cursor: cursor.execute("CREATE TABLE dataframe AS SELECT 1 AS value"))
+    handle.close()
+    schema = store.schema(OTHER)
+    store._load_locks[schema] = OpenedWhileWaiting(store, schema)
+    store.max_idle = 0
+    store._evict()
+    assert store.contains(OTHER)
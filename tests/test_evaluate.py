@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("llm_guard")
+
+import evaluate
+
+
+class NonReentrantScanner:
+    """
+    Fails like a Hugging Face fast tokenizer when two threads scan at the same time.
+    """
+
+    def __init__(self):
+        self._busy = threading.Lock()
+
+    def scan(self, *texts):
+        if not self._busy.acquire(blocking=False):
+            raise RuntimeError("Already borrowed")
+        try:
+            time.sleep(0.001)
+            return texts[-1], True, 0.0
+        finally:
+            self._busy.release()
+
+
+@pytest.fixture
+def fake_scanners(monkeypatch):
+    monkeypatch.setattr(evaluate, "_scanners", {name: NonReentrantScanner() for name in evaluate.scanner_factories})
+
+
+def test_batches_from_concurrent_sessions_share_scanners_safely(fake_scanners):
+    errors = []
+
+    def session():
+        try:
+            evaluate.scan_many([f"prompt {index}" for index in range(20)])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=session) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_prompt_and_output_guards_share_scanners_safely(fake_scanners):
+    errors = []
+
+    def guard(index):
+        try:
+            assert evaluate.is_prompt_safe(f"prompt {index}")
+            assert evaluate.is_output_safe(f"prompt {index}", f"output {index}")
+            evaluate.evaluate_output(f"prompt {index}", f"output {index}")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=guard, args=(index,)) for index in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ingestion
+from ingestion import connect_dataset, sweep_datasets, touch_dataset
+
+OLD = "a" * 64
+NEW = "b" * 64
+STORED = "c" * 64
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingestion, "DATA_DIR", str(tmp_path))
+    return tmp_path
+
+
+def age(path, seconds):
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def test_sweep_deletes_only_unused_dataset_files(data_dir):
+    connect_dataset(OLD).close()
+    for name in (f"{OLD}.parquet", f"{OLD}.parquet.x1y2.part", f"{NEW}.parquet", f"{STORED}.parquet", "datasets.duckdb", "notes.txt"):
+        (data_dir / name).write_bytes(b"data")
+    for path in data_dir.iterdir():
+        age(path, 7200)
+    touch_dataset(NEW)
+
+    removed = sweep_datasets(max_age=3600, keep=lambda fingerprint: fingerprint == STORED)
+    assert removed == 3
+    assert sorted(os.listdir(data_dir)) == sorted([f"{NEW}.parquet", f"{STORED}.parquet", "datasets.duckdb", "notes.txt"])
+
+
+def test_sweep_without_data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingestion, "DATA_DIR", str(tmp_path / "missing"))
+    assert sweep_datasets() == 0
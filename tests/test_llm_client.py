@@ -0,0 +1,108 @@
+import gc
+import os
+import sys
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_client import LLMClient, LLMUnavailableError, estimate_tokens, llm_session
+from telemetry import InstrumentedClient
+
+
+def chunk(content=None, total_tokens=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content is not None else []
+    usage = SimpleNamespace(total_tokens=total_tokens) if total_tokens is not None else None
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+def fake_client(create):
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def streaming_client(**options):
+    def create(**kwargs):
+        if kwargs.get("stream"):
+            return iter([chunk("Hello"), chunk(" world"), chunk(total_tokens=10)])
+        return SimpleNamespace(usage=SimpleNamespace(total_tokens=10))
+    return LLMClient(fake_client(create), session_concurrency=1, tokens_per_minute=10000, **options)
+
+
+def test_unstarted_stream_releases_its_slot_when_dropped():
+    client = streaming_client()
+    instrumented = InstrumentedClient(client)
+    with llm_session("dropped"):
+        stream = instrumented.chat.completions.create(messages=[], stream=True)
+        slots = client._slots()
+        assert not slots.acquire(timeout=0.01)
+        del stream
+        gc.collect()
+        assert slots.acquire(timeout=1)
+        slots.release()
+
+
+def test_consumed_stream_releases_its_slot_and_settles_usage():
+    client = streaming_client()
+    with llm_session("consumed"):
+        stream = client.chat.completions.create(messages=[], stream=True)
+        assert "".join(c.choices[0].delta.content for c in stream if c.choices) == "Hello world"
+        slots = client._slots()
+        assert slots.acquire(timeout=1)
+        slots.release()
+    assert round(client.tokens.tokens) == 10000 - 10
+
+
+def test_closed_stream_releases_its_slot():
+    client = streaming_client()
+    with llm_session("closed"):
+        stream = client.chat.completions.create(messages=[], stream=True)
+        next(stream)
+        stream.close()
+        slots = client._slots()
+        assert slots.acquire(timeout=1)
+        slots.release()
+
+
+def test_waiting_for_a_slot_times_out():
+    client = streaming_client(slot_timeout=0.05)
+    with llm_session("busy"):
+        stream = client.chat.completions.create(messages=[], stream=True)
+        with pytest.raises(LLMUnavailableError):
+            client.chat.completions.create(messages=[])
+        stream.close()
+
+
+def test_failed_attempts_refund_their_reservation():
+    attempts = []
+
+    def create(**kwargs):
+        attempts.append(kwargs)
+        if len(attempts) < 4:
+            raise openai.APIConnectionError(request=httpx.Request("POST", "http://localhost"))
+        return SimpleNamespace(usage=SimpleNamespace(total_tokens=100))
+
+    client = LLMClient(fake_client(create), tokens_per_minute=10000, base_delay=0, max_delay=0)
+    request = {"messages": [{"role": "user", "content": "x" * 400}], "max_completion_tokens": 1000}
+    assert estimate_tokens(request) > 1000
+    client.chat.completions.create(**request)
+    assert len(attempts) == 4
+    assert round(client.tokens.tokens) == 10000 - 100
+
+
+def test_reservation_is_capped_at_the_bucket():
+    client = LLMClient(fake_client(lambda **kwargs: SimpleNamespace(usage=SimpleNamespace(total_tokens=50))),
+                       tokens_per_minute=1000)
+    client.chat.completions.create(messages=[], max_completion_tokens=5000)
+    assert round(client.tokens.tokens) == 1000 - 50
+
+
+def test_idle_session_slots_are_pruned():
+    client = streaming_client()
+    for session in range(100):
+        with llm_session(f"session-{session}"):
+            client.chat.completions.create(messages=[])
+    gc.collect()
+    assert len(client._session_slots) == 0
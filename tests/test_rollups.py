@@ -0,0 +1,43 @@
+import os
+import sys
+
+import duckdb
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rollups import build_rollups, route_to_rollup, ROLLUP_MIN_ROWS
+from schema_summary import summarize_table
+
+
+def rolled_up_connection():
+    con = duckdb.connect()
+    con.execute(f"""
+        CREATE TABLE dataframe AS
+        SELECT TIMESTAMP '2024-01-01' + INTERVAL (i % 30000) MINUTE AS ts,
+               ['north', 'south', 'east'][i % 3 + 1] AS region,
+               i % 97 AS amount
+        FROM range({ROLLUP_MIN_ROWS}) AS t(i)
+    """)
+    row_count, columns = summarize_table(con, "dataframe")
+    rollups = build_rollups(con, row_count, columns)
+    assert any(rollup["grain"] == "day" for rollup in rollups)
+    return con, rollups
+
+
+def routed(con, rollups, sql):
+    rewritten = route_to_rollup(con, sql, rollups)
+    assert sorted(con.execute(rewritten).fetchall()) == sorted(con.execute(sql).fetchall())
+    return rewritten != sql
+
+
+def test_day_and_coarser_strftime_uses_a_rollup():
+    con, rollups = rolled_up_connection()
+    assert routed(con, rollups, "SELECT strftime(ts, '%Y-%m') AS month, SUM(amount) FROM dataframe GROUP BY 1")
+    assert routed(con, rollups, "SELECT strftime(ts, '%A') AS weekday, SUM(amount) FROM dataframe GROUP BY 1")
+
+
+def test_time_of_day_strftime_reads_the_table():
+    con, rollups = rolled_up_connection()
+    for code in ("%H", "%M", "%S", "%I %p", "%T", "%c", "%X", "%Y-%m-%d %H:00"):
+        sql = f"SELECT strftime(ts, '{code}') AS period, SUM(amount) FROM dataframe GROUP BY 1"
+        assert not routed(con, rollups, sql), code
@@ -0,0 +1,69 @@
+import os
+import sys
+
+import duckdb
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sampling
+from sampling import approximate_query, build_sample
+from schema_summary import summarize_table
+
+ROWS = 200000
+
+
+@pytest.fixture
+def con():
+    con = duckdb.connect()
+    con.execute(f"""
+        CREATE TABLE dataframe AS
+        SELECT CASE WHEN i % 1000 = 0 THEN 'rare' WHEN i % 2 = 0 THEN 'even' ELSE 'odd' END AS kind,
+               'user_' || (i % 97)::VARCHAR AS user_name,
+               (i % 101)::DOUBLE AS amount
+        FROM range({ROWS}) AS t(i)
+    """)
+    return con
+
+
+@pytest.fixture
+def sample(con, monkeypatch):
+    monkeypatch.setattr(sampling, "APPROXIMATE_MIN_ROWS", 1000)
+    row_count, columns = summarize_table(con, "dataframe")
+    return build_sample(con, row_count, columns, sample_rows=5000)
+
+
+def test_small_tables_are_answered_exactly(con):
+    for sql in ("SELECT COUNT(DISTINCT user_name) FROM dataframe", "SELECT SUM(amount) FROM dataframe"):
+        assert approximate_query(con, sql, None) == (sql, None)
+
+
+def test_sketch_answers_do_not_claim_a_bound(con, sample):
+    sql, info = approximate_query(con, "SELECT COUNT(DISTINCT user_name) AS users FROM dataframe", sample)
+    assert info["method"] == "sketch" and "approx_count_distinct" in sql
+    text = sampling.describe_approximation(info)
+    assert "no error bound" in text and "few percent" not in text
+
+
+def test_sample_is_stratified_by_the_coarsest_dimension(con, sample):
+    assert sample["stratum"] == "kind"
+    # The rare group keeps all of its rows, and the weights add up to the table
+    rare = con.execute(f'SELECT COUNT(*), SUM("__weight") FROM "{sample["name"]}" WHERE kind = \'rare\'').fetchone()
+    assert rare == (ROWS // 1000, ROWS // 1000)
+    total = con.execute(f'SELECT SUM("__weight") FROM "{sample["name"]}"').fetchone()[0]
+    assert abs(total - ROWS) / ROWS < 0.05
+
+
+def test_average_bound_covers_the_exact_average(con, sample):
+    sql, info = approximate_query(con, "SELECT kind, AVG(amount) AS average FROM dataframe GROUP BY kind ORDER BY kind", sample)
+    assert info["method"] == "sample" and info["margins"] == {"average": "__margin_1"}
+    estimates = con.execute(sql).fetchall()
+    exact = con.execute("SELECT kind, AVG(amount) FROM dataframe GROUP BY kind ORDER BY kind").fetchall()
+    for (kind, estimate, margin), (_, value) in zip(estimates, exact):
+        assert 0 <= margin < 5
+        assert abs(estimate - value) <= margin
+
+
+def test_minimum_and_maximum_are_exact(con, sample):
+    for sql in ("SELECT MAX(amount) FROM dataframe", "SELECT SUM(amount), MIN(amount) FROM dataframe"):
+        assert approximate_query(con, sql, sample) == (sql, None)
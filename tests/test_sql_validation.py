@@ -0,0 +1,68 @@
+import os
+import sys
+
+import duckdb
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sql_validation import SQLValidationError, repair, strip_fences, validate_sql
+
+
+@pytest.fixture
+def con():
+    con = duckdb.connect()
+    con.execute(
+        'CREATE TABLE dataframe AS SELECT * FROM (VALUES (1, 2.5, \'north\', 3, 4)) '
+        't(id, "Unit Price", region, "order-count", order_count_2)'
+    )
+    return con
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("```sql\nSELECT id FROM dataframe;\n```", "SELECT id FROM dataframe"),
+    ("SQL: SELECT id FROM dataframe", "SELECT id FROM dataframe"),
+    ("'SELECT id FROM dataframe'", "SELECT id FROM dataframe"),
+])
+def test_strip_fences(sql, expected):
+    assert strip_fences(sql) == expected
+
+
+def test_quotes_bare_and_backticked_columns(con):
+    sql = validate_sql(con, "SELECT `region`, SUM(Unit Price) FROM dataframe GROUP BY region", ["dataframe"])
+    assert sql == 'SELECT "region", SUM("Unit Price") FROM dataframe GROUP BY region'
+    con.execute(sql)
+
+
+def test_repairs_table_near_miss(con):
+    sql = validate_sql(con, "SELECT id FROM DataFrames", ["dataframe"])
+    assert sql == "SELECT id FROM dataframe"
+
+
+def test_repairs_column_differing_in_case_and_punctuation(con):
+    sql = validate_sql(con, "SELECT unit_price FROM dataframe WHERE unit_price > 1", ["dataframe"])
+    assert sql == 'SELECT "Unit Price" FROM dataframe WHERE "Unit Price" > 1'
+
+
+def test_repair_leaves_string_literals_alone(con):
+    sql = validate_sql(con, "SELECT unit_price FROM dataframe WHERE region <> 'unit_price'", ["dataframe"])
+    assert sql == 'SELECT "Unit Price" FROM dataframe WHERE region <> \'unit_price\''
+
+
+def test_no_repair_without_a_single_candidate():
+    error = 'Binder Error: Referenced column "amount" not found in FROM clause!'
+    assert repair("SELECT amount FROM dataframe", error, {"dataframe": ["Amount", "amount_"]}) is None
+    assert repair("SELECT x FROM dataframe", "Parser Error: syntax error", {"dataframe": ["x"]}) is None
+
+
+def test_unrepairable_query_names_the_closest_columns(con):
+    with pytest.raises(SQLValidationError) as error:
+        validate_sql(con, "SELECT order_counts FROM dataframe", ["dataframe"])
+    message = str(error.value)
+    assert 'Referenced column "order_counts" not found' in message
+    assert "Closest existing columns:" in message and '"order_count_2"' in message
+
+
+def test_unknown_table_lists_the_available_tables(con):
+    with pytest.raises(SQLValidationError, match="Available tables: dataframe"):
+        validate_sql(con, "SELECT id FROM orders", ["dataframe"])
@@ -1,23 +1,11 @@
 from models import ChartFlag, ChartType
 import json
+from cache import get_cache, make_key
+from data_extraction_openai import normalize_question
+from schema_summary import metadata_context
+from telemetry import record_cache_hit
 
-def create_metadata(df):
-    return df.head().to_string()
-
-def potential_data_visualisation(user_input, session_state, forecasting, client ):
-    """
-    Determines if a data visualization is necessary and identifies the best visualization type.
-
-    Parameters:
-    - user_input: The user's prompt for the visualization.
-    - session_state: An object containing the state, including dataframes and metadata.
-    - client: The OpenAI client for generating queries.
-    - forecasting: A boolean indicating if forecasting-related data is included.
-
-    Returns:
-    - A ChartType object containing the type, method, and description of the visualization if needed.
-    """
-    chart_types = [{'Type': 'Scatter',
+chart_types = [{'Type': 'Scatter',
   'Method': 'scatter',
   'Description': 'In a scatter plot, each row of data_frame is represented by a symbol mark in 2D space.'},
  {'Type': 'Line',
@@ -122,25 +110,45 @@ def potential_data_visualisation(user_input, session_state, forecasting, client
   'Description': 'In a ternary scatter plot, each row of data_frame is represented by a symbol mark in ternary coordinates.'},
  {'Type': 'Line Ternary',
   'Method': 'line_ternary',
-  'Description': 'In a ternary line plot, each row of data_frame is represented as vertex of a polyline mark in ternary coordinates.'}]# Keep the existing chart_types definition here
+  'Description': 'In a ternary line plot, each row of data_frame is represented as vertex of a polyline mark in ternary coordinates.'}]
+
+
+def get_visualisation_context(session_state, forecasting):
+    """
+    Builds the retrieved context and table description shared by the visualisation prompts.
 
-    # Generate metadata based on the forecasting flag
+    Parameters:
+    - session_state: An object containing the state, including dataframes and metadata.
+    - forecasting: A boolean indicating if forecasting-related data is included.
+
+    Returns:
+    - A tuple of the retrieved context and the description of the available dataframes.
+    """
+    retrieved_context = metadata_context(session_state, forecasting)
     if forecasting:
-        metadata_df = create_metadata(session_state.df)
-        metadata_forecast_df = create_metadata(session_state.forecast_df)
-        retrieved_context = (
-            f"Main DataFrame Metadata:\n{metadata_df}\n\n"
-            f"Forecast DataFrame Metadata:\n{metadata_forecast_df}"
-        )
         dataframes_description = (
             "'dataframe' represents the main dataset, while 'forecast_dataframe' represents forecasted data."
         )
     else:
-        metadata_df = create_metadata(session_state.df)
-        retrieved_context = f"Main DataFrame Metadata:\n{metadata_df}"
         dataframes_description = "'dataframe' represents the main dataset."
+    return retrieved_context, dataframes_description
+
+
+def is_visualisation_necessary(user_input, session_state, forecasting, client):
+    """
+    Determines if the response to the prompt is best represented as a data visualization.
+
+    Parameters:
+    - user_input: The user's prompt for the visualization.
+    - session_state: An object containing the state, including dataframes and metadata.
+    - forecasting: A boolean indicating if forecasting-related data is included.
+    - client: The OpenAI client for generating queries.
+
+    Returns:
+    - bool: True if a visualization is necessary, False otherwise.
+    """
+    retrieved_context, dataframes_description = get_visualisation_context(session_state, forecasting)
 
-    # First system prompt to determine if visualization is necessary
     flag_format = "{\"visualisation_necessary\": flag}"
     system_prompt = (
         f"Given the prompt: `{user_input}` and the metadata below, can you determine if the response can be best represented in the form of a data visualization? "
@@ -151,7 +159,6 @@ def potential_data_visualisation(user_input, session_state, forecasting, client
     )
 
     try:
-        # First query to check if visualization is necessary
         chat_completion = client.chat.completions.create(
             model="gpt-4o",
             messages=[
@@ -184,58 +191,113 @@ def potential_data_visualisation(user_input, session_state, forecasting, client
         )
 
         print(chat_completion.choices[0].message.content)
-        if ChartFlag.model_validate_json(chat_completion.choices[0].message.content).visualisation_necessary:
-            # Visualization is necessary; determine the type
-            visualisation_format = "{\"Type\": chart_type, \"Method\": function(), \"Description\": description}"
-            system_prompt = (
-                f"Given the prompt: `{user_input}` and the metadata below, determine the best type of data visualization. "
-                f"The JSON format: {visualisation_format}. \n"
-                f"The list of choices for the responses are available in {json.dumps(chart_types)}. It provides the types of charts available, their corresponding methods, and descriptions. "
-                f"Return the choice JSON which is most suitable. {dataframes_description}."
-            )
-
-            chat_completion = client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Prompt: `{user_input}` \n Retrieved Context: `{retrieved_context}`"}
-                ],
-                model="gpt-4o",
-                response_format={
-                    "type": "json_schema",
-                    "json_schema": {
-                        "name": "visualisation_format",
-                        "strict": True,
-                        "schema": {
-                            "type": "object",
-                            "properties": {
-                                "Type": {
-                                    "type": "string",
-                                    "description": "The type of chart, such as bar, line, pie, etc."
-                                },
-                                "Method": {
-                                    "type": "string",
-                                    "description": "A method or function that pertains to the visualization."
-                                },
-                                "Description": {
-                                    "type": "string",
-                                    "description": "A description of the visualization and its purpose."
-                                }
+        return ChartFlag.model_validate_json(chat_completion.choices[0].message.content).visualisation_necessary
+    except Exception as e:
+        print(e)
+        return False
+
+
+def get_visualisation_type(user_input, session_state, forecasting, client):
+    """
+    Identifies the best visualization type for the prompt, regardless of whether one is necessary.
+
+    Parameters:
+    - user_input: The user's prompt for the visualization.
+    - session_state: An object containing the state, including dataframes and metadata.
+    - forecasting: A boolean indicating if forecasting-related data is included.
+    - client: The OpenAI client for generating queries.
+
+    Returns:
+    - A ChartType object containing the type, method, and description of the visualization, or None on failure.
+    """
+    retrieved_context, dataframes_description = get_visualisation_context(session_state, forecasting)
+
+    visualisation_format = "{\"Type\": chart_type, \"Method\": function(), \"Description\": description}"
+    system_prompt = (
+        f"Given the prompt: `{user_input}` and the metadata below, determine the best type of data visualization. "
+        f"The JSON format: {visualisation_format}. \n"
+        f"The list of choices for the responses are available in {json.dumps(chart_types)}. It provides the types of charts available, their corresponding methods, and descriptions. "
+        f"Return the choice JSON which is most suitable. {dataframes_description}."
+    )
+
+    try:
+        chat_completion = client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": f"Prompt: `{user_input}` \n Retrieved Context: `{retrieved_context}`"}
+            ],
+            model="gpt-4o",
+            response_format={
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "visualisation_format",
+                    "strict": True,
+                    "schema": {
+                        "type": "object",
+                        "properties": {
+                            "Type": {
+                                "type": "string",
+                                "description": "The type of chart, such as bar, line, pie, etc."
                             },
-                            "required": ["Type", "Method", "Description"],
-                            "additionalProperties": False
-                        }
+                            "Method": {
+                                "type": "string",
+                                "description": "A method or function that pertains to the visualization."
+                            },
+                            "Description": {
+                                "type": "string",
+                                "description": "A description of the visualization and its purpose."
+                            }
+                        },
+                        "required": ["Type", "Method", "Description"],
+                        "additionalProperties": False
                     }
-                },
-                temperature=0,
-                max_completion_tokens=2048,
-                top_p=1,
-                frequency_penalty=0,
-                presence_penalty=0
-            )
-            print(chat_completion.choices[0].message.content)
-            return ChartType.model_validate_json(chat_completion.choices[0].message.content)
-        else:
-            return None
+                }
+            },
+            temperature=0,
+            max_completion_tokens=2048,
+            top_p=1,
+            frequency_penalty=0,
+            presence_penalty=0
+        )
+        print(chat_completion.choices[0].message.content)
+        return ChartType.model_validate_json(chat_completion.choices[0].message.content)
     except Exception as e:
         print(e)
         return None
+
+
+chart_type_cache = get_cache("chart_types", max_entries=10000, ttl=30 * 24 * 3600)
+
+
+def cached_visualisation_type(user_input, session_state, forecasting, client):
+    """
+    Returns get_visualisation_type for the prompt, asking the LLM once per normalized
+    question and retrieved context. Failures (None) are not cached.
+    """
+    key = make_key(metadata_context(session_state, forecasting), forecasting, normalize_question(user_input))
+    cached = chart_type_cache.get(key)
+    if cached is not None:
+        record_cache_hit("visualisation_type")
+        return ChartType(**cached)
+    chart_type = get_visualisation_type(user_input, session_state, forecasting, client)
+    if chart_type is not None:
+        chart_type_cache.set(key, chart_type.model_dump())
+    return chart_type
+
+
+def potential_data_visualisation(user_input, session_state, forecasting, client ):
+    """
+    Determines if a data visualization is necessary and identifies the best visualization type.
+
+    Parameters:
+    - user_input: The user's prompt for the visualization.
+    - session_state: An object containing the state, including dataframes and metadata.
+    - client: The OpenAI client for generating queries.
+    - forecasting: A boolean indicating if forecasting-related data is included.
+
+    Returns:
+    - A ChartType object containing the type, method, and description of the visualization if needed.
+    """
+    if is_visualisation_necessary(user_input, session_state, forecasting, client):
+        return get_visualisation_type(user_input, session_state, forecasting, client)
+    return None